@@ -0,0 +1,279 @@
+"""Scalable synthetic FHIR R5 study, for benchmarks.
+
+Resources cover the FHIR types of `dependency_order` in config.yaml, reference each other the way a study does
+(subjects, specimens, observations on specimens, tasks linking documents) and are streamed to disk,
+so the size of a study is bounded only by disk space.
+"""
+import pathlib
+import random
+import uuid
+from typing import Dict, Iterator, List
+
+import orjson
+
+SYSTEM = 'https://example.org/benchmark'
+"""Identifier and coding system of generated resources."""
+
+FIXED_COUNTS = {
+    'Organization': 1,
+    'Practitioner': 10,
+    'PractitionerRole': 10,
+    'ResearchStudy': 1,
+    'Substance': 5,
+    'Medication': 5,
+}
+"""Resources per study, independent of scale."""
+
+PER_PATIENT = {
+    'Patient': 1,
+    'ResearchSubject': 1,
+    'Specimen': 2,
+    'Observation': 6,
+    'DiagnosticReport': 1,
+    'Condition': 1,
+    'MedicationAdministration': 1,
+    'Procedure': 1,
+    'DocumentReference': 2,
+    'Task': 1,
+    'ImagingStudy': 1,
+    'FamilyMemberHistory': 1,
+    'BodyStructure': 1,
+}
+"""Resources per patient."""
+
+RESOURCE_TYPES = list(FIXED_COUNTS) + list(PER_PATIENT)
+"""Generated resource types, in dependency order."""
+
+
+def _coding(code: str, display: str = None) -> dict:
+    """A CodeableConcept with a single coding."""
+    return {'coding': [{'system': SYSTEM, 'code': code, 'display': display or code}]}
+
+
+def _reference(resource_type: str, index: int) -> dict:
+    """Reference to a generated resource."""
+    return {'reference': f"{resource_type}/{_id(resource_type, index)}"}
+
+
+def _id(resource_type: str, index: int) -> str:
+    """Id of a generated resource, a uuid as the simplified schema requires."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{SYSTEM}/{resource_type}/{index}"))
+
+
+def _identifier(resource_type: str, index: int) -> List[dict]:
+    """Identifier of a generated resource."""
+    return [{'system': SYSTEM, 'value': f"{resource_type}-{index}", 'use': 'official'}]
+
+
+def _date(rng: random.Random) -> str:
+    """A random date."""
+    return f"{rng.randint(1940, 2020)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+
+
+def _date_time(rng: random.Random) -> str:
+    """A random dateTime, with a time zone as the simplified schema requires."""
+    return f"{_date(rng)}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00+00:00"
+
+
+class Study:
+    """Builds resource n of a type, deterministically from the seed."""
+
+    def __init__(self, resources: int, seed: int = 0):
+        """A study of about `resources` resources."""
+        self.patients = max(1, (resources - sum(FIXED_COUNTS.values())) // sum(PER_PATIENT.values()))
+        """number of patients"""
+        self.seed = seed
+        """random seed"""
+
+    def count(self, resource_type: str) -> int:
+        """Number of resources of a type."""
+        if resource_type in FIXED_COUNTS:
+            return FIXED_COUNTS[resource_type]
+        return self.patients * PER_PATIENT[resource_type]
+
+    def __len__(self) -> int:
+        """Number of resources."""
+        return sum(self.count(_) for _ in RESOURCE_TYPES)
+
+    def resources(self, resource_type: str) -> Iterator[dict]:
+        """All resources of a type."""
+        rng = random.Random(f"{self.seed}-{resource_type}")
+        build = getattr(self, f"_{resource_type}")
+        for index in range(self.count(resource_type)):
+            yield build(index, rng)
+
+    def _patient_of(self, resource_type: str, index: int) -> int:
+        """Patient of the index-th resource of a per patient type."""
+        return index // PER_PATIENT[resource_type]
+
+    def _base(self, resource_type: str, index: int) -> dict:
+        """resourceType, id and identifier."""
+        return {'resourceType': resource_type, 'id': _id(resource_type, index), 'identifier': _identifier(resource_type, index)}
+
+    def _Organization(self, index, rng) -> dict:
+        return self._base('Organization', index) | {'name': f"Organization {index}", 'active': True, 'type': [_coding('prov', 'Healthcare Provider')]}
+
+    def _Practitioner(self, index, rng) -> dict:
+        return self._base('Practitioner', index) | {'name': [{'family': f"Family{index}", 'given': [f"Given{index}"]}]}
+
+    def _PractitionerRole(self, index, rng) -> dict:
+        return self._base('PractitionerRole', index) | {
+            'practitioner': _reference('Practitioner', index % FIXED_COUNTS['Practitioner']),
+            'organization': _reference('Organization', 0),
+            'code': [_coding('researcher')],
+        }
+
+    def _ResearchStudy(self, index, rng) -> dict:
+        return self._base('ResearchStudy', index) | {
+            'status': 'active', 'title': f"Benchmark study {index}", 'description': 'Synthetic study',
+            'condition': [_coding('C0000', 'Condition')], 'keyword': [_coding('benchmark')],
+        }
+
+    def _Substance(self, index, rng) -> dict:
+        return self._base('Substance', index) | {'instance': False, 'code': {'concept': _coding(f"substance-{index}")}}
+
+    def _Medication(self, index, rng) -> dict:
+        return self._base('Medication', index) | {'code': _coding(f"medication-{index}"), 'status': 'active'}
+
+    def _Patient(self, index, rng) -> dict:
+        return self._base('Patient', index) | {
+            'active': True,
+            'gender': rng.choice(['male', 'female', 'other', 'unknown']),
+            'birthDate': _date(rng),
+            'address': [{'postalCode': f"{rng.randint(10000, 99999)}", 'country': 'US'}],
+            'extension': [{'url': f"{SYSTEM}/StructureDefinition/age", 'valueInteger': rng.randint(1, 90)}],
+            'managingOrganization': _reference('Organization', 0),
+        }
+
+    def _ResearchSubject(self, index, rng) -> dict:
+        return self._base('ResearchSubject', index) | {
+            'status': 'active', 'study': _reference('ResearchStudy', 0),
+            'subject': _reference('Patient', self._patient_of('ResearchSubject', index)),
+        }
+
+    def _Specimen(self, index, rng) -> dict:
+        return self._base('Specimen', index) | {
+            'subject': _reference('Patient', self._patient_of('Specimen', index)),
+            'type': _coding(rng.choice(['blood', 'saliva', 'tissue'])),
+            'collection': {'collectedDateTime': _date_time(rng), 'bodySite': {'concept': _coding('arm')}},
+        }
+
+    def _Observation(self, index, rng) -> dict:
+        patient = self._patient_of('Observation', index)
+        return self._base('Observation', index) | {
+            'status': 'final',
+            'category': [_coding('laboratory')],
+            'code': _coding(rng.choice(['weight', 'height', 'hemoglobin'])),
+            'subject': _reference('Patient', patient),
+            'focus': [_reference('Specimen', patient * PER_PATIENT['Specimen'])],
+            'effectiveDateTime': _date_time(rng),
+            'valueQuantity': {'value': round(rng.uniform(1, 200), 2), 'unit': 'kg', 'system': 'http://unitsofmeasure.org', 'code': 'kg'},
+        }
+
+    def _DiagnosticReport(self, index, rng) -> dict:
+        patient = self._patient_of('DiagnosticReport', index)
+        return self._base('DiagnosticReport', index) | {
+            'status': 'final', 'code': _coding('panel'),
+            'subject': _reference('Patient', patient),
+            'specimen': [_reference('Specimen', patient * PER_PATIENT['Specimen'])],
+            'result': [_reference('Observation', patient * PER_PATIENT['Observation'] + _) for _ in range(2)],
+        }
+
+    def _Condition(self, index, rng) -> dict:
+        return self._base('Condition', index) | {
+            'clinicalStatus': _coding('active'),
+            'code': _coding(rng.choice(['diabetes', 'asthma', 'hypertension'])),
+            'subject': _reference('Patient', self._patient_of('Condition', index)),
+            'onsetDateTime': _date_time(rng),
+        }
+
+    def _MedicationAdministration(self, index, rng) -> dict:
+        return self._base('MedicationAdministration', index) | {
+            'status': 'completed',
+            'medication': {'reference': _reference('Medication', index % FIXED_COUNTS['Medication'])},
+            'subject': _reference('Patient', self._patient_of('MedicationAdministration', index)),
+            'occurenceDateTime': _date_time(rng),
+        }
+
+    def _Procedure(self, index, rng) -> dict:
+        return self._base('Procedure', index) | {
+            'status': 'completed', 'code': _coding('biopsy'),
+            'subject': _reference('Patient', self._patient_of('Procedure', index)),
+            'occurrenceDateTime': _date_time(rng),
+        }
+
+    def _DocumentReference(self, index, rng) -> dict:
+        return self._base('DocumentReference', index) | {
+            'status': 'current',
+            'subject': _reference('Patient', self._patient_of('DocumentReference', index)),
+            'content': [{'attachment': {'url': f"file:///data/{index}.cram", 'contentType': 'application/cram',
+                                        'size': rng.randint(1000, 10 ** 9), 'title': f"{index}.cram"}}],
+        }
+
+    def _Task(self, index, rng) -> dict:
+        patient = self._patient_of('Task', index)
+        documents = [patient * PER_PATIENT['DocumentReference'] + _ for _ in range(PER_PATIENT['DocumentReference'])]
+        return self._base('Task', index) | {
+            'status': 'completed', 'intent': 'order', 'code': _coding('alignment'),
+            'for': _reference('Patient', patient),
+            'focus': _reference('Specimen', patient * PER_PATIENT['Specimen']),
+            'input': [{'type': _coding('input'), 'valueReference': _reference('DocumentReference', documents[0])}],
+            'output': [{'type': _coding('output'), 'valueReference': _reference('DocumentReference', documents[1])}],
+        }
+
+    def _ImagingStudy(self, index, rng) -> dict:
+        return self._base('ImagingStudy', index) | {
+            'status': 'available', 'modality': [_coding('MR')], 'numberOfSeries': rng.randint(1, 10),
+            'subject': _reference('Patient', self._patient_of('ImagingStudy', index)),
+        }
+
+    def _FamilyMemberHistory(self, index, rng) -> dict:
+        return self._base('FamilyMemberHistory', index) | {
+            'status': 'completed',
+            'patient': _reference('Patient', self._patient_of('FamilyMemberHistory', index)),
+            'relationship': _coding(rng.choice(['MTH', 'FTH', 'SIS'])),
+            'condition': [{'code': _coding('diabetes')}],
+        }
+
+    def _BodyStructure(self, index, rng) -> dict:
+        return self._base('BodyStructure', index) | {
+            'patient': _reference('Patient', self._patient_of('BodyStructure', index)),
+            'includedStructure': [{'structure': _coding('arm')}],
+            'morphology': _coding('tumor'),
+        }
+
+
+def write_ndjson(study: Study, output_path: pathlib.Path) -> Dict[str, int]:
+    """Write `<ResourceType>.ndjson` files, return the counts."""
+    output_path.mkdir(parents=True, exist_ok=True)
+    counts = {}
+    for resource_type in RESOURCE_TYPES:
+        with open(output_path / f"{resource_type}.ndjson", 'wb') as fp:
+            for resource in study.resources(resource_type):
+                fp.write(orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE))
+                counts[resource_type] = counts.get(resource_type, 0) + 1
+    return counts
+
+
+def write_bundles(study: Study, output_path: pathlib.Path, bundle_size: int = 1000) -> int:
+    """Write the study as `bundle-<n>.json` collection bundles of bundle_size entries, return the number of bundles."""
+    output_path.mkdir(parents=True, exist_ok=True)
+    bundles = 0
+    entries = []
+
+    def _write():
+        bundle = {'resourceType': 'Bundle', 'id': f"bundle-{bundles}", 'type': 'collection', 'entry': entries}
+        with open(output_path / f"bundle-{bundles:05d}.json", 'wb') as fp:
+            fp.write(orjson.dumps(bundle))
+
+    for resource_type in RESOURCE_TYPES:
+        for resource in study.resources(resource_type):
+            entries.append({'fullUrl': f"{SYSTEM}/{resource_type}/{resource['id']}", 'resource': resource})
+            if len(entries) == bundle_size:
+                _write()
+                bundles += 1
+                entries = []
+    if entries:
+        _write()
+        bundles += 1
+    return bundles
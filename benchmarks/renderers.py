@@ -0,0 +1,199 @@
+"""Micro-benchmarks of the simplifier's monkeypatched renderers, ns/op and allocations per call.
+
+    python -m benchmarks.renderers --output renderers-new.json --compare renderers-old.json
+
+Each renderer is called on representative inputs, the FHIR models are parsed once up front.
+Time is the best of `repeat` runs of `number` calls. Allocations are measured with tracemalloc in a separate
+run, as the memory blocks still held by the call's result and the peak bytes traced while it ran.
+"""
+import gc
+import platform
+import time
+import tracemalloc
+from typing import Callable, Dict, Optional
+
+import click
+import orjson
+import yaml
+from yaml import SafeLoader
+
+from benchmarks.generator import SYSTEM, Study
+from benchmarks.suite import CONFIG_PATH, _git_commit
+
+RENDERERS = ['_simple_coding_dict', '_simple_codeable_concept_dict', '_simple_identifier_dict', '_simple_extension_dict',
+             '_simple_observation_dict', '_render_sub_resources', '_populate_extensions']
+"""Benchmarked functions of iceberg_tools.data.simplifier."""
+
+
+def _resource(resource_type: str) -> dict:
+    """First generated resource of a type."""
+    return next(Study(1).resources(resource_type))
+
+
+def _cases(nested_objects: dict) -> Dict[str, Callable]:
+    """A no argument call of each renderer on its representative input, parsed now, to call inside a SimplifierContextManager."""
+    from fhir.resources.codeableconcept import CodeableConcept
+    from fhir.resources.coding import Coding
+    from fhir.resources.extension import Extension
+    from fhir.resources.identifier import Identifier
+
+    from iceberg_tools.data import simplifier
+    from iceberg_tools.util import parse_obj
+
+    coding = Coding.parse_obj({'system': 'http://loinc.org', 'code': '29463-7', 'display': 'Body weight'})
+    codeable_concept = CodeableConcept.parse_obj({
+        'text': 'Body weight',
+        'coding': [{'system': 'http://loinc.org', 'code': '29463-7', 'display': 'Body weight'},
+                   {'system': 'http://snomed.info/sct', 'code': '27113001'}],
+    })
+    identifier = Identifier.parse_obj({
+        'system': f"{SYSTEM}/patient-id", 'value': 'P-0001', 'use': 'official',
+        'type': {'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/v2-0203', 'code': 'MR'}], 'text': 'Medical record'},
+    })
+    extension = Extension.parse_obj({
+        'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex', 'valueCode': 'F',
+    })
+    complex_extension = Extension.parse_obj({
+        'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race',
+        'extension': [
+            {'url': 'ombCategory', 'valueCoding': {'system': 'urn:oid:2.16.840.1.113883.6.238', 'code': '2106-3', 'display': 'White'}},
+            {'url': 'text', 'valueString': 'White'},
+        ],
+    })
+    observation = parse_obj(_resource('Observation')).resource
+    document_reference = _resource('DocumentReference')
+    document_reference['content'][0]['attachment']['extension'] = [{'url': f"{SYSTEM}/md5", 'valueString': 'd41d8cd98f00b204e9800998ecf8427e'}]
+    document_reference = parse_obj(document_reference).resource
+
+    def _render_sub_resources():
+        simplifier.THREAD_LOCAL.references = []
+        simplifier.THREAD_LOCAL.nested_objects = nested_objects
+        return simplifier._render_sub_resources(document_reference)
+
+    def _simple_observation_dict():
+        simplifier.THREAD_LOCAL.references = []
+        simplifier.THREAD_LOCAL.nested_objects = nested_objects
+        return simplifier._simple_observation_dict(observation)
+
+    def _populate_extensions():
+        extensions = {}
+        for child_extension in complex_extension.extension:
+            simplifier._populate_extensions(child_extension.dict(), extensions, 'us_core_race')
+        simplifier._populate_extensions(extension.dict(), extensions)
+        return extensions
+
+    return {
+        '_simple_coding_dict': lambda: simplifier._simple_coding_dict(coding),
+        '_simple_codeable_concept_dict': lambda: simplifier._simple_codeable_concept_dict(codeable_concept),
+        '_simple_identifier_dict': lambda: simplifier._simple_identifier_dict(identifier),
+        '_simple_extension_dict': lambda: simplifier._simple_extension_dict(extension),
+        '_simple_observation_dict': _simple_observation_dict,
+        '_render_sub_resources': _render_sub_resources,
+        '_populate_extensions': _populate_extensions,
+    }
+
+
+def _ns_per_op(case: Callable, number: int, repeat: int) -> float:
+    """Best time per call of `repeat` runs, in nanoseconds."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        for _ in range(number):
+            case()
+        elapsed = time.perf_counter_ns() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / number
+
+
+def _allocations(case: Callable, number: int) -> dict:
+    """Blocks and bytes held by the results, peak bytes traced, all per call."""
+    results = [None] * number
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        for index in range(number):
+            results[index] = case()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    diff = after.compare_to(before, 'filename')
+    return {
+        'blocks_per_op': sum(_.count_diff for _ in diff) / number,
+        'bytes_per_op': sum(_.size_diff for _ in diff) / number,
+        'peak_bytes_per_op': (peak - start) / number,
+    }
+
+
+def run(number: int = 10_000, repeat: int = 5, config_path: str = CONFIG_PATH, renderers: list = RENDERERS) -> dict:
+    """Time each renderer, return the results."""
+    from iceberg_tools.data.simplifier import SimplifierContextManager
+
+    with open(config_path) as fp:
+        nested_objects = yaml.load(fp, SafeLoader)['nested_objects']
+
+    results = {}
+    cases = _cases(nested_objects)
+    with SimplifierContextManager():
+        for name in renderers:
+            case = cases[name]
+            case()  # warm up render plans and getters
+            gc.disable()
+            try:
+                ns_per_op = _ns_per_op(case, number, repeat)
+            finally:
+                gc.enable()
+            results[name] = {'ns_per_op': ns_per_op} | _allocations(case, min(number, 1000))
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'number': number,
+        'repeat': repeat,
+        'renderers': results,
+    }
+
+
+def compare(results: dict, baseline: dict) -> Dict[str, Optional[float]]:
+    """ns/op ratio of results over baseline per renderer, > 1 is slower."""
+    ratios = {}
+    for name, result in results['renderers'].items():
+        previous = baseline['renderers'].get(name)
+        ratios[name] = result['ns_per_op'] / previous['ns_per_op'] if previous and previous['ns_per_op'] else None
+    return ratios
+
+
+@click.command()
+@click.option('--number', default=10_000, show_default=True, type=int, help='Calls per timing run.')
+@click.option('--repeat', default=5, show_default=True, type=int, help='Timing runs, the best is reported.')
+@click.option('--output', 'output_path', default='bench-renderers.json', show_default=True,
+              help='Write results to this json file.')
+@click.option('--compare', 'compare_path', default=None,
+              help='Results json of a previous run to compare with.')
+@click.option('--renderer', 'renderers', multiple=True, type=click.Choice(RENDERERS),
+              help='Only benchmark these renderers, may be repeated.')
+@click.option('--config_path', default=CONFIG_PATH, show_default=True, help='Path to config file.')
+def cli(number, repeat, output_path, compare_path, renderers, config_path):
+    """Benchmark the simplifier's renderers."""
+    results = run(number, repeat, config_path, list(renderers) or RENDERERS)
+    with open(output_path, 'wb') as fp:
+        fp.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    click.echo(f"Wrote {output_path}")
+
+    ratios = {}
+    if compare_path:
+        with open(compare_path, 'rb') as fp:
+            ratios = compare(results, orjson.loads(fp.read()))
+    click.echo(f"{'renderer':32} {'ns/op':>10} {'blocks/op':>10} {'bytes/op':>10} {'peak/op':>10}")
+    for name, result in results['renderers'].items():
+        line = (f"{name:32} {result['ns_per_op']:10.0f} {result['blocks_per_op']:10.1f} {result['bytes_per_op']:10.0f}"
+                f" {result['peak_bytes_per_op']:10.0f}")
+        if ratios.get(name) is not None:
+            line += f" {ratios[name]:6.2f}x baseline"
+        click.echo(line)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,135 @@
+"""CLI startup time per command, wall time and python import time, saved as json for comparison between commits.
+
+    python -m benchmarks.startup --output startup-new.json --compare startup-old.json
+
+Each command is run `repeat` times in a fresh interpreter with `-X importtime`, as a workflow engine would run it.
+Commands work on small fixtures, so the times are dominated by startup.
+"""
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import click
+import orjson
+
+from benchmarks.suite import _git_commit
+
+LAUNCHER = "import sys; sys.argv[0] = 'iceberg'; from iceberg_tools.cli import cli; cli()"
+"""Runs the console script entry point, without depending on it being installed."""
+
+COMMANDS = {
+    'help': ['--help'],
+    'data help': ['data', '--help'],
+    'data validate': ['data', 'validate', 'tests/fixtures/simplify/kf', '--pattern', 'Organization.ndjson'],
+    'data validate-simplified': ['data', 'validate-simplified', '{empty}'],
+    'data simplify help': ['data', 'simplify', '--help'],
+    'data migrate help': ['data', 'migrate', '--help'],
+    'data pfb help': ['data', 'pfb', '--help'],
+    'data report help': ['data', 'report', '--help'],
+    'schema help': ['schema', '--help'],
+    'schema compile help': ['schema', 'compile', 'simplified', '--help'],
+}
+"""Arguments by benchmark name, `{empty}` is an empty directory."""
+
+TOP_IMPORTS = 10
+"""Slowest top level imports reported per command."""
+
+
+def _import_times(stderr: str) -> Tuple[Dict[str, int], int]:
+    """Cumulative microseconds of each top level import and the number of modules imported, from -X importtime output."""
+    imports = {}
+    modules = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        modules += 1
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):  # nested imports are indented by two spaces per level, after the separator's space
+            imports[name.strip()] = int(cumulative)
+    return imports, modules
+
+
+def _run(args: List[str], repeat: int) -> dict:
+    """Run a command `repeat` times, return wall and import times."""
+    walls = []
+    imports, modules = {}, 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', LAUNCHER] + args,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                                   env=os.environ | {'PYTHONDONTWRITEBYTECODE': '1'})
+        walls.append(time.perf_counter() - started)
+        assert completed.returncode == 0, (args, completed.stderr[-2000:])
+        imports, modules = _import_times(completed.stderr)
+    slowest = sorted(imports.items(), key=lambda _: _[1], reverse=True)[:TOP_IMPORTS]
+    return {
+        'args': args,
+        'wall_seconds_median': statistics.median(walls),
+        'wall_seconds_min': min(walls),
+        'import_seconds': sum(imports.values()) / 1_000_000,
+        'modules': modules,
+        'slowest_imports': {name: microseconds / 1_000_000 for name, microseconds in slowest},
+    }
+
+
+def run(repeat: int = 5, commands: List[str] = None) -> dict:
+    """Time each command, return the results."""
+    results = {}
+    with tempfile.TemporaryDirectory() as empty:
+        for name in commands or COMMANDS:
+            args = [_.format(empty=empty) for _ in COMMANDS[name]]
+            results[name] = _run(args, repeat)
+    return {
+        'commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'repeat': repeat,
+        'commands': results,
+    }
+
+
+def compare(results: dict, baseline: dict) -> Dict[str, Optional[float]]:
+    """Median wall time ratio of results over baseline per command, > 1 is slower."""
+    ratios = {}
+    for name, result in results['commands'].items():
+        previous = baseline['commands'].get(name)
+        ratios[name] = result['wall_seconds_median'] / previous['wall_seconds_median'] if previous else None
+    return ratios
+
+
+@click.command()
+@click.option('--repeat', default=5, show_default=True, type=int, help='Runs per command, the median is reported.')
+@click.option('--output', 'output_path', default='bench-startup.json', show_default=True,
+              help='Write results to this json file.')
+@click.option('--compare', 'compare_path', default=None,
+              help='Results json of a previous run to compare with.')
+@click.option('--command', 'commands', multiple=True, type=click.Choice(list(COMMANDS)),
+              help='Only benchmark these commands, may be repeated.')
+def cli(repeat, output_path, compare_path, commands):
+    """Benchmark the startup time of CLI commands."""
+    assert pathlib.Path('tests/fixtures').is_dir(), 'Run from the repository root'
+    results = run(repeat, list(commands))
+    with open(output_path, 'wb') as fp:
+        fp.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    click.echo(f"Wrote {output_path}")
+
+    ratios = {}
+    if compare_path:
+        with open(compare_path, 'rb') as fp:
+            ratios = compare(results, orjson.loads(fp.read()))
+    click.echo(f"{'command':28} {'wall':>8} {'imports':>8} {'modules':>8}  slowest import")
+    for name, result in results['commands'].items():
+        slowest = next(iter(result['slowest_imports']), '')
+        line = (f"{name:28} {result['wall_seconds_median']:7.3f}s {result['import_seconds']:7.3f}s {result['modules']:8}"
+                f"  {slowest}")
+        if ratios.get(name) is not None:
+            line += f" {ratios[name]:6.2f}x baseline"
+        click.echo(line)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,199 @@
+"""Time the data commands on a synthetic study, save the results as json for comparison between commits.
+
+    python -m benchmarks.suite --scale 100000 --output bench-$(git rev-parse --short HEAD).json
+    python -m benchmarks.suite --scale 100000 --compare bench-old.json
+
+Steps needing the `pfb` command (SimplePFBWriter, aggregate_edges) are skipped when it is not installed.
+"""
+import contextlib
+import io
+import logging
+import os
+import pathlib
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Optional
+
+import click
+import orjson
+import yaml
+from yaml import SafeLoader
+
+from benchmarks.generator import RESOURCE_TYPES, Study, write_bundles, write_ndjson
+
+SCHEMA_PATH = 'iceberg/schemas/simplified/simplified-fhir.json'
+"""Default simplified schema."""
+
+CONFIG_PATH = 'config.yaml'
+"""Default gen3 config."""
+
+BENCHMARKS = ['generate', 'validate', 'migrate_directory', 'simplify_directory', 'validate_simplified',
+              'SimplePFBWriter', 'aggregate_edges']
+"""Timed steps, in run order, each consumes the output of the previous ones."""
+
+logger = logging.getLogger(__name__)
+
+
+def _git_commit() -> Optional[str]:
+    """Commit of the working tree, None outside a git checkout."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _peak_rss() -> int:
+    """Peak resident set size in bytes of this process and its finished children."""
+    self_ = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(self_, children) * scale
+
+
+def _time(step: Callable, resources: int) -> dict:
+    """Run a step, return wall and cpu seconds and throughput; the step's own output is discarded."""
+    times = os.times()
+    cpu = times.user + times.system + times.children_user + times.children_system
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ok = step()
+    wall = time.perf_counter() - started
+    times = os.times()
+    return {
+        'ok': ok is not False,
+        'wall_seconds': wall,
+        'cpu_seconds': times.user + times.system + times.children_user + times.children_system - cpu,
+        'resources': resources,
+        'resources_per_second': resources / wall if wall > 0 else None,
+        'peak_rss_bytes': _peak_rss(),
+    }
+
+
+def run(scale: int, work_path: pathlib.Path, workers: Optional[int] = None, schema_path: str = SCHEMA_PATH,
+        config_path: str = CONFIG_PATH, seed: int = 0, bundle_size: int = 1000) -> dict:
+    """Generate a study of `scale` resources in work_path and time each benchmark on it."""
+    # lazy imports, so the generator is usable without the data dependencies
+    from iceberg_tools.cli.data import validate, validate_simplified
+    from iceberg_tools.data.migrator import migrate_directory
+    from iceberg_tools.data.pfb import SimplePFBWriter
+    from iceberg_tools.data.report import aggregate_edges
+    from iceberg_tools.data.simplifier import simplify_directory
+
+    with open(config_path) as fp:
+        dependency_order = yaml.load(fp, SafeLoader)['dependency_order']
+
+    study = Study(scale, seed=seed)
+    resources = len(study)
+    ndjson_path = work_path / 'ndjson'
+    bundles_path = work_path / 'bundles'
+    migrated_path = work_path / 'migrated'
+    simplified_path = work_path / 'simplified'
+    pfb_path = work_path / 'pfb'
+    for path in [migrated_path, pfb_path]:
+        path.mkdir(parents=True, exist_ok=True)
+
+    def _generate():
+        write_ndjson(study, ndjson_path)
+        write_bundles(study, bundles_path, bundle_size)
+
+    def _pfb():
+        writer = SimplePFBWriter(schema_path, pfb_path / 'study.pfb', dependency_order)
+        for _ in writer.transform_directory(simplified_path):
+            pass
+
+    steps = {
+        'generate': _generate,
+        'validate': lambda: validate(ndjson_path, '*.ndjson', workers),
+        'migrate_directory': lambda: migrate_directory(bundles_path, migrated_path, False, '*.json', workers),
+        'simplify_directory': lambda: simplify_directory(ndjson_path, '*.ndjson', simplified_path, schema_path, 'PFB',
+                                                         config_path, workers=workers),
+        'validate_simplified': lambda: validate_simplified(simplified_path, schema_path),
+        'SimplePFBWriter': _pfb,
+        'aggregate_edges': lambda: aggregate_edges(pfb_path, pfb_path, '*.pfb'),
+    }
+    has_pfb = shutil.which('pfb') is not None
+
+    results = {}
+    for name in BENCHMARKS:
+        if name in ['SimplePFBWriter', 'aggregate_edges'] and not has_pfb:
+            logger.warning(f"Skipping {name}, the pfb command is not installed")
+            results[name] = None
+            continue
+        logger.info(f"Running {name}")
+        results[name] = _time(steps[name], resources)
+        logger.info(f"{name} {results[name]['wall_seconds']:.2f}s")
+        if not results[name]['ok']:
+            logger.warning(f"{name} reported invalid resources")
+
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scale': scale,
+        'resources': resources,
+        'resource_counts': {_: study.count(_) for _ in RESOURCE_TYPES},
+        'workers': workers,
+        'benchmarks': results,
+    }
+
+
+def compare(results: dict, baseline: dict) -> Dict[str, Optional[float]]:
+    """Wall time ratio of results over baseline per benchmark, > 1 is slower."""
+    ratios = {}
+    for name in BENCHMARKS:
+        current, previous = results['benchmarks'].get(name), baseline['benchmarks'].get(name)
+        if not current or not previous or not previous['wall_seconds']:
+            ratios[name] = None
+            continue
+        ratios[name] = current['wall_seconds'] / previous['wall_seconds']
+    return ratios
+
+
+@click.command()
+@click.option('--scale', default=10_000, show_default=True, type=int,
+              help='Number of resources to generate, 10k to 10M.')
+@click.option('--output', 'output_path', default='bench.json', show_default=True,
+              help='Write results to this json file.')
+@click.option('--compare', 'compare_path', default=None,
+              help='Results json of a previous run to compare with.')
+@click.option('--workers', default=None, type=int, show_default=True,
+              help='Number of worker processes, passed to each benchmark that takes them.')
+@click.option('--work_path', default=None,
+              help='Directory for generated and output data, a temporary directory if unset.')
+@click.option('--seed', default=0, show_default=True, type=int, help='Random seed of the generated study.')
+@click.option('--schema_path', default=SCHEMA_PATH, show_default=True, help='Path to simplified schema json.')
+@click.option('--config_path', default=CONFIG_PATH, show_default=True, help='Path to config file.')
+def cli(scale, output_path, compare_path, workers, work_path, seed, schema_path, config_path):
+    """Benchmark the data commands on a synthetic FHIR study."""
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(message)s')
+    # silence per file progress of the benchmarked code
+    logging.getLogger('iceberg_tools').setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run(scale, pathlib.Path(work_path or tmp), workers, schema_path, config_path, seed)
+    with open(output_path, 'wb') as fp:
+        fp.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    click.echo(f"Wrote {output_path}")
+
+    baseline = None
+    if compare_path:
+        with open(compare_path, 'rb') as fp:
+            baseline = orjson.loads(fp.read())
+    for name, ratio in compare(results, baseline).items() if baseline else [(_, None) for _ in BENCHMARKS]:
+        result = results['benchmarks'][name]
+        if result is None:
+            click.echo(f"{name:20} skipped")
+            continue
+        line = f"{name:20} {result['wall_seconds']:10.2f}s {result['resources_per_second']:12.0f} resources/s"
+        if ratio is not None:
+            line += f" {ratio:6.2f}x baseline"
+        click.echo(line)
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,16 +1,26 @@
+import importlib.abc
+import importlib.util
 import logging
+import sys
 from typing import Union
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_URL_VALIDATE_PATCHED = False
+"""Url.validate is patched once, see monkey_patch_url_validate."""
+
 
 def monkey_patch_url_validate():
     # monkey patch to allow file: urls
-    import fhir.resources.fhirtypes
+    global _URL_VALIDATE_PATCHED
+    if _URL_VALIDATE_PATCHED:
+        return
+    _URL_VALIDATE_PATCHED = True
+    from fhir.resources import fhirtypes
     from pydantic.v1 import FileUrl
 
-    original_url_validate = fhir.resources.fhirtypes.Url.validate
+    original_url_validate = fhirtypes.Url.validate
 
     @classmethod
     def better_url_validate(  # type: ignore
@@ -24,8 +34,33 @@ def monkey_patch_url_validate():
         value = original_url_validate(value, field, config)
         return value
 
-    fhir.resources.fhirtypes.Url.validate = better_url_validate
+    fhirtypes.Url.validate = better_url_validate
     logger.debug("monkey patched Url.validate")
 
 
-monkey_patch_url_validate()
+class _PatchOnImport(importlib.abc.MetaPathFinder):
+    """Apply monkey_patch_url_validate as soon as fhir.resources.fhirtypes is imported.
+
+    FHIR models bind Url.validate when their class is created, so the patch must precede them.
+    Patching on import of iceberg_tools would import fhir.resources, slowing the startup of commands that do not use it.
+    """
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != 'fhir.resources.fhirtypes':
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(fullname)
+        exec_module = spec.loader.exec_module
+
+        def _exec_module(module):
+            exec_module(module)
+            monkey_patch_url_validate()
+
+        spec.loader.exec_module = _exec_module
+        return spec
+
+
+if 'fhir.resources.fhirtypes' in sys.modules:
+    monkey_patch_url_validate()
+else:
+    sys.meta_path.insert(0, _PatchOnImport())
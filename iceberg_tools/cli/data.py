@@ -4,15 +4,15 @@ import threading
 
 import click
 import yaml
-from fhir.resources import FHIRAbstractModel  # noqa
 from yaml import SafeLoader
 
-from iceberg_tools.data.report import aggregate_edges
-from iceberg_tools.data.migrator import migrate_directory
-from iceberg_tools.data.pfb import SimplePFBWriter
-from iceberg_tools.data.simplifier import cli as simplifier
-from iceberg_tools.schema.simplified_validator import directory_reader as simplified_directory_reader
-from iceberg_tools.util import NaturalOrderGroup, directory_reader
+from iceberg_tools.cli.groups import LazyGroup
+from iceberg_tools.data.index import index_path, open_index
+from iceberg_tools.stats import enable_stats
+from iceberg_tools.trace import enable_trace
+
+# command implementations are imported by the commands that use them,
+# the cli is run once per file by workflow engines and most commands need few of the heavy modules
 
 LINKS = threading.local()
 CLASSES = threading.local()
@@ -21,30 +21,44 @@ IDENTIFIER_LIST_SIZE = 8
 logger = logging.getLogger(__name__)
 
 
-@click.group(name="data", cls=NaturalOrderGroup)
-def cli():
+@click.group(name="data", cls=LazyGroup, lazy_commands={'simplify': 'iceberg_tools.data.simplifier:cli'})
+@click.option('--stats-out', 'stats_out', default=None,
+              help='Write wall and cpu time, records/sec and bytes/sec per stage (read, decode, parse, migrate, simplify, '
+                   'schema_check, serialize, write) and resource type to this json file.')
+@click.option('--trace-out', 'trace_out', default=None,
+              help='Write spans per file, batch and worker to this trace-event json file, see chrome://tracing or ui.perfetto.dev.')
+@click.pass_context
+def cli(ctx, stats_out, trace_out):
     """Project data (ResearchStudy, ResearchSubjects, Patient, etc.)."""
-    pass
-
-
-cli.add_command(simplifier)
+    if stats_out:
+        stats = enable_stats()
+        ctx.call_on_close(lambda: stats.write(pathlib.Path(stats_out), ctx.invoked_subcommand))
+    if trace_out:
+        tracer = enable_trace()
+        ctx.call_on_close(lambda: tracer.write(pathlib.Path(trace_out)))
 
 
 @cli.command('validate')
 @click.argument('path')
 @click.option('--pattern', required=True, default="*.*", show_default=True,
               help='File name pattern')
-def _validate(path, pattern):
+@click.option('--workers', default=None, type=int, show_default=True,
+              help='Number of worker processes used to read and parse files.')
+def _validate(path, pattern, workers):
     """Check FHIR data for validity and conventions.
 
     PATH: Path to FHIR files.
     """
-    validate(path, pattern)
+    validate(path, pattern, workers)
 
 
-def validate(path, pattern):
+def validate(path, pattern, workers=None):
+    from iceberg_tools.util import directory_reader
+
     ok = True
-    for result in directory_reader(pathlib.Path(path), pattern):
+    records = 0
+    for result in directory_reader(pathlib.Path(path), pattern, workers=workers):
+        records += 1
         if result.exception:
             ok = False
             print('file:', result.path)
@@ -52,6 +66,9 @@ def validate(path, pattern):
             print('\tresource_id:', result.resource_id)
             msg = str(result.exception).replace('\n', '\n\t\t')
             print('\texception:', msg)
+    if records == 0:
+        print(f"No records found in {path} matching {pattern}")
+        return False
     if ok:
         print('OK, all resources pass')
         return ok
@@ -66,19 +83,25 @@ def validate(path, pattern):
               show_default=True,
               help='Path to simplified schema json, a file path or url'
               )
-def _validate_simplified(path, schema_path):
+@click.option('--pattern', default='*.ndjson*', show_default=True,
+              help='File name pattern, .gz and .zst files are decompressed.')
+def _validate_simplified(path, schema_path, pattern):
 
     """Check simplified data for validity and conventions.
 
     PATH: Path to simplified ndjson files.
     """
-    validate_simplified(path, schema_path)
+    validate_simplified(path, schema_path, pattern)
+
 
+def validate_simplified(path, schema_path, pattern='*.ndjson*'):
+    from iceberg_tools.schema.simplified_validator import directory_reader as simplified_directory_reader
 
-def validate_simplified(path, schema_path):
     ok = True
+    records = 0
 
-    for result in simplified_directory_reader(pathlib.Path(path), schema_path):
+    for result in simplified_directory_reader(pathlib.Path(path), schema_path, pattern):
+        records += 1
         if result.exception:
             ok = False
             print('file:', result.path)
@@ -86,6 +109,9 @@ def validate_simplified(path, schema_path):
             print('\tresource_id:', result.resource_id)
             msg = str(result.exception).replace('\n', '\n\t\t')
             print('\texception:', msg)
+    if records == 0:
+        print(f"No records found in {path} matching {pattern}")
+        return False
     if ok:
         print('OK, all resources pass')
         return ok
@@ -113,6 +139,8 @@ def pfb(path, output_path, schema_path, config_path):
     PATH: Directory path to simplified FHIR ndjson files.
     OUTPUT_PATH: File path where to write the PFB.
     """
+    from iceberg_tools.data.pfb import SimplePFBWriter
+
     path = pathlib.Path(path)
     output_path = pathlib.Path(output_path)
     config_path = pathlib.Path(config_path)
@@ -148,7 +176,9 @@ def pfb(path, output_path, schema_path, config_path):
               help="Validate after migration")
 @click.option('--pattern', required=True, default="**/*.*json", show_default=True,
               help='File name pattern')
-def migrate(path, output_path, validate, pattern):
+@click.option('--workers', default=None, type=int, show_default=True,
+              help='Number of worker processes used to migrate files.')
+def migrate(path, output_path, validate, pattern, workers):
     """Migrate from FHIR R4B to R5.0.
 
 
@@ -158,6 +188,7 @@ def migrate(path, output_path, validate, pattern):
     PATH: Path containing bundles (*.json) or resources (*.ndjson)
     OUTPUT_PATH: Path where migrated resources will be stored
     """
+    from iceberg_tools.data.migrator import migrate_directory
 
     path = pathlib.Path(path)
     output_path = pathlib.Path(output_path)
@@ -168,7 +199,47 @@ def migrate(path, output_path, validate, pattern):
 
     assert output_path.is_dir(), f"Path {output_path} is not a directory"
 
-    migrate_directory(path, output_path, validate, pattern)
+    migrate_directory(path, output_path, validate, pattern, workers)
+
+
+@cli.command('index')
+@click.argument('path')
+@click.option('--pattern', default='**/*.ndjson', help='Search pattern', show_default=True)
+@click.option('--rebuild/--no-rebuild', default=False, is_flag=True, show_default=True,
+              help='Rebuild indexes that are still fresh.')
+def index(path: str, pattern: str, rebuild: bool):
+    """Build sidecar (*.ndjson.idx) indexes of ndjson files.
+
+    \b
+    PATH: Directory path to search for ndjson files
+    """
+    assert pathlib.Path(path).is_dir(), f"Path {path} is not a directory"
+    for file_path in sorted(pathlib.Path(path).glob(pattern)):
+        if not file_path.is_file():
+            continue
+        if rebuild:
+            index_path(file_path).unlink(missing_ok=True)
+        with open_index(file_path, build=True) as ndjson_index:
+            print(f"{file_path}\t{len(ndjson_index)}\t{ndjson_index.resource_types()}")
+
+
+@cli.command('lookup')
+@click.argument('path')
+@click.option('--offset', default=None, type=int, help='Line offset, as reported by validate.')
+@click.option('--id', 'id_', default=None, help='ResourceType/id of the record.')
+def lookup(path: str, offset: int, id_: str):
+    """Print a single record of an ndjson file, using its sidecar index.
+
+    \b
+    PATH: ndjson file, indexed on first use
+    """
+    assert (offset is None) != (id_ is None), "Specify one of --offset or --id"
+    with open_index(pathlib.Path(path), build=True) as ndjson_index:
+        if id_ is not None:
+            assert '/' in id_, f"{id_} should be ResourceType/id"
+            offset = ndjson_index.find(*id_.split('/', 1))
+            assert offset is not None, f"{id_} not found in {path}"
+        print(ndjson_index.read(offset).decode().rstrip())
 
 
 @cli.command()
@@ -182,6 +253,8 @@ def report(path: str, output_path: str, pattern: str):
     PATH: Directory path to search for pfb files
     OUTPUT_PATH: Directory path to write the report TSVs
     """
+    from iceberg_tools.data.report import aggregate_edges
+
     assert pathlib.Path(path).is_dir(), f"Path {path} is not a directory"
     assert pathlib.Path(output_path).is_dir(), f"Path {output_path} is not a directory"
     aggregate_edges(path, output_path, pattern)
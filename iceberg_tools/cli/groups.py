@@ -0,0 +1,31 @@
+import importlib
+from typing import Dict
+
+import click
+
+
+class NaturalOrderGroup(click.Group):
+    """See https://github.com/pallets/click/issues/513."""
+    def list_commands(self, ctx):
+        return self.commands.keys()
+
+
+class LazyGroup(NaturalOrderGroup):
+    """Imports a subcommand's module only when the subcommand is run or listed.
+
+    see https://click.palletsprojects.com/en/8.1.x/complex/#lazily-loading-subcommands
+    """
+
+    def __init__(self, *args, lazy_commands: Dict[str, str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+        """'module:attribute' of each lazily loaded subcommand, by name"""
+
+    def list_commands(self, ctx):
+        return list(self.lazy_commands) + [_ for _ in self.commands if _ not in self.lazy_commands]
+
+    def get_command(self, ctx, name):
+        if name in self.lazy_commands and name not in self.commands:
+            module_name, attribute = self.lazy_commands[name].split(':')
+            self.add_command(getattr(importlib.import_module(module_name), attribute), name)
+        return super().get_command(ctx, name)
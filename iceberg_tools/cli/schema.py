@@ -6,11 +6,7 @@ import click
 import yaml
 from yaml import SafeLoader
 
-from iceberg_tools.graph import SchemaLinkWriter
-from iceberg_tools.schema import _find_fhir_classes, BASE_URI, extract_schemas
-from iceberg_tools.schema.graph import bundle_schemas
-from iceberg_tools.schema.simplified import _simplify_schemas
-from iceberg_tools.util import NaturalOrderGroup
+from iceberg_tools.cli.groups import NaturalOrderGroup
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +20,9 @@ def cli():
 @cli.group('generate')
 def generate():
     """Generate from FHIR resources."""
-    pass
+    # fetched definitions are cached, as they were when the cli imported every module
+    from iceberg_tools.schema.simplified import install_requests_cache
+    install_requests_cache()
 
 
 @generate.command('graph')
@@ -39,8 +37,15 @@ def generate():
               help='Path to config file.')
 @click.option('--stats/--no-stats', default=False, is_flag=True, show_default=True,
               help="Log statistics about the FHIR classes found.")
-def generate_bmeg(output_path, config_path, stats):
+@click.option('--workers', default=None, type=int, show_default=True,
+              help='Number of worker processes extracting schemas, used only when many are missing from the cache.')
+@click.option('--cache/--no-cache', default=True, is_flag=True, show_default=True,
+              help='Reuse schemas extracted by a previous run with the same fhir.resources and bindings.')
+def generate_bmeg(output_path, config_path, stats, workers, cache):
     """Create BMEG schemas."""
+    from iceberg_tools.graph import SchemaLinkWriter
+    from iceberg_tools.schema import _find_fhir_classes, BASE_URI, SCHEMA_CACHE_PATH, extract_schemas
+    from iceberg_tools.schema.graph import bundle_schemas
 
     output_path = pathlib.Path(output_path)
     output_path.mkdir(parents=True, exist_ok=True)
@@ -51,7 +56,7 @@ def generate_bmeg(output_path, config_path, stats):
         gen3_config = yaml.load(fp, SafeLoader)
 
     classes = _find_fhir_classes(gen3_config, log_stats=stats)
-    schemas = extract_schemas(classes, BASE_URI)
+    schemas = extract_schemas(classes, BASE_URI, workers, SCHEMA_CACHE_PATH if cache else None)
 
     output_path.mkdir(parents=True, exist_ok=True)
 
@@ -82,8 +87,14 @@ def generate_bmeg(output_path, config_path, stats):
               help='Path to gen3 static data dictionary files.')
 @click.option('--stats/--no-stats', default=False, is_flag=True, show_default=True,
               help="Log statistics about the FHIR classes found.")
-def generate_simplified(output_path, config_path, gen3_fixtures, stats):
+@click.option('--workers', default=None, type=int, show_default=True,
+              help='Number of worker processes extracting schemas, used only when many are missing from the cache.')
+@click.option('--cache/--no-cache', default=True, is_flag=True, show_default=True,
+              help='Reuse schemas extracted by a previous run with the same fhir.resources and bindings.')
+def generate_simplified(output_path, config_path, gen3_fixtures, stats, workers, cache):
     """Create simplified schemas."""
+    from iceberg_tools.schema import _find_fhir_classes, BASE_URI, SCHEMA_CACHE_PATH, extract_schemas
+    from iceberg_tools.schema.simplified import _simplify_schemas
 
     output_path = pathlib.Path(output_path)
     output_path.mkdir(parents=True, exist_ok=True)
@@ -96,7 +107,7 @@ def generate_simplified(output_path, config_path, gen3_fixtures, stats):
         gen3_config = yaml.load(fp, SafeLoader)
 
     classes = _find_fhir_classes(gen3_config, log_stats=stats)
-    schemas = extract_schemas(classes, BASE_URI)
+    schemas = extract_schemas(classes, BASE_URI, workers, SCHEMA_CACHE_PATH if cache else None)
     schemas = _simplify_schemas(gen3_config, gen3_fixtures, schemas, log_stats=stats)
 
     # also write out yaml files
@@ -126,6 +137,21 @@ def compile_gen3_schemas(output_path):
         json.dump(dump_schemas_from_dir(output_path), fp, indent=2, sort_keys=False)
 
 
+@cli.command('bindings')
+@click.option('--output_path', default=None,
+              help='Where to write the bindings database, by default ~/.iceberg/element_bindings.sqlite, '
+                   'read by schema generation unless ICEBERG_ELEMENT_BINDINGS is set.')
+@click.option('--definitions_path', default=None,
+              help='FHIR definitions zip, downloaded if not set.')
+@click.option('--force', default=False, is_flag=True, show_default=True,
+              help='Rebuild even if the database was built from the same definitions.')
+def bindings(output_path, definitions_path, force):
+    """Build the element bindings database used by schema generation."""
+    from iceberg_tools.schema.fhir_resources.binding_lookup import USER_PATH, create_fhir_definitions_lookup
+    create_fhir_definitions_lookup(output_path=output_path or str(USER_PATH), definitions_path=definitions_path,
+                                   force=force)
+
+
 @cli.group('compile')
 def compile_():
     """Create aggregated json file from individual yaml schemas"""
@@ -0,0 +1,191 @@
+import gzip
+import io
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+from typing import BinaryIO, List, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, the zstd command is used if installed
+    zstandard = None
+
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+"""File name suffix by compression."""
+COMPRESSIONS = list(EXTENSIONS)
+"""Supported compressions."""
+GZIP_LEVEL = 6
+"""gzip compression level, the gzip command default."""
+ZSTD_LEVEL = 3
+"""zstd compression level, the zstd command default."""
+BUFFER_SIZE = 1024 * 1024
+"""Buffer size of compressed streams."""
+
+
+def compression(name) -> Optional[str]:
+    """Compression of a file from its name, None if not compressed."""
+    suffix = os.path.splitext(str(name))[1]
+    for compression_, extension in EXTENSIONS.items():
+        if suffix == extension:
+            return compression_
+    return None
+
+
+def _threads() -> int:
+    """Threads available to a compressor."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _command(compression_: str, write: bool, threads: int) -> Optional[List[str]]:
+    """A multi-threaded (de)compression command, None if not installed."""
+    if compression_ == 'gzip':
+        executable = shutil.which('pigz')
+        if executable is None:
+            return None
+        if write:
+            return [executable, '-c', f"-{GZIP_LEVEL}", '-p', str(threads)]
+        return [executable, '-dc']
+    executable = shutil.which('zstd')
+    if executable is None:
+        return None
+    if write:
+        return [executable, '-q', '-c', f"-{ZSTD_LEVEL}", f"-T{threads}"]
+    return [executable, '-q', '-dc']
+
+
+class _Process:
+    """A (de)compression process reading or writing a file, so (de)compression runs beside the caller."""
+
+    def __init__(self, command: List[str], path: pathlib.Path, write: bool):
+        """Start the process."""
+        self.command = command
+        self.path = path
+        self.file = None
+        """compressed output file"""
+        if write:
+            self.file = open(path, 'wb')
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.file, bufsize=BUFFER_SIZE)
+        else:
+            self.process = subprocess.Popen(command + [str(path)], stdout=subprocess.PIPE, bufsize=BUFFER_SIZE)
+
+    def readinto(self, buffer) -> int:
+        """Read decompressed bytes."""
+        return self.process.stdout.readinto(buffer)
+
+    def write(self, data) -> int:
+        """Write bytes to compress."""
+        return self.process.stdin.write(data)
+
+    def close(self):
+        """Wait for the process, raise if it failed."""
+        if self.file is not None:
+            self.process.stdin.close()
+            returncode = self.process.wait()
+            self.file.close()
+        else:
+            finished = self.process.poll() is not None
+            self.process.stdout.close()
+            returncode = self.process.wait()
+            if not finished and returncode < 0:
+                # closed before the end of the stream, the process was stopped by SIGPIPE
+                returncode = 0
+        if returncode != 0:
+            raise IOError(f"{self.command[0]} exited with {returncode} on {self.path}")
+
+
+def _open_stream(path: pathlib.Path, compression_: str, write: bool, threads: int):
+    """A raw (de)compression stream, a process if a multi-threaded command is installed."""
+    command = _command(compression_, write, threads)
+    if command is not None:
+        return _Process(command, path, write)
+    if compression_ == 'gzip':
+        return gzip.open(path, 'wb' if write else 'rb', compresslevel=GZIP_LEVEL)
+    assert zstandard is not None, f"{path} requires the zstd command or the zstandard package"
+    if write:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=threads)
+        return compressor.stream_writer(open(path, 'wb'), closefd=True, write_return_read=True)
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+
+
+class _CompressedIO(io.RawIOBase):
+    """Raw binary file over a (de)compression stream, tell() counts uncompressed bytes, seek(0) restarts reading."""
+
+    def __init__(self, path: pathlib.Path, compression_: str, write: bool, threads: int):
+        """Open the stream."""
+        super().__init__()
+        self.name = str(path)
+        self.path = path
+        self.compression = compression_
+        self.write_ = write
+        self.threads = threads
+        self.position = 0
+        """uncompressed bytes read or written"""
+        self.stream = _open_stream(path, compression_, write, threads)
+
+    def readable(self) -> bool:
+        """True if opened for reading."""
+        return not self.write_
+
+    def writable(self) -> bool:
+        """True if opened for writing."""
+        return self.write_
+
+    def seekable(self) -> bool:
+        """Readers can rewind."""
+        return not self.write_
+
+    def readinto(self, buffer) -> int:
+        """Read decompressed bytes."""
+        count = self.stream.readinto(buffer)
+        self.position += count
+        return count
+
+    def write(self, data) -> int:
+        """Compress bytes."""
+        count = self.stream.write(data)
+        self.position += count
+        return count
+
+    def tell(self) -> int:
+        """Uncompressed bytes read or written."""
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """Rewind a reader, decompressing again from the start, other seeks are not supported."""
+        if whence == io.SEEK_CUR and offset == 0:
+            return self.position
+        assert not self.write_ and whence == io.SEEK_SET and offset == 0, f"{self.name} can only be rewound"
+        self.stream.close()
+        self.stream = _open_stream(self.path, self.compression, self.write_, self.threads)
+        self.position = 0
+        return 0
+
+    def close(self):
+        """Close the stream, flushing compressed output."""
+        if not self.closed:
+            try:
+                self.stream.close()
+            finally:
+                super().close()
+
+
+def open_compressed(path: pathlib.Path, mode: str = 'rb', buffer_size: int = BUFFER_SIZE, threads: int = None) -> BinaryIO:
+    """Open a gzip or zstd file as a buffered binary stream, compression is based on the file name.
+
+    pigz and zstd commands are used when installed, (de)compressing on other cores,
+    otherwise gzip or the optional zstandard package.
+    """
+    path = pathlib.Path(path)
+    compression_ = compression(path.name)
+    assert compression_ is not None, f"{path} is not compressed, expected one of {list(EXTENSIONS.values())}"
+    assert mode in ['rb', 'wb'], f"mode should be rb or wb, not {mode}"
+    raw = _CompressedIO(path, compression_, mode == 'wb', threads or _threads())
+    if mode == 'wb':
+        return io.BufferedWriter(raw, buffer_size)
+    return io.BufferedReader(raw, buffer_size)
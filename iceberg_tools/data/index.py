@@ -0,0 +1,205 @@
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import sys
+from array import array
+from typing import List, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.idx'
+"""Sidecar file name suffix, `Observation.ndjson` is indexed by `Observation.ndjson.idx`."""
+MAGIC = b'ICEIDX01'
+HEADER = struct.Struct('<8sQQQQ')
+"""magic, line count, source size, source mtime_ns, key blob size"""
+OFFSET = struct.Struct('<Q')
+"""byte offset of a line"""
+KEY = struct.Struct('<QQQ')
+"""key start in blob, key length, line number"""
+
+
+def index_path(source: pathlib.Path) -> pathlib.Path:
+    """Sidecar index path of an ndjson file."""
+    source = pathlib.Path(source)
+    return source.with_name(source.name + INDEX_SUFFIX)
+
+
+def _record_key(obj: dict) -> bytes:
+    """`ResourceType/id` of a FHIR resource or of the object of a simplified (PFB) record."""
+    if 'resourceType' not in obj and isinstance(obj.get('object', None), dict):
+        obj = obj['object']
+    return f"{obj.get('resourceType', '')}/{obj.get('id', '')}".encode()
+
+
+def build_index(source: pathlib.Path) -> 'NDJSONIndex':
+    """Scan an ndjson file once, write its sidecar index."""
+    source = pathlib.Path(source)
+    stat = source.stat()
+    offsets = array('Q')
+    keys = []
+    position = 0
+    with open(source, 'rb') as fp:
+        for line_number, line in enumerate(fp):
+            offsets.append(position)
+            position += len(line)
+            key = b''
+            if line.strip():
+                key = _record_key(orjson.loads(line))
+            keys.append((key, line_number))
+    offsets.append(position)
+    keys.sort()
+
+    blob = bytearray()
+    key_table = bytearray()
+    for key, line_number in keys:
+        key_table += KEY.pack(len(blob), len(key), line_number)
+        blob += key
+
+    path = index_path(source)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, len(keys), stat.st_size, stat.st_mtime_ns, len(blob)))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        fp.write(offsets.tobytes())
+        fp.write(key_table)
+        fp.write(blob)
+    os.replace(tmp_path, path)
+    logger.info(f"Indexed {source} lines:{len(keys)}")
+    return NDJSONIndex(source)
+
+
+def open_index(source: pathlib.Path, build: bool = False) -> Optional['NDJSONIndex']:
+    """Open the sidecar index of an ndjson file, None if missing or stale, unless build is set."""
+    source = pathlib.Path(source)
+    path = index_path(source)
+    if path.is_file():
+        index = NDJSONIndex(source)
+        if index.is_fresh():
+            return index
+        index.close()
+    if build:
+        return build_index(source)
+    return None
+
+
+class NDJSONIndex:
+    """Memory mapped sidecar index of an ndjson file: line byte offsets and `ResourceType/id` keys."""
+
+    def __init__(self, source: pathlib.Path):
+        """Map the sidecar index of source."""
+        self.source = pathlib.Path(source)
+        """indexed ndjson file"""
+        self.path = index_path(self.source)
+        """sidecar index file"""
+        with open(self.path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.line_count, self.source_size, self.source_mtime_ns, blob_size = HEADER.unpack_from(self._mmap, 0)
+        assert magic == MAGIC, f"{self.path} is not an ndjson index"
+        self._offsets_start = HEADER.size
+        self._keys_start = self._offsets_start + (self.line_count + 1) * OFFSET.size
+        self._blob_start = self._keys_start + self.line_count * KEY.size
+
+    def __enter__(self):
+        """Use as a context manager."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """Release the mapping."""
+        self.close()
+
+    def close(self):
+        """Release the mapping."""
+        self._mmap.close()
+
+    def __len__(self) -> int:
+        """Number of lines in the source."""
+        return self.line_count
+
+    def is_fresh(self) -> bool:
+        """True if the source has not changed since it was indexed."""
+        stat = self.source.stat()
+        return stat.st_size == self.source_size and stat.st_mtime_ns == self.source_mtime_ns
+
+    def line_offset(self, line_number: int) -> int:
+        """Byte offset of a line, line_count gives the end of the file."""
+        assert 0 <= line_number <= self.line_count, f"line {line_number} not in {self.source}"
+        return OFFSET.unpack_from(self._mmap, self._offsets_start + line_number * OFFSET.size)[0]
+
+    def _key(self, position: int) -> Tuple[bytes, int]:
+        """The key and line number at position in the sorted key table."""
+        key_start, key_length, line_number = KEY.unpack_from(self._mmap, self._keys_start + position * KEY.size)
+        start = self._blob_start + key_start
+        return self._mmap[start:start + key_length], line_number
+
+    def _bisect(self, key: bytes) -> int:
+        """Position of the first key >= key."""
+        low, high = 0, self.line_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, resource_type: str, id_: str) -> Optional[int]:
+        """Line number of a resource, None if not found."""
+        key = f"{resource_type}/{id_}".encode()
+        position = self._bisect(key)
+        if position < self.line_count:
+            found, line_number = self._key(position)
+            if found == key:
+                return line_number
+        return None
+
+    def count(self, resource_type: str = None) -> int:
+        """Number of records, optionally of a resource type."""
+        if resource_type is None:
+            return self.line_count
+        prefix = f"{resource_type}/".encode()
+        return self._bisect(prefix + b'\xff') - self._bisect(prefix)
+
+    def resource_types(self) -> dict:
+        """Record counts by resource type."""
+        counts = {}
+        position = 0
+        while position < self.line_count:
+            key, _ = self._key(position)
+            if b'/' not in key:
+                position += 1
+                continue
+            resource_type = key.split(b'/')[0].decode()
+            counts[resource_type] = self.count(resource_type)
+            position = self._bisect(f"{resource_type}/".encode() + b'\xff')
+        return counts
+
+    def read(self, line_number: int) -> bytes:
+        """Raw bytes of a line, without re-scanning the source."""
+        start = self.line_offset(line_number)
+        end = self.line_offset(line_number + 1)
+        with open(self.source, 'rb') as fp:
+            fp.seek(start)
+            return fp.read(end - start)
+
+    def split_points(self, chunk_size: int) -> List[Tuple[int, int, int]]:
+        """Newline aligned byte ranges of roughly chunk_size bytes, as (start, end, first line number)."""
+        ranges = []
+        line_number = 0
+        while line_number < self.line_count:
+            start = self.line_offset(line_number)
+            # first line that starts at or after start + chunk_size
+            low, high = line_number + 1, self.line_count
+            while low < high:
+                middle = (low + high) // 2
+                if self.line_offset(middle) < start + chunk_size:
+                    low = middle + 1
+                else:
+                    high = middle
+            ranges.append((start, self.line_offset(low), line_number))
+            line_number = low
+        return ranges
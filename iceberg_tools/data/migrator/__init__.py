@@ -1,9 +1,12 @@
-import gzip
-import io
+import functools
 import logging
+import multiprocessing
 
 import orjson
 
+from iceberg_tools.data.compression import EXTENSIONS, open_compressed
+from iceberg_tools.stats import collector, init_stats_worker, merge_stats, stage_timer, stats_snapshot
+from iceberg_tools.trace import init_trace_worker, merge_trace, span, trace_snapshot, tracer
 from iceberg_tools.util import parse_obj
 
 logger = logging.getLogger(__name__)
@@ -260,50 +263,110 @@ def _is_resource(resource):
     return 'resourceType' in resource
 
 
-def migrate_bundles(output_path, path, validate, pattern='**/*.json'):
+def _init_migrate_worker(stats: bool, trace: bool):
+    """Process pool initializer, collect stats and spans in the worker if the parent does."""
+    init_stats_worker(stats)
+    init_trace_worker(trace)
+
+
+def _migrate_file(input_file, migrate_file, output_path, validate):
+    """Apply migrate_file to a file within a trace span, return the stats and spans recorded by this process."""
+    with span(migrate_file.__name__, 'migrate', path=input_file):
+        migrate_file(input_file, output_path=output_path, validate=validate)
+    return stats_snapshot(), trace_snapshot()
+
+
+def _migrate_files(migrate_file, files, output_path, validate, workers=None):
+    """Apply migrate_file to each file, optionally across a process pool."""
+    if workers is None or workers <= 1:
+        for input_file in files:
+            with span(migrate_file.__name__, 'migrate', path=input_file):
+                migrate_file(input_file, output_path=output_path, validate=validate)
+        return
+    migrate_file = functools.partial(_migrate_file, migrate_file=migrate_file, output_path=output_path, validate=validate)
+    with multiprocessing.Pool(processes=workers, initializer=_init_migrate_worker,
+                              initargs=(collector() is not None, tracer() is not None)) as pool:
+        for counters, spans in pool.imap_unordered(migrate_file, files, chunksize=1):
+            merge_stats(counters)
+            merge_trace(spans)
+
+
+def _migrate_bundle(input_file, output_path, validate):
+    """Migrate a single bundle file."""
+    timer = stage_timer()
+    with open(input_file, "rb") as fp:
+        data = fp.read()
+        timer.lap('read', len(data))
+        resource = orjson.loads(data)
+        timer.lap('decode', len(data))
+        timer.record(resource.get('resourceType', None) if isinstance(resource, dict) else None)
+        if not _is_resource(resource):
+            logger.warning(f"Not a FHIR resource {input_file}")
+            return
+        if not _is_bundle(resource):
+            logger.warning(f"Not a bundle {input_file}")
+            return
+        bundle_ = resource
+        if 'entry' not in bundle_:
+            logger.warning(f"No 'entry' in bundle {input_file} ")
+            return
+    for entry in bundle_['entry']:
+        resource = entry['resource']
+        timer.restart()
+        _ = migrate_resource(resource)
+        timer.lap('migrate')
+        timer.record(_['resourceType'])
+        logging_validator(_, input_file, validate)
+
+    output_file = output_path / input_file.name
+
+    timer.restart()
+    data = orjson.dumps(bundle_)
+    timer.lap('serialize', len(data))
+    with open(output_file, "wb") as fp:
+        fp.write(data)
+    timer.lap('write', len(data))
+    timer.record('Bundle')
+    logger.info(f"Migrated bundle {input_file} to {output_file} entry_count:{len(bundle_['entry'])}")
+
+
+def migrate_bundles(output_path, path, validate, pattern='**/*.json', workers=None):
     """Migrate bundles."""
-    for input_file in path.glob(pattern):   # TODO: see util directory_reader
-        with open(input_file, "rb") as fp:
-            resource = orjson.loads(fp.read())
-            if not _is_resource(resource):
-                logger.warning(f"Not a FHIR resource {input_file}")
-                continue
-            if not _is_bundle(resource):
-                logger.warning(f"Not a bundle {input_file}")
-                continue
-            bundle_ = resource
-            if 'entry' not in bundle_:
-                logger.warning(f"No 'entry' in bundle {input_file} ")
-                continue
-        for entry in bundle_['entry']:
-            resource = entry['resource']
-            _ = migrate_resource(resource)
-            logging_validator(_, input_file, validate)
-
-        output_file = output_path / input_file.name
-
-        with open(output_file, "wb") as fp:
-            fp.write(orjson.dumps(bundle_))
-        logger.info(f"Migrated bundle {input_file} to {output_file} entry_count:{len(bundle_['entry'])}")
-
-
-def migrate_resources(output_path, path, validate, pattern='**/*.json'):
+    _migrate_files(_migrate_bundle, list(path.glob(pattern)), output_path, validate, workers)  # TODO: see util directory_reader
+
+
+def _migrate_resource_file(input_file, output_path, validate):
+    """Migrate a single resource file."""
+    timer = stage_timer()
+    with open(input_file, "rb") as fp:
+        data = fp.read()
+        timer.lap('read', len(data))
+        resource = orjson.loads(data)
+        timer.lap('decode', len(data))
+        if not _is_resource(resource):
+            logger.warning(f"Not a FHIR resource {input_file}")
+            return
+        if _is_bundle(resource):
+            return
+        _ = migrate_resource(resource)
+        timer.lap('migrate')
+        timer.record(_['resourceType'])
+        logging_validator(_, input_file, validate)
+
+    output_file = output_path / input_file.name
+    timer.restart()
+    data = orjson.dumps(_)
+    timer.lap('serialize', len(data))
+    with open(output_file, "wb") as fp:
+        fp.write(data)
+    timer.lap('write', len(data))
+    timer.record(_['resourceType'])
+    logger.info(f'Migrated resource {input_file} to {output_file}')
+
+
+def migrate_resources(output_path, path, validate, pattern='**/*.json', workers=None):
     """Migrate single resource per file."""
-    for input_file in path.glob(pattern):  # TODO: see util directory_reader
-        with open(input_file, "rb") as fp:
-            resource = orjson.loads(fp.read())
-            if not _is_resource(resource):
-                logger.warning(f"Not a FHIR resource {input_file}")
-                continue
-            if _is_bundle(resource):
-                continue
-            _ = migrate_resource(resource)
-            logging_validator(_, input_file, validate)
-
-        output_file = output_path / input_file.name
-        with open(output_file, "wb") as fp:
-            fp.write(orjson.dumps(_))
-        logger.info(f'Migrated resource {input_file} to {output_file}')
+    _migrate_files(_migrate_resource_file, list(path.glob(pattern)), output_path, validate, workers)  # TODO: see util directory_reader
 
 
 def logging_validator(_, input_file, validate):
@@ -315,57 +378,85 @@ def logging_validator(_, input_file, validate):
                 logger.warning(f"{input_file} has exception {parse_result.exception}")
 
 
-def migrate_ndjson(output_path, path, validate, pattern='**/*.json'):
+def _migrate_ndjson_file(input_file, output_path, validate):
+    """Migrate a single ndjson file."""
+    out_fp = None
+    timer = stage_timer()
+    try:
+        with open(input_file, "rb") as fp:
+            output_file = output_path / input_file.name
+            for line in fp:
+                timer.lap('read', len(line))
+                resource = orjson.loads(line)
+                timer.lap('decode', len(line))
+                _ = migrate_resource(resource)
+                timer.lap('migrate')
+                if out_fp is None:
+                    out_fp = open(output_file, "wb")
+                logging_validator(_, input_file, validate)
+                _migrate_write(out_fp, _, timer)
+        logger.info(f'Migrated {input_file} to {output_file}')
+    except orjson.JSONDecodeError as e:
+        if 'unexpected end of data' not in str(e):
+            logger.warning(f"{input_file} has exception {e}")
+    finally:
+        if out_fp is not None:
+            out_fp.close()
+
+
+def _migrate_write(out_fp, resource, timer):
+    """Write a migrated resource as an ndjson line, counting the record's stages."""
+    timer.restart()
+    data = orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE)
+    timer.lap('serialize', len(data))
+    out_fp.write(data)
+    timer.lap('write', len(data))
+    timer.record(resource['resourceType'])
+
+
+def migrate_ndjson(output_path, path, validate, pattern='**/*.json', workers=None):
     """Migrate ndjson files, not expecting bundles."""
-    for input_file in path.glob(pattern):  # TODO: see util directory_reader
-        out_fp = None
-        try:
-            with open(input_file, "r") as fp:
-                output_file = output_path / input_file.name
-                for line in fp.readlines():
-                    resource = orjson.loads(line)
+    _migrate_files(_migrate_ndjson_file, list(path.glob(pattern)), output_path, validate, workers)  # TODO: see util directory_reader
+
+
+def _migrate_compressed_file(input_file, output_path, validate):
+    """Migrate a single *json.gz or *json.zst file, written with the same compression."""
+    with open_compressed(input_file) as fp:
+        output_file = output_path / input_file.name
+        with open_compressed(output_file, 'wb') as out_fp:
+            timer = stage_timer()
+            for line in fp:
+                timer.lap('read', len(line))
+                resource = orjson.loads(line)
+                timer.lap('decode', len(line))
+                try:
                     _ = migrate_resource(resource)
-                    if out_fp is None:
-                        out_fp = open(output_file, "wb")
+                    timer.lap('migrate')
                     logging_validator(_, input_file, validate)
-                    out_fp.write(orjson.dumps(_, option=orjson.OPT_APPEND_NEWLINE))
-            logger.info(f'Migrated {input_file} to {output_file}')
-        except orjson.JSONDecodeError as e:
-            if 'unexpected end of data' not in str(e):
-                logger.warning(f"{input_file} has exception {e}")
-        finally:
-            if out_fp is not None:
-                out_fp.close()
-
-
-def migrate_json_gz(output_path, path, validate, pattern='**/*.json'):
-    """Migrate *json.gz files."""
-    if 'gz' not in pattern:
-        pattern += ".gz"
-    for input_file in path.glob(pattern):  # TODO: see util directory_reader
-
-        with io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(input_file))) as fp:
-            output_file = output_path / input_file.name
-            with gzip.open(output_file, 'wb') as out_fp:
-                for line in fp.readlines():
-                    resource = orjson.loads(line)
-                    try:
-                        _ = migrate_resource(resource)
-                        logging_validator(_, input_file, validate)
-
-                        out_fp.write(orjson.dumps(_, option=orjson.OPT_APPEND_NEWLINE))
-                    except Exception as e:
-                        print('\t', str(e))
-                        break
-        logger.info(f'Migrated {input_file} to {output_file}')
 
+                    _migrate_write(out_fp, _, timer)
+                except Exception as e:
+                    print('\t', str(e))
+                    break
+    logger.info(f'Migrated {input_file} to {output_file}')
+
+
+def migrate_compressed(output_path, path, validate, pattern='**/*.json', workers=None):
+    """Migrate *json.gz and *json.zst files."""
+    for extension in EXTENSIONS.values():
+        compressed_pattern = pattern if pattern.endswith(extension) else pattern + extension
+        _migrate_files(_migrate_compressed_file, list(path.glob(compressed_pattern)), output_path, validate, workers)  # TODO: see util directory_reader
 
-def migrate_directory(path, output_path, validate, pattern):
-    """Migrate all files in a directory."""
+
+def migrate_directory(path, output_path, validate, pattern, workers=None):
+    """Migrate all files in a directory.
+
+    Each phase runs to completion before the next, files within a phase are spread across `workers` processes.
+    """
     # single resources per file
-    migrate_bundles(output_path, path, validate, pattern)
-    migrate_resources(output_path, path, validate, pattern)
+    migrate_bundles(output_path, path, validate, pattern, workers)
+    migrate_resources(output_path, path, validate, pattern, workers)
 
     # multiple resources per file
-    migrate_ndjson(output_path, path, validate, pattern)
-    migrate_json_gz(output_path, path, validate, pattern)
+    migrate_ndjson(output_path, path, validate, pattern, workers)
+    migrate_compressed(output_path, path, validate, pattern, workers)
@@ -1,12 +1,18 @@
 import logging
 import pathlib
+import shutil
 import subprocess
+import tempfile
 from collections import defaultdict
 from typing import List, Iterator, Any
 
 from fastavro import reader
 from pydantic import BaseModel
 
+from iceberg_tools.data.compression import compression, open_compressed
+from iceberg_tools.trace import span
+from iceberg_tools.util import read_manifest
+
 logger = logging.getLogger(__name__)
 
 
@@ -14,7 +20,8 @@ def run_cmd(command_line) -> str:
     """Run a command line, return stdout."""
     try:
         logger.debug(command_line)
-        return subprocess.check_output(command_line, shell=True).decode("utf-8").rstrip()
+        with span(' '.join(command_line.split(' ')[:2]), 'subprocess', command=command_line):
+            return subprocess.check_output(command_line, shell=True).decode("utf-8").rstrip()
     except Exception as exc:
         logger.error(exc)
         raise exc
@@ -168,11 +175,20 @@ class SimplePFBWriter:
         return run_cmd(cmd)
 
     def write(self, ndjson_file: str) -> str:
-        """Add data to pfb file."""
+        """Add data to pfb file, a gzip or zstd file is decompressed to a temporary file first."""
 
         if not self.schema_written:
             self.write_schema()
 
+        if compression(ndjson_file) is not None:
+            # pfb reads plain ndjson only
+            ndjson_file = pathlib.Path(ndjson_file)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                decompressed = pathlib.Path(tmp_dir) / ndjson_file.stem
+                with open_compressed(ndjson_file) as fp, open(decompressed, 'wb') as out_fp:
+                    shutil.copyfileobj(fp, out_fp)
+                return self.write(str(decompressed))
+
         cmd = f"pfb add -i {ndjson_file} {self.output_path}"
         logger.info(f"Adding {ndjson_file}")
         # TODO - We need to shell out to do this,  _from_dict is not public
@@ -189,10 +205,9 @@ class SimplePFBWriter:
             input_path = pathlib.Path(input_path)
         assert input_path.exists() and input_path.is_dir(), f"{input_path} should be a directory"
         write_order = []
-        files = [_ for _ in input_path.glob('*.ndjson')]
+        # rotated output lists its files in manifest.json
+        files = read_manifest(input_path)
         for _ in self.dependency_order:
-            file = next(iter([n for n in files if f"{_}.ndjson" in str(n)]), None)
-            if file:
-                write_order.append(file)
+            write_order.extend(files.get(_, []))
         for file in write_order:
             yield self.write(file)
@@ -1,15 +1,16 @@
 import decimal
 import importlib
 import logging
+import multiprocessing
 import pathlib
 import threading
 import uuid
-from typing import Dict, List
+from dataclasses import dataclass
+from typing import Dict, Iterator, List
 
 import click
 import inflection
 import orjson
-import requests
 import yaml
 
 from fhir.resources import FHIRAbstractModel  # noqa
@@ -17,7 +18,6 @@ from fhir.resources.attachment import Attachment
 from fhir.resources.codeableconcept import CodeableConcept
 from fhir.resources.codeablereference import CodeableReference
 from fhir.resources.coding import Coding
-from fhir.resources.core.utils import is_primitive_type
 from fhir.resources.documentreference import DocumentReferenceContent, DocumentReference
 from fhir.resources.extension import Extension
 from fhir.resources.identifier import Identifier
@@ -27,8 +27,12 @@ from fhir.resources.reference import Reference
 from fhir.resources.task import Task
 from yaml import SafeLoader
 
-from iceberg_tools.util import EmitterContextManager, directory_reader
-from iceberg_tools.data.simplifier.oid_lookup import get_oid
+from iceberg_tools.data.compression import COMPRESSIONS
+from iceberg_tools.stats import clock, collector, init_stats_worker, merge_stats, stats_snapshot
+from iceberg_tools.trace import init_trace_worker, merge_trace, span, trace_snapshot, tracer
+from iceberg_tools.util import DEFAULT_CHUNK_SIZE, EmitterContextManager, ParseResult, directory_reader, find_input_files, \
+    merge_shards, plan_read_tasks, read_task
+from iceberg_tools.data.simplifier.render_plan import CODING_CLASSES, render_plan
 
 # Latest FHIR version by default
 FHIR_CLASSES = importlib.import_module('fhir.resources')
@@ -41,22 +45,29 @@ THREAD_LOCAL = threading.local()
 
 ICEBERG_NAMESPACE = uuid.uuid3(uuid.NAMESPACE_DNS, 'ICEBERG')
 
+ENGINES = ['model', 'dict']
+"""model: render monkey patched FHIR models, dict: render json dicts directly."""
+
 
 class Getter:
-    """A getter for a FHIR resource."""
+    """A getter for a FHIR resource, the path is split into attribute names once."""
 
     def __init__(self, path: str):
         """Initialize Getter."""
         self.path_str = 'this.' + path
+        self.extension_name = None
+        """if set, the value of the first extension whose url contains it"""
+        if 'extension' in self.path_str:
+            prefix, self.extension_name = self.path_str.split('.extension.')
+            path = prefix.replace('this.', '')
+        self.names = path.split('.')
+        """attribute names, traversed in order"""
 
-    def _traverse_path(self, resource: FHIRAbstractModel, path_to_search: str = None):
+    def _traverse_path(self, resource: FHIRAbstractModel):
         """Traverse the path, return the last element ,traverse 1st element in list."""
         target = resource
-        path_to_search = path_to_search or str(self.path_str)
-        path_to_search = path_to_search.replace('this.', '')
-        for path in path_to_search.split('.'):
-            _ = f"this.{path}"
-            _ = eval(_, {}, {'this': target})
+        for name in self.names:
+            _ = getattr(target, name)
             if _ is None:
                 break
             if isinstance(_, list):
@@ -67,22 +78,34 @@ class Getter:
 
     def get(self, resource: FHIRAbstractModel):
         """Get the value from the resource, including extensions."""
-        if 'extension' in self.path_str:
-            prefix, extension_name = self.path_str.split('.extension.')
-            val = self._traverse_path(resource, path_to_search=prefix)
+        if self.extension_name is not None:
+            val = self._traverse_path(resource)
             if val:
                 extension_list = getattr(val, 'extension', None)
                 for extension in extension_list or []:
-                    if extension_name in extension.url:
+                    if self.extension_name in extension.url:
                         return extension.dict()['__value__']
             return None
 
         return self._traverse_path(resource)
 
 
+_GETTERS = {}
+"""Compiled getters by (resource_type, path)."""
+
+
+def getter(resource_type: str, path: str) -> Getter:
+    """The cached Getter of a nested_objects path."""
+    key = (resource_type, path)
+    _ = _GETTERS.get(key, None)
+    if _ is None:
+        _ = _GETTERS[key] = Getter(path)
+    return _
+
+
 def _get_nested_object(resource: FHIRAbstractModel, path: str):
     """Pluck a value from a resource, using path."""
-    return Getter(path).get(resource)
+    return getter(resource.resource_type, path).get(resource)
 
 
 def _simple_coding_dict(self: Coding, *args, **kwargs):
@@ -149,9 +172,14 @@ def _simple_identifier_dict(self: Identifier, *args, **kwargs):
 
 def _ensure_identifier_value(self):
     """Lookup urn: style values. dependent on oid_lookup."""
-    value = self.value
+    return _simple_identifier_value(self.value)
+
+
+def _simple_identifier_value(value):
+    """Lookup urn: style values of an Identifier.value."""
     if value:
         if 'urn:oid' in value:
+            from iceberg_tools.data.simplifier.oid_lookup import get_oid  # a large table, imported on first use
             value_, content = get_oid(value.split('urn:oid:')[-1])
             if not value_:
                 _debug_once(('get_oid failed', value, content))
@@ -162,16 +190,22 @@ def _ensure_identifier_value(self):
 
 def _ensure_identifier_system(self):
     """Ensure identifier `system` simplified."""
+    return _simple_identifier_system(self.system)
+
+
+def _simple_identifier_system(system):
+    """Simplify an Identifier.system to a name."""
     name = None
-    if self.system:
-        if 'urn:oid' in self.system:
-            name, content = get_oid(self.system.split('urn:oid:')[-1])
+    if system:
+        if 'urn:oid' in system:
+            from iceberg_tools.data.simplifier.oid_lookup import get_oid  # a large table, imported on first use
+            name, content = get_oid(system.split('urn:oid:')[-1])
             if not name:
-                _debug_once(('get_oid failed', self.system, content))
-        elif 'urn:ietf:rfc:3986' in self.system:
+                _debug_once(('get_oid failed', system, content))
+        elif 'urn:ietf:rfc:3986' in system:
             name = 'uri'
         else:
-            name = self.system.split('/')[-1].replace('-', '_')
+            name = system.split('/')[-1].replace('-', '_')
     if not name:
         name = ''
     return name
@@ -185,34 +219,30 @@ def _simple_observation_dict(self: Observation, *args, **kwargs):
         observation['category'] = ['laboratory']
         observation['category_coding'] = ['http://terminology.hl7.org/CodeSystem/observation-category#laboratory']
 
-    alias_maps = self.get_alias_mapping()
-    for prop_name in self.elements_sequence():
-        field_key = alias_maps[prop_name]
-        is_value = field_key.startswith('value')
-        if is_value:
-            v = self.__dict__.get(field_key, None)
-            if v is not None:
-                is_fhir = issubclass(type(v), FHIRAbstractModel)
-                nested_object_name = field_key
-                if is_fhir:
-                    name_value_list = v.dict()
-                    if not isinstance(name_value_list, list):
-                        name_value_list = [name_value_list]
-                    for item in name_value_list:
-                        if '__value__' in item:
-                            assert '__value__' in item, (nested_object_name, name_value_list)
-                            value = item['__value__']
-                            name = item.get('__name__', None)
-                            if name:
-                                name = '_' + name
-                            else:
-                                name = ''
-                            if isinstance(value, list):
-                                value = value[0]
-                            observation[f"{nested_object_name}{name}"] = value
+    for field in render_plan(type(self)).values:
+        v = self.__dict__.get(field.name, None)
+        if v is not None:
+            is_fhir = issubclass(type(v), FHIRAbstractModel)
+            nested_object_name = field.name
+            if is_fhir:
+                name_value_list = v.dict()
+                if not isinstance(name_value_list, list):
+                    name_value_list = [name_value_list]
+                for item in name_value_list:
+                    if '__value__' in item:
+                        assert '__value__' in item, (nested_object_name, name_value_list)
+                        value = item['__value__']
+                        name = item.get('__name__', None)
+                        if name:
+                            name = '_' + name
                         else:
-                            for k, v in item.items():
-                                observation[f"{nested_object_name}_{k}"] = v
+                            name = ''
+                        if isinstance(value, list):
+                            value = value[0]
+                        observation[f"{nested_object_name}{name}"] = value
+                    else:
+                        for k, v in item.items():
+                            observation[f"{nested_object_name}_{k}"] = v
     return observation
 
 
@@ -231,24 +261,20 @@ def _simple_extension_dict(self: Extension, *args, **kwargs):
     """MonkeyPatch replacement for dict(), render Extension."""
     # note `self` is the Extension
     # stop traversal here
-    alias_maps = self.get_alias_mapping()
-    for prop_name in self.elements_sequence():
-        field_key = alias_maps[prop_name]
-        is_value = field_key.startswith('value')
-        if is_value:
-            v = self.__dict__.get(field_key, None)
-            if v is not None:
-                is_fhir = issubclass(type(v), FHIRAbstractModel)
-                _name = self.url
-                if _name:
-                    _name = _name.split('/')[-1]
-                _name = _name.replace('-', '_')
-                if is_fhir:
-                    v = v.dict()
-                _ = {'__value__': v}
-                if _name:
-                    _['__name__'] = _name
-                return _
+    for field in render_plan(type(self)).values:
+        v = self.__dict__.get(field.name, None)
+        if v is not None:
+            is_fhir = issubclass(type(v), FHIRAbstractModel)
+            _name = self.url
+            if _name:
+                _name = _name.split('/')[-1]
+            _name = _name.replace('-', '_')
+            if is_fhir:
+                v = v.dict()
+            _ = {'__value__': v}
+            if _name:
+                _['__name__'] = _name
+            return _
 
 
 def _simple_reference_dict(self: Reference, *args, **kwargs):
@@ -285,7 +311,7 @@ def _simple_task_dict(self: Task, *args, **kwargs):
     """MonkeyPatch replacement for dict(), render Observation."""
     task = _simple_resource_dict(self)
     # go through outputs to collect references
-    for _ in self.output:
+    for _ in self.output or []:
         _.dict()
     return task
 
@@ -373,14 +399,11 @@ def _simple_resource_dict(self: FHIRAbstractModel, *args, **kwargs):
 
 def _render_primitives(self: FHIRAbstractModel, *args, **kwargs) -> Dict:
     """Utility, create a dict of the primitive keys in a resource"""
-    alias_maps = self.get_alias_mapping()
     resource_primitives = {}
-    for prop_name in self.elements_sequence():
-        field_key = alias_maps[prop_name]
-        is_primitive = is_primitive_type(self.__fields__[field_key])
-        v = self.__dict__.get(field_key, None)
-        if v is not None and is_primitive:
-            resource_primitives[field_key] = v
+    for field in render_plan(type(self)).primitives:
+        v = self.__dict__.get(field.name, None)
+        if v is not None:
+            resource_primitives[field.name] = v
     if 'resourceType' not in resource_primitives:
         resource_primitives['resourceType'] = self.resource_type
     return resource_primitives
@@ -388,13 +411,11 @@ def _render_primitives(self: FHIRAbstractModel, *args, **kwargs) -> Dict:
 
 def _render_references(self: FHIRAbstractModel, *args, **kwargs) -> Dict:
     """Utility, create a dict of the references in a resource."""
-    alias_maps = self.get_alias_mapping()
     references = {}
-    for prop_name in self.elements_sequence():
-        field_key = alias_maps[prop_name]
-        v = self.__dict__.get(field_key, None)
+    for field in render_plan(type(self)).references:
+        v = self.__dict__.get(field.name, None)
         if v is not None and isinstance(v, Reference):
-            references[field_key] = v.dict()['__value__']
+            references[field.name] = v.dict()['__value__']
     return references
 
 
@@ -459,9 +480,8 @@ def _populate_extensions(ext_dict, extensions, parent_name=None):
 def _render_codings(self: FHIRAbstractModel, *args, **kwargs) -> Dict:
     """Utility, create a dict of the codings in a resource."""
     codings = {}
-    alias_maps = self.get_alias_mapping()
-    for prop_name in self.elements_sequence():
-        field_key = alias_maps[prop_name]
+    for field in render_plan(type(self)).codings:
+        field_key = field.name
         v = self.__dict__.get(field_key, None)
         is_scalar = not isinstance(v, list)
 
@@ -471,7 +491,7 @@ def _render_codings(self: FHIRAbstractModel, *args, **kwargs) -> Dict:
                 v_as_list = [v_as_list]
             if len(v_as_list) == 0:
                 continue
-            if type(v_as_list[0]) not in [CodeableConcept, Coding, CodeableReference]:
+            if type(v_as_list[0]) not in CODING_CLASSES:
                 continue
             for v in v_as_list:
                 codings_as_list = v.dict()
@@ -603,6 +623,9 @@ def _render_dialect(simplified: dict, references: List[str], dialect: str, schem
 
     gen3_links = []
     for _ in references:
+        if not _:
+            # e.g. a Reference with only a display
+            continue
         if len(_.split('/')) != 2:
             logger.warning(f"Unexpected reference format {_} in {simplified['resourceType']} {simplified['id']}")
             continue
@@ -633,6 +656,12 @@ def simplify(resource: FHIRAbstractModel, dialect: str, nested_objects: dict = {
     simplified = resource.dict()
     # cleanup goes here...
     simplified = _ensure_dialect(simplified, resource, dialect)
+    _transform_ids(simplified, transform_ids)
+    return simplified, THREAD_LOCAL.references
+
+
+def _transform_ids(simplified: dict, transform_ids=None):
+    """Replace the simplified id and collected references with seeded UUIDs."""
     if transform_ids:
         simplified['id'] = new_id(transform_ids, simplified['id'])
         transformed_references = []
@@ -641,7 +670,6 @@ def simplify(resource: FHIRAbstractModel, dialect: str, nested_objects: dict = {
             id_ = new_id(transform_ids, id_)
             transformed_references.append(f"{type_}/{id_}")
         THREAD_LOCAL.references = transformed_references
-    return simplified, THREAD_LOCAL.references
 
 
 def check_simplified_schemas(simplified: dict, schemas: dict):
@@ -717,8 +745,154 @@ class SimplifierContextManager:
         Task.dict = self.orig_task_dict
 
 
-def simplify_directory(input_path, pattern, output_path, schema_path, dialect, config_path, transform_ids=None):
-    """Reads directory of FHIR, renders simple, data frame friendly flattened records."""
+@dataclass
+class SimplifyOptions:
+    """Settings shared by every record of a simplify_directory run."""
+    schemas: dict
+    """simplified schemas"""
+    dialect: str
+    """PFB or FHIR"""
+    nested_objects: dict
+    """paths of nested objects to render, by resource type"""
+    limit_links: dict
+    """permitted link destinations, by resource type"""
+    transform_ids: str = None
+    """seed for id transformation"""
+    trusted: bool = False
+    """construct resources without validation"""
+    engine: str = 'model'
+    """one of ENGINES"""
+    background_writer: bool = False
+    """write output on a background thread"""
+    max_bytes: int = None
+    """rotate output files at this size"""
+    max_records: int = None
+    """rotate output files at this record count"""
+    compression: str = None
+    """compress output files, gzip or zstd"""
+    stats: bool = False
+    """collect stats, see iceberg_tools.stats"""
+    trace: bool = False
+    """record trace spans, see iceberg_tools.trace"""
+
+
+def _simplify_results(parse_results: Iterator[ParseResult], emitter: EmitterContextManager, options: SimplifyOptions):
+    """Simplify parse results, write them to the emitter."""
+    stats = collector()
+    for resource_type, line in _simplify_records(parse_results, options):
+        if stats is None:
+            emitter.emit(resource_type).write(line)
+            continue
+        started = clock()
+        emitter.emit(resource_type).write(line)
+        stats.add('write', resource_type, started, clock(), bytes_=len(line))
+
+
+def _simplify_records(parse_results: Iterator[ParseResult], options: SimplifyOptions) -> Iterator[tuple]:
+    """Simplify parse results, yield (resource_type, ndjson line) tuples."""
+    # imported here, dict_simplifier depends on this module
+    from iceberg_tools.data.simplifier.dict_simplifier import check_dict, simplify_dict
+
+    stats = collector()
+    for parse_result in parse_results:
+        if options.engine == 'dict' and not options.trusted and parse_result.exception is None:
+            # reject what the model engine would
+            parse_result.exception = check_dict(parse_result.object)
+        if parse_result.exception is not None:
+            if 'resourceType' not in str(parse_result.exception):
+                logger.error(f"{parse_result.path} has exception {parse_result.exception}")
+            # print other exceptions too
+            logger.error(f"{parse_result.path} has exception {parse_result.exception}")
+            continue
+
+        if stats is not None:
+            started = clock()
+        if options.engine == 'dict':
+            simplified, references = simplify_dict(parse_result.object, options.dialect, options.nested_objects, options.transform_ids)
+        else:
+            simplified, references = simplify(parse_result.resource, options.dialect, options.nested_objects, options.transform_ids)
+        if stats is not None:
+            simplified_ = clock()
+        try:
+            check_simplified_schemas(simplified, options.schemas)
+        except (TypeError, AssertionError) as e:
+            _debug_once(str(e))
+
+        assert simplified, ("Should have simplified", parse_result.path, parse_result.offset)
+        all_ok = all([validate_simplified_value(_) for _ in simplified.values()])
+        _assert_all_ok(all_ok, parse_result, simplified)
+
+        resource_type = simplified['resourceType']
+        if stats is not None:
+            checked = clock()
+        simplified = _render_dialect(simplified, references, options.dialect, options.schemas, options.limit_links)
+        if stats is not None:
+            rendered = clock()
+        line = orjson.dumps(simplified, default=_default_json_serializer, option=orjson.OPT_APPEND_NEWLINE)
+        if stats is not None:
+            stats.add('simplify', resource_type, started, simplified_)
+            stats.add('schema_check', resource_type, simplified_, checked)
+            stats.add('simplify', resource_type, checked, rendered, records=0)
+            stats.add('serialize', resource_type, rendered, clock(), bytes_=len(line))
+        yield resource_type, line
+
+
+_WORKER_OPTIONS: SimplifyOptions = None
+"""Options of a simplify worker process, see _init_simplify_worker."""
+
+
+def _init_simplify_worker(options: SimplifyOptions):
+    """Process pool initializer, options are sent once per worker rather than once per task."""
+    global _WORKER_OPTIONS
+    _WORKER_OPTIONS = options
+    init_stats_worker(options.stats)
+    init_trace_worker(options.trace)
+
+
+def _simplify_task(args: tuple) -> tuple:
+    """Process pool worker, simplify a file or byte range into its own shard files, return the shard, its stats and spans."""
+    task, shard, output_path = args
+    options = _WORKER_OPTIONS
+    parse_results = read_task(task, parse=(options.engine == 'model'), validate=False, trusted=options.trusted)
+    # each worker patches its own classes and writes its own files
+    with span('task', 'simplify', path=task.path, start=task.start, end=task.end, shard=shard):
+        with SimplifierContextManager():
+            with EmitterContextManager(output_path, shard=shard, binary=True, background=options.background_writer,
+                                       max_bytes=options.max_bytes, max_records=options.max_records,
+                                       compression=options.compression) as emitter:
+                _simplify_results(parse_results, emitter, options)
+    return shard, stats_snapshot(), trace_snapshot()
+
+
+def _simplify_parallel(input_path: pathlib.Path, pattern: str, output_path, options: SimplifyOptions, workers: int, merge: bool):
+    """Simplify across a process pool, each file (or byte range of a large ndjson file) is written to its own shards."""
+    input_files = find_input_files(input_path, pattern, str(output_path))
+    with multiprocessing.Pool(processes=workers, initializer=_init_simplify_worker, initargs=(options,)) as pool:
+        tasks = plan_read_tasks(input_files, DEFAULT_CHUNK_SIZE, pool)
+        # shards are numbered in read order, largest tasks are scheduled first
+        args = sorted([(task, shard, output_path) for shard, task in enumerate(tasks)], key=lambda _: _[0].size, reverse=True)
+        for _, counters, spans in pool.imap_unordered(_simplify_task, args, chunksize=1):
+            merge_stats(counters)
+            merge_trace(spans)
+    if merge:
+        with span('merge', 'write', path=output_path):
+            merge_shards(output_path)
+
+
+def simplify_directory(input_path, pattern, output_path, schema_path, dialect, config_path, transform_ids=None, workers=None,
+                       trusted=False, engine='model', merge=True, background_writer=False, max_bytes=None, max_records=None,
+                       compression=None, pipeline=False):
+    """Reads directory of FHIR, renders simple, data frame friendly flattened records.
+
+    If trusted, resources are constructed without pydantic validation.
+    The `dict` engine renders the json dicts directly, no FHIR models are constructed or validated.
+    With workers, each worker process writes `<ResourceType>-<shard>.ndjson` files, merged into `<ResourceType>.ndjson` if merge is set.
+    If background_writer, output is written by a separate thread, overlapping simplification and disk I/O.
+    With max_bytes or max_records, output is rotated into `<ResourceType>-<part>.ndjson` files listed in `manifest.json`.
+    With compression (gzip or zstd), output files are compressed, see data.compression.
+    With pipeline, reading, simplifying (across workers) and writing overlap, see simplifier.pipeline.
+    """
+    assert engine in ENGINES, f"engine should be one of {ENGINES}"
 
     input_path = pathlib.Path(input_path)
     assert input_path.is_dir(), f"{input_path} not a directory"
@@ -728,40 +902,35 @@ def simplify_directory(input_path, pattern, output_path, schema_path, dialect, c
         with open(schema_path, "rb") as fp_:
             schemas = orjson.loads(fp_.read())
     else:
+        import requests
         schemas = requests.get(schema_path).json()
     assert schemas, f"No schema found at {schema_path}"
 
     with open(config_path) as fp:
         gen3_config = yaml.load(fp, SafeLoader)
-    limit_links = gen3_config['limit_links']
-    nested_objects = gen3_config['nested_objects']
+    options = SimplifyOptions(schemas=schemas, dialect=dialect, nested_objects=gen3_config['nested_objects'],
+                              limit_links=gen3_config['limit_links'], transform_ids=transform_ids,
+                              trusted=trusted, engine=engine, background_writer=background_writer,
+                              max_bytes=max_bytes, max_records=max_records, compression=compression,
+                              stats=collector() is not None, trace=tracer() is not None)
+
+    if pipeline:
+        # imported here, the pipeline depends on this module
+        from iceberg_tools.data.simplifier.pipeline import simplify_pipeline
+        simplify_pipeline(input_path, pattern, output_path, options, workers)
+        return
+
+    if workers is not None and workers > 1:
+        pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
+        _simplify_parallel(input_path, pattern, output_path, options, workers, merge)
+        return
 
     with SimplifierContextManager():
-        with EmitterContextManager(output_path) as emitter:
-            for parse_result in directory_reader(directory_path=input_path, pattern=pattern,
-                                                 validate=False, ignore_path=output_path):
-                if parse_result.exception is not None:
-                    if 'resourceType' not in str(parse_result.exception):
-                        logger.error(f"{parse_result.path} has exception {parse_result.exception}")
-                    # print other exceptions too
-                    logger.error(f"{parse_result.path} has exception {parse_result.exception}")
-                    continue
-                resource = parse_result.resource
-
-                simplified, references = simplify(resource, dialect, nested_objects, transform_ids)
-                try:
-                    check_simplified_schemas(simplified, schemas)
-                except (TypeError, AssertionError) as e:
-                    _debug_once(str(e))
-
-                assert simplified, ("Should have simplified", resource.resource_type, resource.id)
-                all_ok = all([validate_simplified_value(_) for _ in simplified.values()])
-                _assert_all_ok(all_ok, parse_result, resource, simplified)
-
-                simplified = _render_dialect(simplified, references, dialect, schemas, limit_links)
-                fp = emitter.emit(resource.resource_type)
-                fp.write(orjson.dumps(simplified, default=_default_json_serializer,
-                                      option=orjson.OPT_APPEND_NEWLINE).decode())
+        with EmitterContextManager(output_path, binary=True, background=background_writer,
+                                   max_bytes=max_bytes, max_records=max_records, compression=compression) as emitter:
+            parse_results = directory_reader(directory_path=input_path, pattern=pattern, parse=(engine == 'model'),
+                                             validate=False, ignore_path=str(output_path), trusted=trusted)
+            _simplify_results(parse_results, emitter, options)
 
 
 def _debug_once(msg):
@@ -770,10 +939,10 @@ def _debug_once(msg):
         logger.info(msg)
 
 
-def _assert_all_ok(all_ok, parse_result, resource, simplified):
+def _assert_all_ok(all_ok, parse_result, simplified):
     """Utility, log simplified check problems."""
     if not all_ok:
-        reference = f"{resource.resource_type}/{resource.id}"
+        reference = f"{simplified['resourceType']}/{simplified.get('id', None)}"
         logger.warning(f"{parse_result.path} {reference} {parse_result.offset}")
         logger.warning(f"\t{simplified}")
         logger.warning({k: validate_simplified_value(v) for k, v in simplified.items()})
@@ -802,13 +971,33 @@ def _assert_all_ok(all_ok, parse_result, resource, simplified):
               default=None,
               show_default=True,
               help='Transform ids based on this seed')
-def cli(path, pattern, output_path, schema_path, dialect, config_path, transform_ids):
+@click.option('--workers', default=None, type=int, show_default=True,
+              help='Number of worker processes, each reads, simplifies and writes its own shard files.')
+@click.option('--merge/--no-merge', default=True, is_flag=True, show_default=True,
+              help='With workers, merge shard files into <ResourceType>.ndjson.')
+@click.option('--trusted', default=False, is_flag=True, show_default=True,
+              help='Input was already validated, construct resources without validation.')
+@click.option('--engine', default='model', type=click.Choice(ENGINES), show_default=True,
+              help='model: render FHIR models, dict: render json directly, faster, input is not validated.')
+@click.option('--background_writer', default=False, is_flag=True, show_default=True,
+              help='Write output files on a background thread.')
+@click.option('--max_bytes', default=None, type=int, show_default=True,
+              help='Rotate output to a new <ResourceType>-<part>.ndjson file at this size.')
+@click.option('--max_records', default=None, type=int, show_default=True,
+              help='Rotate output to a new <ResourceType>-<part>.ndjson file at this record count.')
+@click.option('--compression', default=None, type=click.Choice(COMPRESSIONS), show_default=True,
+              help='Compress output files, multi-threaded if pigz or zstd are installed.')
+@click.option('--pipeline', default=False, is_flag=True, show_default=True,
+              help='Overlap reading, simplifying (across --workers processes) and writing, log the utilization of each stage.')
+def cli(path, pattern, output_path, schema_path, dialect, config_path, transform_ids, workers, merge, trusted, engine,
+        background_writer, max_bytes, max_records, compression, pipeline):
     """Renders PFB friendly flattened records.
 
     PATH: Path containing bundles (*.json) or resources (*.ndjson)
     OUTPUT_PATH: Path where simplified resources will be stored
     """
-    simplify_directory(path, pattern, output_path, schema_path, dialect, config_path, transform_ids)
+    simplify_directory(path, pattern, output_path, schema_path, dialect, config_path, transform_ids, workers, trusted, engine, merge,
+                       background_writer, max_bytes, max_records, compression, pipeline)
 
 
 if __name__ == '__main__':
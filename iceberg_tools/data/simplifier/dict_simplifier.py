@@ -0,0 +1,449 @@
+"""Render simplified records directly from json dicts, without instantiating FHIR models.
+
+Each function mirrors a renderer of the model based simplifier (see `SimplifierContextManager`),
+FHIR class metadata provides the field order, json names and types, values are read from the raw dict.
+Input is not validated, `check_dict` rejects the resources parse_obj would, without constructing models.
+"""
+import importlib
+from typing import Dict, List, Optional
+
+from fhir.resources.codeableconcept import CodeableConcept
+from fhir.resources.codeablereference import CodeableReference
+from fhir.resources.coding import Coding
+from fhir.resources.extension import Extension
+from fhir.resources.identifier import Identifier
+from fhir.resources.observation import Observation
+from fhir.resources.quantity import Quantity
+from fhir.resources.reference import Reference
+from fhir.resources.task import Task
+
+from iceberg_tools.data.simplifier import THREAD_LOCAL, _ensure_dialect, _populate_extensions, \
+    _simple_identifier_system, _simple_identifier_value, _transform_ids, getter
+from iceberg_tools.data.simplifier.render_plan import FieldPlan, RenderPlan, render_plan
+from iceberg_tools.util import coerce_primitive, construct_plan
+
+FHIR_CLASSES = importlib.import_module('fhir.resources')
+
+
+def _resolve(klass, obj: dict):
+    """Class of a value, polymorphic resources are resolved by their resourceType."""
+    if klass == 'Resource':
+        return FHIR_CLASSES.get_fhir_model_class(obj['resourceType'])
+    return klass
+
+
+def _check(klass, obj, loc: str):
+    """Raise ValueError or ValidationError if parse_obj would reject obj, `loc` locates it in the resource.
+
+    Checks what the FHIR models enforce: no unknown properties, required properties, the classes' pre root validators
+    and the types of non string primitives; string patterns are not checked.
+    """
+    if not isinstance(obj, dict):
+        raise ValueError(f"{loc} should be an object")
+    klass = _resolve(klass, obj)
+    properties, _ = construct_plan(klass)
+    for key in obj:
+        if key not in properties and key != 'resourceType':
+            raise ValueError(f"{loc}.{key} extra fields not permitted")
+    for validator in klass.__pre_root_validators__:
+        validator(klass, obj)
+    for alias, (_, field, model_class) in properties.items():
+        v = obj.get(alias, None)
+        if v is None:
+            if field.required:
+                raise ValueError(f"{loc}.{alias} field required")
+            continue
+        if model_class is None:
+            if not isinstance(v, str):
+                coerce_primitive(klass, field, v)
+            continue
+        for _ in v if isinstance(v, list) else [v]:
+            if _ is not None:
+                _check(model_class, _, f"{loc}.{alias}")
+
+
+def check_dict(obj: dict) -> Optional[Exception]:
+    """The reason parse_obj would reject a resource dict, None if it would not."""
+    try:
+        assert 'resourceType' in obj, "Dict missing `resourceType`, is it a FHIR dict?"
+        _check('Resource', obj, obj['resourceType'])
+    except (ValueError, AssertionError, KeyError) as e:
+        return e
+    return None
+
+
+def _render(klass, obj: dict):
+    """Equivalent of model.dict() while patched."""
+    plan = render_plan(_resolve(klass, obj))
+    return _RENDERERS.get(plan.renderer_class, _render_resource)(plan, obj)
+
+
+def _value(plan: RenderPlan, field: FieldPlan, obj: dict):
+    """Value of a field, primitives are coerced as the model would."""
+    v = obj.get(field.alias, None)
+    if v is None or field.model_class is not None:
+        return v
+    return coerce_primitive(plan.klass, field.field, v)
+
+
+def _render_coding(plan: RenderPlan, obj: dict):
+    """See _simple_coding_dict."""
+    display = obj.get('display', None)
+    if not display:
+        display = obj.get('code', None)
+    return [
+        {'__value__': f"{obj.get('system', None)}#{obj.get('code', None)}", "__name__": "coding"},
+        {'__value__': display},
+    ]
+
+
+def _render_codeable_concept(plan: RenderPlan, obj: dict):
+    """See _simple_codeable_concept_dict."""
+    codeable_concept = []
+    if obj.get('text', None):
+        codeable_concept.append(
+            {'__value__': [obj['text']], "__name__": "text"},
+        )
+    if obj.get('coding', None) is not None:
+        codings = [_render_coding(None, _) for _ in obj['coding']]
+        # flatten
+        codings = [item for sublist in codings for item in sublist]
+        codeable_concept.extend(
+            [
+                {'__value__': [_['__value__'] for _ in codings if _.get('__name__', None) == 'coding'], "__name__": "coding"},
+                {'__value__': [_['__value__'] for _ in codings if '__name__' not in _]},
+            ]
+        )
+    return codeable_concept
+
+
+def _render_codeable_reference(plan: RenderPlan, obj: dict):
+    """See _simple_codeable_reference_dict."""
+    codeable_reference = []
+    if obj.get('reference', None) is not None:
+        _ = _render(Reference, obj['reference'])
+        _['__value__'] = [_['__value__']]
+        codeable_reference.extend([_])
+    if obj.get('concept', None) is not None:
+        codeable_reference.extend(_render(CodeableConcept, obj['concept']))
+    return codeable_reference
+
+
+def _render_identifier(plan: RenderPlan, obj: dict):
+    """See _simple_identifier_dict."""
+    system = obj.get('system', None)
+    value = obj.get('value', None)
+    name = _simple_identifier_system(system)
+    identifier = [
+        {'__value__': f"{name}#{_simple_identifier_value(value)}", '__name__': 'identifier'},
+        {'__value__': f"{system}#{value}", '__name__': 'identifier_coding'},
+    ]
+    type_ = obj.get('type', None)
+    if type_ is not None:
+        coding = type_.get('coding', None)
+        if coding and len(coding) > 0:
+            identifier.append(
+                {'__name__': "identifier_text_coding",
+                 '__value__': f"{coding[0].get('system', None)}#{coding[0].get('code', None)}"}
+            )
+    return identifier
+
+
+def _render_observation(plan: RenderPlan, obj: dict):
+    """See _simple_observation_dict."""
+    observation = _render_resource(plan, obj)
+    if 'category' not in observation or observation['category'] == [None]:
+        observation['category'] = ['laboratory']
+        observation['category_coding'] = ['http://terminology.hl7.org/CodeSystem/observation-category#laboratory']
+
+    for field in plan.values:
+        if field.model_class is None:
+            continue
+        v = obj.get(field.alias, None)
+        if v is None:
+            continue
+        nested_object_name = field.name
+        name_value_list = _render(field.model_class, v)
+        if not isinstance(name_value_list, list):
+            name_value_list = [name_value_list]
+        for item in name_value_list:
+            if '__value__' in item:
+                value = item['__value__']
+                name = item.get('__name__', None)
+                if name:
+                    name = '_' + name
+                else:
+                    name = ''
+                if isinstance(value, list):
+                    value = value[0]
+                observation[f"{nested_object_name}{name}"] = value
+            else:
+                for k, v in item.items():
+                    observation[f"{nested_object_name}_{k}"] = v
+    return observation
+
+
+def _render_quantity(plan: RenderPlan, obj: dict):
+    """See _simple_quantity_dict."""
+    value = _value(plan, plan.names['value'], obj)
+    return [
+        {'__value__': f"{obj.get('system', None)}#{obj.get('code', None)}", "__name__": "unit"},
+        {'__value__': value, "__name__": "value"},
+        {'__value__': f"{value} {obj.get('unit', None)}"},
+    ]
+
+
+def _render_extension(plan: RenderPlan, obj: dict):
+    """See _simple_extension_dict."""
+    for field in plan.values:
+        v = obj.get(field.alias, None)
+        if v is not None:
+            _name = obj.get('url', None)
+            if _name:
+                _name = _name.split('/')[-1]
+            _name = _name.replace('-', '_')
+            if field.model_class is not None:
+                v = _render(field.model_class, v)
+            else:
+                v = _value(plan, field, obj)
+            _ = {'__value__': v}
+            if _name:
+                _['__name__'] = _name
+            return _
+
+
+def _render_reference(plan: RenderPlan, obj: dict):
+    """See _simple_reference_dict."""
+    reference = obj.get('reference', None)
+    THREAD_LOCAL.references.append(reference)
+    return {'__value__': reference}
+
+
+def _render_task(plan: RenderPlan, obj: dict):
+    """See _simple_task_dict."""
+    task = _render_resource(plan, obj)
+    output = plan.names['output']
+    for _ in obj.get('output') or []:
+        _render(output.model_class, _)
+    return task
+
+
+def _render_resource(plan: RenderPlan, obj: dict):
+    """See _simple_resource_dict."""
+    simplified = _render_extensions(plan, obj)
+    simplified.update(_render_primitives(plan, obj))
+    simplified.update(_render_codings(plan, obj))
+    simplified.update(_render_identifiers(plan, obj))
+    simplified.update(_render_references(plan, obj))
+    simplified.update(_render_sub_resources(plan, obj))
+    return simplified
+
+
+def _render_primitives(plan: RenderPlan, obj: dict) -> Dict:
+    """See simplifier._render_primitives."""
+    resource_primitives = {}
+    for field in plan.primitives:
+        v = _value(plan, field, obj)
+        if v is not None:
+            resource_primitives[field.name] = v
+    if 'resourceType' not in resource_primitives:
+        resource_primitives['resourceType'] = plan.resource_type
+    return resource_primitives
+
+
+def _render_references(plan: RenderPlan, obj: dict) -> Dict:
+    """See simplifier._render_references, lists of references are not rendered."""
+    references = {}
+    for field in plan.references:
+        v = obj.get(field.alias, None)
+        if v is not None and isinstance(v, dict):
+            references[field.name] = _render(field.model_class, v)['__value__']
+    return references
+
+
+def _render_extensions(plan: RenderPlan, obj: dict) -> Dict:
+    """See simplifier._render_extensions."""
+    extensions = {}
+    if plan.has_extension and obj.get('extension', None):
+        for extension in obj['extension']:
+            ext_dict = _render(Extension, extension)
+            if ext_dict:
+                _populate_extensions(ext_dict, extensions)
+            else:
+                parent_name = extension.get('url', None).split('/')[-1].replace('-', '_')
+                for child_extension in extension.get('extension', None):
+                    ext_dict = _render(Extension, child_extension)
+                    if ext_dict:
+                        _populate_extensions(ext_dict, extensions, parent_name)
+
+    # cleanup no data
+    extensions = {k: v for k, v in extensions.items() if (v is not None and v != [])}
+    return extensions
+
+
+def _render_codings(plan: RenderPlan, obj: dict) -> Dict:
+    """See simplifier._render_codings."""
+    codings = {}
+    for field in plan.codings:
+        v = obj.get(field.alias, None)
+        is_scalar = not isinstance(v, list)
+
+        if v is not None:
+            v_as_list = v
+            if not isinstance(v_as_list, list):
+                v_as_list = [v_as_list]
+            if len(v_as_list) == 0:
+                continue
+            for v in v_as_list:
+                codings_as_list = _render(field.model_class, v)
+                if not isinstance(codings_as_list, list):
+                    codings_as_list = [codings_as_list]
+                for _ in codings_as_list:
+                    compound_name = field.name
+                    if '__name__' in _:
+                        compound_name = f"{compound_name}_{_['__name__']}"
+                    compound_name = compound_name.replace('-', '_')
+                    if compound_name not in codings:
+                        codings[compound_name] = []
+                    codings[compound_name].extend(_['__value__'])
+                    if is_scalar:
+                        codings[compound_name] = codings[compound_name][0]
+    return codings
+
+
+def _render_identifiers(plan: RenderPlan, obj: dict) -> Dict:
+    """See simplifier._render_identifiers."""
+    identifiers = {}
+    if not plan.has_identifier:
+        return identifiers
+    identifier_list = obj.get('identifier', None)
+    if identifier_list is None or identifier_list == []:
+        return identifiers
+
+    # treat as a list, Per FHIR most are, some are not
+    if not isinstance(identifier_list, list):
+        identifier_list = [identifier_list]
+
+    # render as {k:[]}
+    rendered_identifiers = []
+    for _ in identifier_list:
+        rendered_identifiers.extend(_render_identifier(None, _))
+    keys = [_['__name__'] for _ in rendered_identifiers]
+    for k in keys:
+        identifiers[k] = [_['__value__'] for _ in rendered_identifiers if _['__name__'] == k]
+    return identifiers
+
+
+def _traverse_path(plan: RenderPlan, obj: dict, names: List[str]):
+    """See Getter._traverse_path, returns the class and value of the last element."""
+    klass = plan.klass
+    target = obj
+    _ = None
+    for name in names:
+        if klass is None:
+            raise AttributeError(f"{type(target).__name__} has no attribute {name}")
+        target_plan = render_plan(_resolve(klass, target))
+        if name not in target_plan.names:
+            raise AttributeError(f"{target_plan.klass.__name__} has no attribute {name}")
+        field = target_plan.names[name]
+        klass = field.model_class
+        _ = _value(target_plan, field, target)
+        if _ is None:
+            break
+        if isinstance(_, list):
+            target = _[0]
+        else:
+            target = _
+    return klass, _
+
+
+def _get_nested_object(plan: RenderPlan, obj: dict, path: str):
+    """See Getter.get, returns the class (None if not a FHIR model) and value at path."""
+    getter_ = getter(plan.resource_type, path)
+    if getter_.extension_name is not None:
+        klass, val = _traverse_path(plan, obj, getter_.names)
+        if val:
+            extension_list = val.get('extension', None) if isinstance(val, dict) and klass is not None else None
+            for extension in extension_list or []:
+                if getter_.extension_name in extension.get('url', None):
+                    return None, _render(Extension, extension)['__value__']
+        return None, None
+    return _traverse_path(plan, obj, getter_.names)
+
+
+def _render_sub_resources(plan: RenderPlan, obj: dict) -> dict:
+    """See simplifier._render_sub_resources."""
+    nested_objects = THREAD_LOCAL.nested_objects
+    simplified = {}
+    if plan.resource_type not in nested_objects:
+        return simplified
+
+    for path in nested_objects[plan.resource_type]:
+        klass, nested_object_value = _get_nested_object(plan, obj, path)
+        nested_object_name = '_'.join(path.split('.'))
+
+        if nested_object_value is not None and isinstance(nested_object_value, list):
+            for item in nested_object_value:
+                if klass is None:
+                    raise AttributeError(f"{type(item).__name__} has no attribute dict")
+                _ = _render(klass, item)
+                value = _['__value__']
+                name = _.get('__name__', None)
+                if name:
+                    name = '_' + name
+                else:
+                    name = ''
+                if f"{nested_object_name}{name}" not in simplified:
+                    simplified[f"{nested_object_name}{name}"] = []
+                simplified[f"{nested_object_name}{name}"].append(value)
+
+        elif nested_object_value is not None:
+            if klass is not None:
+                name_value_list = _render(klass, nested_object_value)
+                if not isinstance(name_value_list, list):
+                    name_value_list = [name_value_list]
+                for item in name_value_list:
+                    value = item['__value__']
+                    name = item.get('__name__', None)
+                    if name:
+                        name = '_' + name
+                    else:
+                        name = ''
+                    if isinstance(value, list):
+                        value = value[0]
+                    simplified[f"{nested_object_name}{name}"] = value
+            else:
+                if isinstance(nested_object_value, list):
+                    nested_object_value = nested_object_value[0]
+                simplified[f"{nested_object_name}"] = nested_object_value
+
+    return simplified
+
+
+_RENDERERS = {
+    Coding: _render_coding,
+    Identifier: _render_identifier,
+    Reference: _render_reference,
+    Extension: _render_extension,
+    Observation: _render_observation,
+    CodeableConcept: _render_codeable_concept,
+    CodeableReference: _render_codeable_reference,
+    Task: _render_task,
+    Quantity: _render_quantity,
+}
+"""Class specific renderers, by RenderPlan.renderer_class."""
+
+
+def simplify_dict(obj: dict, dialect: str, nested_objects: dict = {}, transform_ids=None) -> (Dict, List[str]):
+    """Create a PFB friendly record from a json dict. Returns simplified resource and associated references.
+
+    Output is the same as `simplify` of the equivalent model, no monkey patching is required.
+    """
+    # filled in by _render_reference
+    THREAD_LOCAL.references = []
+    # read by _render_sub_resources
+    THREAD_LOCAL.nested_objects = nested_objects
+    simplified = _render('Resource', obj)
+    simplified = _ensure_dialect(simplified, obj, dialect)
+    _transform_ids(simplified, transform_ids)
+    return simplified, THREAD_LOCAL.references
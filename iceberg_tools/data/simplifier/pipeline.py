@@ -0,0 +1,287 @@
+"""Overlapped simplify: a reader thread, a pool of simplify processes and a writer thread, joined by bounded queues.
+
+The reader reads and batches raw ndjson lines, the pool parses and simplifies batches, the writer writes the
+simplified records in read order. Each queue holds a few batches per worker, a stage that falls behind blocks the
+stages feeding it, so memory stays bounded. Every stage measures the time it spends working and waiting,
+the stage with the highest utilization is the bottleneck.
+"""
+import logging
+import multiprocessing
+import pathlib
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from multiprocessing.pool import AsyncResult
+from typing import Dict, List, Union
+
+from iceberg_tools.data.simplifier import SimplifierContextManager, SimplifyOptions, _simplify_records
+from iceberg_tools.stats import clock, collector, init_stats_worker, merge_stats, stats_snapshot
+from iceberg_tools.trace import init_trace_worker, merge_trace, span, trace_snapshot
+from iceberg_tools.util import EmitterContextManager, PoolWorkers, ReadTask, find_input_files, ndjson_lines, open_file, \
+    parse_ndjson_lines, read_task, sniff_first_line
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+"""Lines sent to a worker at a time."""
+QUEUE_SIZE_PER_WORKER = 2
+"""Batches queued between stages, per worker."""
+POLL_INTERVAL = 0.1
+"""Seconds between checks for a failed stage while blocked on a queue."""
+
+_DONE = None
+"""End of stream marker."""
+
+
+@dataclass
+class LineBatch:
+    """Consecutive raw lines of an ndjson file."""
+    path: pathlib.Path
+    """source file"""
+    offset: int
+    """line number of the first line"""
+    lines: List[bytes]
+    """raw lines, blank lines included"""
+
+
+@dataclass
+class StageStats:
+    """Time a pipeline stage spent working and waiting."""
+    name: str
+    """reader, simplify or writer"""
+    capacity: int = 1
+    """threads or processes in the stage"""
+    busy: float = 0.0
+    """seconds spent working, summed over the stage's processes"""
+    blocked: float = 0.0
+    """seconds spent waiting on a queue, for input or for room in the next queue"""
+    items: int = 0
+    """batches handled"""
+
+    def utilization(self, elapsed: float) -> float:
+        """Fraction of the stage's capacity spent working."""
+        if elapsed <= 0:
+            return 0.0
+        return self.busy / (elapsed * self.capacity)
+
+
+class _Pipeline:
+    """State shared by the stages of one run."""
+
+    def __init__(self, workers: int):
+        """Create the queues and stage stats."""
+        self.batches = queue.Queue(maxsize=workers * QUEUE_SIZE_PER_WORKER)
+        """reader -> dispatcher"""
+        self.results = queue.Queue(maxsize=workers * QUEUE_SIZE_PER_WORKER)
+        """dispatcher -> writer, pending results in read order"""
+        self.stop = threading.Event()
+        """set when a stage fails"""
+        self.exception = None
+        """first exception raised by a stage"""
+        self.workers = PoolWorkers('Simplify')
+        """the pool's workers, a task of a worker that exits never completes"""
+        self.stats = {
+            'reader': StageStats('reader'),
+            'simplify': StageStats('simplify', capacity=workers),
+            'writer': StageStats('writer'),
+        }
+
+    def fail(self, exception: Exception):
+        """Record the first failure, stop every stage."""
+        self.exception = self.exception or exception
+        self.stop.set()
+
+    def put(self, queue_: queue.Queue, item, stats: StageStats) -> bool:
+        """Put item, blocking while the queue is full, False if the pipeline stopped."""
+        started = time.perf_counter()
+        try:
+            while not self.stop.is_set():
+                try:
+                    queue_.put(item, timeout=POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            stats.blocked += time.perf_counter() - started
+
+    def get(self, queue_: queue.Queue, stats: StageStats):
+        """Get an item, blocking while the queue is empty, _DONE if the pipeline stopped."""
+        started = time.perf_counter()
+        try:
+            while not self.stop.is_set():
+                try:
+                    return queue_.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+            return _DONE
+        finally:
+            stats.blocked += time.perf_counter() - started
+
+
+def _read(pipeline: _Pipeline, input_files: List[pathlib.Path]):
+    """Reader stage, batch the lines of ndjson files, other files are simplified whole by a worker."""
+    stats = pipeline.stats['reader']
+    started = time.perf_counter()
+    run_stats = collector()
+    try:
+        for input_file in input_files:
+            if pipeline.stop.is_set():
+                return
+            with span('file', 'read', path=input_file), open_file(input_file) as fp:
+                first_line = sniff_first_line(fp)
+                if first_line is None:
+                    # a json document, e.g. a Bundle
+                    if not pipeline.put(pipeline.batches, ReadTask(path=input_file, size=input_file.stat().st_size), stats):
+                        return
+                    stats.items += 1
+                    continue
+                offset = 0
+                lines = [first_line]
+                read_started = clock() if run_stats is not None else None
+                for line in fp:
+                    lines.append(line)
+                    if len(lines) == BATCH_SIZE:
+                        if run_stats is not None:
+                            _count_read(run_stats, read_started, lines)
+                        if not pipeline.put(pipeline.batches, LineBatch(input_file, offset, lines), stats):
+                            return
+                        stats.items += 1
+                        offset += len(lines)
+                        lines = []
+                        read_started = clock() if run_stats is not None else None
+                if lines:
+                    if run_stats is not None:
+                        _count_read(run_stats, read_started, lines)
+                    if not pipeline.put(pipeline.batches, LineBatch(input_file, offset, lines), stats):
+                        return
+                    stats.items += 1
+        pipeline.put(pipeline.batches, _DONE, stats)
+    except Exception as e:  # noqa
+        pipeline.fail(e)
+    finally:
+        stats.busy = time.perf_counter() - started - stats.blocked
+
+
+def _count_read(run_stats, started: tuple, lines: List[bytes]):
+    """Count reading a batch of lines, their resource type is not known until a worker decodes them."""
+    run_stats.add('read', None, started, clock(), records=sum(1 for _ in lines if _.strip()), bytes_=sum(len(_) for _ in lines))
+
+
+def _result(pipeline: _Pipeline, result: AsyncResult, stats: StageStats):
+    """Wait for a worker's result, None if the pipeline stopped, RuntimeError if the worker exited."""
+    started = time.perf_counter()
+    try:
+        while not pipeline.stop.is_set():
+            try:
+                return result.get(timeout=POLL_INTERVAL)
+            except multiprocessing.TimeoutError:
+                pipeline.workers.check()
+        return None
+    finally:
+        stats.blocked += time.perf_counter() - started
+
+
+def _write(pipeline: _Pipeline, emitter: EmitterContextManager):
+    """Writer stage, write the records of each batch, in read order."""
+    stats = pipeline.stats['writer']
+    simplify_stats = pipeline.stats['simplify']
+    started = time.perf_counter()
+    try:
+        while True:
+            result = pipeline.get(pipeline.results, stats)
+            if result is _DONE:
+                return
+            result = _result(pipeline, result, stats)
+            if result is None:
+                return
+            records, busy, counters, spans = result
+            simplify_stats.busy += busy
+            simplify_stats.items += 1
+            merge_stats(counters)
+            merge_trace(spans)
+            run_stats = collector()
+            with span('batch', 'write', records=len(records)):
+                for resource_type, line in records:
+                    if run_stats is None:
+                        emitter.emit(resource_type).write(line)
+                        continue
+                    started_ = clock()
+                    emitter.emit(resource_type).write(line)
+                    run_stats.add('write', resource_type, started_, clock(), bytes_=len(line))
+            stats.items += 1
+    except Exception as e:  # noqa
+        pipeline.fail(e)
+    finally:
+        stats.busy = time.perf_counter() - started - stats.blocked
+
+
+_WORKER_OPTIONS: SimplifyOptions = None
+"""Options of a pipeline worker process, see _init_worker."""
+
+
+def _init_worker(options: SimplifyOptions, pids):
+    """Process pool initializer, keep the simplifier patches for the life of the worker."""
+    global _WORKER_OPTIONS
+    _WORKER_OPTIONS = options
+    PoolWorkers.register(pids)
+    init_stats_worker(options.stats)
+    init_trace_worker(options.trace)
+    SimplifierContextManager().__enter__()
+
+
+def _simplify_batch(batch: Union[LineBatch, ReadTask]) -> tuple:
+    """Simplify stage, parse and simplify a batch, return its (resource_type, line) records, the time taken, stats and spans."""
+    started = time.perf_counter()
+    options = _WORKER_OPTIONS
+    parse = options.engine == 'model'
+    if isinstance(batch, ReadTask):
+        parse_results = read_task(batch, parse=parse, validate=False, trusted=options.trusted)
+        with span('file', 'simplify', path=batch.path):
+            records = [_ for _ in _simplify_records(parse_results, options)]
+    else:
+        # the reader counted reading the lines
+        parse_results = parse_ndjson_lines(ndjson_lines(batch.lines), batch.path, batch.offset,
+                                           parse=parse, validate=False, trusted=options.trusted, reads=False)
+        with span('batch', 'simplify', path=batch.path, offset=batch.offset, lines=len(batch.lines)):
+            records = [_ for _ in _simplify_records(parse_results, options)]
+    return records, time.perf_counter() - started, stats_snapshot(), trace_snapshot()
+
+
+def simplify_pipeline(input_path: pathlib.Path, pattern: str, output_path, options: SimplifyOptions,
+                      workers: int = None) -> Dict[str, StageStats]:
+    """Simplify with reading, simplifying and writing overlapped, output is identical to a serial run.
+
+    Returns the stats of each stage, also logged.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    pipeline = _Pipeline(workers)
+    input_files = find_input_files(input_path, pattern, str(output_path))
+    started = time.perf_counter()
+    with EmitterContextManager(output_path, binary=True, max_bytes=options.max_bytes, max_records=options.max_records,
+                               compression=options.compression) as emitter:
+        with multiprocessing.Pool(processes=workers, initializer=_init_worker,
+                                  initargs=(options, pipeline.workers.queue)) as pool:
+            reader = threading.Thread(target=_read, args=(pipeline, input_files), name='pipeline-reader', daemon=True)
+            writer = threading.Thread(target=_write, args=(pipeline, emitter), name='pipeline-writer', daemon=True)
+            reader.start()
+            writer.start()
+            # dispatch batches in read order, the bounded results queue limits batches in flight
+            dispatch_stats = StageStats('dispatch')
+            while True:
+                batch = pipeline.get(pipeline.batches, dispatch_stats)
+                if batch is _DONE:
+                    break
+                if not pipeline.put(pipeline.results, pool.apply_async(_simplify_batch, (batch,)), dispatch_stats):
+                    break
+            pipeline.put(pipeline.results, _DONE, dispatch_stats)
+            reader.join()
+            writer.join()
+            if pipeline.exception is not None:
+                raise pipeline.exception
+    elapsed = time.perf_counter() - started
+    for stats in pipeline.stats.values():
+        logger.info(f"pipeline {stats.name}: utilization {stats.utilization(elapsed):.0%} busy {stats.busy:.2f}s "
+                    f"blocked {stats.blocked:.2f}s batches {stats.items} capacity {stats.capacity}")
+    return pipeline.stats
@@ -0,0 +1,103 @@
+"""Per FHIR class render plans, the field metadata the renderers need, computed once per class."""
+from dataclasses import dataclass, field as dataclass_field
+from typing import Dict, List
+
+from fhir.resources.codeableconcept import CodeableConcept
+from fhir.resources.codeablereference import CodeableReference
+from fhir.resources.coding import Coding
+from fhir.resources.core.utils import is_primitive_type
+from fhir.resources.extension import Extension
+from fhir.resources.identifier import Identifier
+from fhir.resources.observation import Observation
+from fhir.resources.quantity import Quantity
+from fhir.resources.reference import Reference
+from fhir.resources.task import Task
+from pydantic.v1.fields import SHAPE_SINGLETON
+
+from iceberg_tools.util import construct_plan
+
+CODING_CLASSES = [CodeableConcept, Coding, CodeableReference]
+"""Classes rendered by _render_codings."""
+
+RENDERED_CLASSES = [Coding, Identifier, Reference, Extension, Observation, CodeableConcept, CodeableReference, Task, Quantity]
+"""Classes with their own renderer, see SimplifierContextManager."""
+
+
+@dataclass
+class FieldPlan:
+    """Metadata of a single field of a FHIR class."""
+    alias: str
+    """json property name"""
+    name: str
+    """python field name, used as the simplified key"""
+    field: object
+    """pydantic ModelField"""
+    model_class: object
+    """FHIR class of the value, `Resource` if polymorphic, None for primitives"""
+    is_list: bool
+    """value is a list"""
+
+
+@dataclass
+class RenderPlan:
+    """Fields of a FHIR class, by role, each in elements_sequence order."""
+    klass: type
+    """FHIR class"""
+    resource_type: str
+    """resource_type of the class"""
+    renderer_class: type
+    """first class of the mro in RENDERED_CLASSES, None if rendered as a generic resource"""
+    fields: List[FieldPlan]
+    """all fields"""
+    names: Dict[str, FieldPlan]
+    """fields by python name"""
+    primitives: List[FieldPlan] = dataclass_field(default_factory=list)
+    """rendered by _render_primitives"""
+    codings: List[FieldPlan] = dataclass_field(default_factory=list)
+    """CodeableConcept, Coding and CodeableReference fields"""
+    references: List[FieldPlan] = dataclass_field(default_factory=list)
+    """single valued Reference fields"""
+    values: List[FieldPlan] = dataclass_field(default_factory=list)
+    """value[x] fields"""
+    has_extension: bool = False
+    """class has an extension field"""
+    has_identifier: bool = False
+    """class has an identifier field"""
+
+
+_RENDER_PLANS = {}
+"""Render plans by FHIR class."""
+
+
+def render_plan(klass) -> RenderPlan:
+    """The render plan of a FHIR class, computed on first use."""
+    plan = _RENDER_PLANS.get(klass, None)
+    if plan is None:
+        properties, _ = construct_plan(klass)
+        alias_maps = klass.get_alias_mapping()
+        renderer_class = None
+        for class_ in klass.__mro__:
+            if class_ in RENDERED_CLASSES:
+                renderer_class = class_
+                break
+        plan = RenderPlan(klass=klass, resource_type=klass.__fields__['resource_type'].default,
+                          renderer_class=renderer_class, fields=[], names={})
+        for prop_name in klass.elements_sequence():
+            name = alias_maps[prop_name]
+            _, field, model_class = properties[prop_name]
+            field_plan = FieldPlan(alias=prop_name, name=name, field=field, model_class=model_class,
+                                   is_list=field.shape != SHAPE_SINGLETON)
+            plan.fields.append(field_plan)
+            plan.names[name] = field_plan
+            if is_primitive_type(field):
+                plan.primitives.append(field_plan)
+            if model_class in CODING_CLASSES:
+                plan.codings.append(field_plan)
+            if isinstance(model_class, type) and issubclass(model_class, Reference) and not field_plan.is_list:
+                plan.references.append(field_plan)
+            if name.startswith('value'):
+                plan.values.append(field_plan)
+        plan.has_extension = 'extension' in plan.names
+        plan.has_identifier = 'identifier' in plan.names
+        _RENDER_PLANS[klass] = plan
+    return plan
@@ -1,3 +1,4 @@
+import copy
 import importlib
 import json
 from string import Formatter
@@ -14,6 +15,11 @@ from iceberg_tools.schema import extract_schemas, BASE_URI
 
 NESTED_OBJECTS_IGNORE = ['Identifier', 'Extension']
 
+_SUB_SCHEMAS = {}
+"""Per FHIR class name, its extracted schema, see _extract_nested_schemas."""
+_NESTED_LINKS = {}
+"""Per (nested schema title, class names in scope), its links, see _extract_nested_links."""
+
 
 class RefFinder:
     """
@@ -86,7 +92,7 @@ def _generate_links_from_fhir_references(schema, classes) -> List[dict]:
     for nested_schema, path in _extract_nested_schemas(schema):
         if nested_schema['title'] in NESTED_OBJECTS_IGNORE:
             continue
-        extracted_links = _extract_links(nested_schema, classes)
+        extracted_links = _extract_nested_links(nested_schema, classes)
         if len(extracted_links) == 0:
             continue
 
@@ -105,6 +111,7 @@ def _generate_links_from_fhir_references(schema, classes) -> List[dict]:
 def _extract_nested_schemas(schema) -> Iterator[tuple[dict, str]]:
     """Extract $ref from elements in schema that are not `References`.
 
+    Sub schemas are extracted once per process and shared, they must not be modified.
     Returns: (sub_schema, path) a tuple of the sub schema and the path to it in the passed schema
     """
     refs_finder = RefFinder(schema, refs=False)
@@ -130,13 +137,24 @@ def _extract_nested_schemas(schema) -> Iterator[tuple[dict, str]]:
             assert '$ref' in property_, ("TODO no $ref?", property_name, property_, match)
             target = property_['$ref'].split('.')[0]
 
-        target_class = mod.get_fhir_model_class(target)
-        sub_schemas = extract_schemas([target_class], BASE_URI)
-        sub_schema = sub_schemas[target]
+        sub_schema = _SUB_SCHEMAS.get(target, None)
+        if sub_schema is None:
+            target_class = mod.get_fhir_model_class(target)
+            sub_schema = _SUB_SCHEMAS[target] = extract_schemas([target_class], BASE_URI)[target]
 
         yield sub_schema, match
 
 
+def _extract_nested_links(nested_schema: dict, classes) -> List[dict]:
+    """Links of a schema from _extract_nested_schemas, extracted once per schema and classes in scope."""
+    key = (nested_schema['title'], frozenset(_.__name__ for _ in classes))
+    links = _NESTED_LINKS.get(key, None)
+    if links is None:
+        # _extract_links adds defaults to the schema
+        links = _NESTED_LINKS[key] = _extract_links(copy.deepcopy(nested_schema), classes)
+    return copy.deepcopy(links)
+
+
 def _extract_links(schema: dict, classes) -> List[dict]:
     """Extract Link Description Object (LDO) from a schema.
 
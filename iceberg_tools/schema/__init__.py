@@ -1,33 +1,52 @@
 import copy
+import hashlib
 import importlib
 import logging
+import multiprocessing
+import os
 import pathlib
-import sqlite3
 from collections import defaultdict
-from typing import List
+from typing import List, Optional
 
 import inflection
 import orjson
 from fhir.resources.core.utils.common import get_fhir_type_name
 from fhir.resources.fhirprimitiveextension import FHIRPrimitiveExtension
 
-from iceberg_tools.schema.fhir_resources.binding_lookup import create_fhir_definitions_lookup
+from iceberg_tools.schema.fhir_resources.binding_lookup import bindings_index, bindings_version
 
 
 logger = logging.getLogger(__name__)
 
-path = pathlib.Path("~/.iceberg").expanduser()
-path.mkdir(parents=True, exist_ok=True)
-path = path / "element_bindings.sqlite"
-if not path.is_file():
-    create_fhir_definitions_lookup()
-if not path.is_file():
-    logger.error(f"Unable to find fhir bindings at {path}")
-    exit(2)
-
-ELEMENT_DB = sqlite3.connect(path)
 BASE_URI = 'http://graph-fhir.io/schema/0.0.2'
 
+SCHEMA_CACHE_PATH = '~/.iceberg/schema_cache'
+"""Default cache of extracted schemas, see extract_schemas."""
+PARALLEL_MISSES = 500
+"""Fewest schemas missing from the cache worth extracting across workers, fewer are cheaper to extract serially."""
+
+
+_CLASS_GRAPH = {}
+"""Per FHIR model class, (number of element properties, classes of its element properties), see _class_node."""
+
+
+def _class_node(klass) -> tuple:
+    """Number of element properties and the distinct FHIR model classes they embed, in property order."""
+    node = _CLASS_GRAPH.get(klass, None)
+    if node is None:
+        mod = importlib.import_module('fhir.resources')
+        properties = 0
+        embedded_classes = {}
+        for p in klass.element_properties():
+            properties += 1
+            try:
+                embedded_class = mod.get_fhir_model_class(get_fhir_type_name(p.type_))
+                embedded_classes[embedded_class] = None
+            except KeyError:
+                pass
+        node = _CLASS_GRAPH[klass] = (properties, tuple(embedded_classes))
+    return node
+
 
 def _find_fhir_classes(gen3_config, log_stats=True) -> List[type]:
     """Based on config, expand dependencies."""
@@ -42,135 +61,168 @@ def _find_fhir_classes(gen3_config, log_stats=True) -> List[type]:
     for class_name in class_names:
         classes.add(mod.get_fhir_model_class(class_name))
 
-    # find subclasses N levels deep
-    # maintain statistics
-    stats = defaultdict(int)
-
+    # find subclasses N levels deep, breadth first, expanding only the classes found in the previous level
+    expanded = []
+    frontier = set(classes)
     for _ in range(subclass_depth):
         embedded_classes = set()
-        for klass in classes:
-
-            for p in klass.element_properties():
-                try:
-
-                    embedded_class = mod.get_fhir_model_class(get_fhir_type_name(p.type_))
-                    embedded_classes.add(embedded_class)
-
-                    _update_stats(stats, klass, embedded_class)
-
-                except KeyError:
-                    pass
-
-        classes.update(embedded_classes)
+        for klass in frontier:
+            embedded_classes.update(_class_node(klass)[1])
+        expanded.extend(frontier)
+        frontier = embedded_classes - classes
+        classes.update(frontier)
     classes.add(FHIRPrimitiveExtension)
 
     if log_stats:
-        logger.info(f"Class statistics number of nested objects:\n{_summarize_stats(stats)}")
+        logger.info(f"Class statistics number of nested objects:\n{_summarize_stats(expanded)}")
 
     return classes
 
 
-def _summarize_stats(stats: dict) -> str:
-    """Summarize stats, counts of subclasses."""
+def _summarize_stats(classes: List[type]) -> str:
+    """Summarize stats, counts of nested classes and their properties, per class."""
     summary = {}
-    for _ in stats:
-        parts = _.split('.')
-        klass_name = parts[0]
-        if klass_name in ['Meta', 'Extension']:
+    for klass in classes:
+        if klass.__name__ in ['Meta', 'Extension']:
+            continue
+        nested_classes = [_ for _ in _class_node(klass)[1] if _.__name__ not in ['Meta', 'Extension']]
+        if not nested_classes:
             continue
-        nested_class_count = len(parts[1:])
-        total_property_counts = stats[_]
-        summary[klass_name] = {'nested_class_count': nested_class_count, 'total_property_counts': total_property_counts}
+        total_property_counts = sum(_class_node(_)[0] for _ in nested_classes)
+        summary[klass.__name__] = {'nested_class_count': len(nested_classes), 'total_property_counts': total_property_counts}
 
     stats_table = '\n  '.join(sorted([f'{k}: {v}' for k, v in summary.items()]))
     return '  ' + stats_table
 
 
-def _update_stats(stats: dict, klass, embedded_class):
-    """Update stats for class and embedded class."""
-    if embedded_class.__name__ in ['Meta', 'Extension']:
-        return
-    stat_property = f"{klass.__name__}.{embedded_class.__name__}"
-    existing_stat_property = next(iter([k for k in stats.keys() if klass.__name__ in k]), None)
-    if existing_stat_property:
-        if embedded_class.__name__ not in existing_stat_property:
-            property_count = stats[existing_stat_property]
-            del stats[existing_stat_property]
-            existing_stat_property += f".{embedded_class.__name__}"
-            stats[existing_stat_property] = property_count + len(list(embedded_class.element_properties()))
-    else:
-        stats[stat_property] += 1
+def extract_schemas(classes: List[type], base_uri: str, workers: int = None, cache_path: str = None) -> dict:
+    """Get json schema for all classes.
 
+    If cache_path, schemas are read from and written to a per class cache there, see _schema_cache_path.
+    Missing schemas are extracted serially, or across `workers` processes if at least PARALLEL_MISSES are missing.
+    """
+    # load the bindings before forking workers, building them if needed
+    bindings_index(create=True)
+    cache = _schema_cache_path(cache_path) if cache_path else None
 
-def extract_schemas(classes: List[type], base_uri: str) -> dict:
-    """Get json schema for all classes."""
     schemas = {}
     for klass in classes:
-        schema = klass.schema()
-
-        assert 'title' in schema, schema
-        schema['$id'] = schema['title']
-
-        schema = _decorate_schema_bindings(schema)
-        schema = _decorate_schema_backrefs(schema)
-
-        schema['description'] = schema.get('description', '').replace('\n\n', '\n')
-        schema['description'] = schema['description'].replace("""Disclaimer: Any field name ends with ``__ext`` doesn't part of\nResource StructureDefinition, instead used to enable Extensibility feature\nfor FHIR Primitive Data Types.\n""", '')
-        schema['description'] = schema['description'].replace('\n', ' ')
-
-        if '[See' not in schema['description']:
-            schema['description'] += f" [See https://hl7.org/fhir/R5/{schema['title']}.html]"
-
-        # rename python style name back to resourceType
-        if 'resource_type' in schema['properties']:
-            schema['properties']['resourceType'] = schema['properties']['resource_type']
-            schema['properties']['resourceType']['description'] = 'One of the resource types defined as part of FHIR'
-            del schema['properties']['resource_type']
-        # rename python reserved names
-        if 'for' in schema['properties']:
-            schema['properties']['for_fhir'] = copy.deepcopy(schema['properties']['for'])
-            schema['properties']['for_fhir']['description'] = "[Reserved word `for` renamed to `for_fhir`] " + schema['properties']['for_fhir']['description']
-            del schema['properties']['for']
-        #
-        # style as an anonymous schema
-        #
-
-        # rename type Resource to $ref
-        for p_ in schema['properties'].values():
-            if 'type' not in p_:
-                continue
-            if p_['type'][0].isupper():
-                p_['$ref'] = f"{p_['type']}.yaml"
-                del p_['type']
-        for p_ in schema['properties'].values():
-            if 'items' not in p_:
-                continue
-            if 'type' not in p_['items']:
-                continue
-            if p_['items']['type'][0].isupper():
-                p_['items']['$ref'] = f"{p_['items']['type']}.yaml"
-                del p_['items']['type']
-
+        schemas[klass.__name__] = _read_cached_schema(cache, klass) if cache else None
+    missing = [klass for klass in classes if schemas[klass.__name__] is None]
+    if cache:
+        logger.debug(f"{len(classes) - len(missing)} of {len(classes)} schemas found in {cache}")
+
+    def _add(klass, schema):
+        if cache:
+            _write_cached_schema(cache, klass, schema)
         schemas[klass.__name__] = schema
 
+    if workers is None or workers <= 1 or len(missing) < PARALLEL_MISSES:
+        for klass in missing:
+            _add(klass, _extract_schema(klass))
+    else:
+        with multiprocessing.Pool(processes=workers) as pool:
+            for klass, schema in zip(missing, pool.imap(_extract_schema, missing, chunksize=4)):
+                _add(klass, schema)
+
     return schemas
 
 
+def _extract_schema(klass: type) -> dict:
+    """Get json schema for a class."""
+    schema = klass.schema()
+
+    assert 'title' in schema, schema
+    schema['$id'] = schema['title']
+
+    schema = _decorate_schema_bindings(schema)
+    schema = _decorate_schema_backrefs(schema)
+
+    schema['description'] = schema.get('description', '').replace('\n\n', '\n')
+    schema['description'] = schema['description'].replace("""Disclaimer: Any field name ends with ``__ext`` doesn't part of\nResource StructureDefinition, instead used to enable Extensibility feature\nfor FHIR Primitive Data Types.\n""", '')
+    schema['description'] = schema['description'].replace('\n', ' ')
+
+    if '[See' not in schema['description']:
+        schema['description'] += f" [See https://hl7.org/fhir/R5/{schema['title']}.html]"
+
+    # rename python style name back to resourceType
+    if 'resource_type' in schema['properties']:
+        schema['properties']['resourceType'] = schema['properties']['resource_type']
+        schema['properties']['resourceType']['description'] = 'One of the resource types defined as part of FHIR'
+        del schema['properties']['resource_type']
+    # rename python reserved names
+    if 'for' in schema['properties']:
+        schema['properties']['for_fhir'] = copy.deepcopy(schema['properties']['for'])
+        schema['properties']['for_fhir']['description'] = "[Reserved word `for` renamed to `for_fhir`] " + schema['properties']['for_fhir']['description']
+        del schema['properties']['for']
+    #
+    # style as an anonymous schema
+    #
+
+    # rename type Resource to $ref
+    for p_ in schema['properties'].values():
+        if 'type' not in p_:
+            continue
+        if p_['type'][0].isupper():
+            p_['$ref'] = f"{p_['type']}.yaml"
+            del p_['type']
+    for p_ in schema['properties'].values():
+        if 'items' not in p_:
+            continue
+        if 'type' not in p_['items']:
+            continue
+        if p_['items']['type'][0].isupper():
+            p_['items']['$ref'] = f"{p_['items']['type']}.yaml"
+            del p_['items']['type']
+
+    return schema
+
+
+def _schema_cache_path(cache_path: str) -> pathlib.Path:
+    """Directory of cached schemas extracted by this code from these model library versions and bindings database."""
+    import fhir.resources
+    import pydantic
+    try:
+        import fhir_core  # the base models of fhir.resources>=8
+        fhir_core_version = fhir_core.__version__
+    except ImportError:
+        fhir_core_version = ''
+
+    digest = hashlib.sha256()
+    for _ in [fhir.resources.__version__.encode(), fhir_core_version.encode(), str(pydantic.VERSION).encode(),
+              bindings_version().encode(), pathlib.Path(__file__).read_bytes()]:
+        digest.update(hashlib.sha256(_).digest())
+    return pathlib.Path(cache_path).expanduser() / digest.hexdigest()[:16]
+
+
+def _read_cached_schema(cache: pathlib.Path, klass: type) -> Optional[dict]:
+    """The cached schema of a class, None if not cached."""
+    path = cache / f"{klass.__module__}.{klass.__name__}.json"
+    if not path.is_file():
+        return None
+    return orjson.loads(path.read_bytes())
+
+
+def _write_cached_schema(cache: pathlib.Path, klass: type, schema: dict):
+    """Cache the schema of a class, renamed into place so concurrent runs never read a partial file."""
+    cache.mkdir(parents=True, exist_ok=True)
+    path = cache / f"{klass.__module__}.{klass.__name__}.json"
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_bytes(orjson.dumps(schema))
+    os.replace(tmp_path, path)
+
+
 def _decorate_schema_bindings(schema):
     """Supplement schema with bindings."""
-    elements = {}
     klass = schema['title']
-    with ELEMENT_DB:
-        cursor = ELEMENT_DB.cursor()
-        cursor.execute('select id, entity from element_bindings where id like ?;', (f"{klass}.%", ))
-        for row in cursor.fetchall():
-            elements[row[0]] = orjson.loads(row[1])
+    # built on first schema generation if there is no database yet
+    elements = bindings_index(create=True).get(klass, {})
     if len(elements) == 0:
         return schema
     for property_name, property_ in schema['properties'].items():
-        if f"{klass}.{property_name}" not in elements:
+        if property_name not in elements:
             continue
-        element = elements[f"{klass}.{property_name}"]
+        element = elements[property_name]
         if 'binding' in element:
             binding = element['binding']
             property_['binding_strength'] = binding.get('strength', None)
@@ -1,15 +1,49 @@
+"""Element bindings (value sets of coded properties), read when schemas are generated.
+
+The database is opened read-only on first use, from the `ICEBERG_ELEMENT_BINDINGS` environment variable
+if set, otherwise `~/.iceberg/element_bindings.sqlite`, which schema generation builds if it does not exist.
+Importing this module, or anything that only reads data, never opens, downloads or creates it.
+
+No prebuilt database is shipped: the first build downloads the FHIR definitions, with a warning, unless
+`ICEBERG_FHIR_DEFINITIONS` names a local copy of the definitions zip.
+"""
+import hashlib
+import itertools
+import os
 import pathlib
-from typing import Iterator, List
+import sqlite3
+import tempfile
+import urllib.request
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional
 from zipfile import ZipFile
 
 import orjson
 import inflection
-import sqlite3
-import urllib.request
 import logging
 
 logger = logging.getLogger(__name__)
 
+BINDINGS_ENV = 'ICEBERG_ELEMENT_BINDINGS'
+"""Environment variable, path of a bindings database to use instead of the user one."""
+USER_PATH = pathlib.Path('~/.iceberg/element_bindings.sqlite').expanduser()
+"""Database built by schema generation or `iceberg schema bindings`."""
+DEFINITIONS_ENV = 'ICEBERG_FHIR_DEFINITIONS'
+"""Environment variable, path of a local definitions zip to build the user database from instead of downloading."""
+DEFINITIONS_URL = "https://github.com/nazrulworld/hl7-archives/raw/0.4.0/FHIR/R5/5.0.0-definitions.json.zip"
+"""FHIR R5 definitions the bindings are extracted from."""
+DEFINITIONS_FILES = ['profiles-resources.json', 'profiles-others.json', 'profiles-types.json']
+"""Bundles of StructureDefinitions in the definitions zip."""
+BATCH_SIZE = 1000
+"""Elements inserted per transaction."""
+HASH_KEY = 'definitions_sha256'
+"""Metadata key of the content hash of the definitions the database was built from."""
+
+_CONNECTION = None
+"""(pid, connection) of the open database, a forked process opens its own."""
+_INDEX = None
+"""Elements by class and property, see bindings_index."""
+
 
 def _class_property(element_id):
     """Ensure type, property_name."""
@@ -21,12 +55,31 @@ def _class_property(element_id):
         return f"{''.join(klass)}.{parts[-1]}"  # {'type': ''.join(klass), 'property_name': parts[-1]}
 
 
-def _profile_in_bundle(bundle) -> Iterator[dict]:
-    """Generate profiles."""
-    for e in bundle.get('entry', []):
-        _ = e.get('resource', None)
-        if _:
-            yield _
+def _profile_in_bundle(fp) -> Iterator[dict]:
+    """Generate profiles, decoding the bundle's entries one at a time from a binary stream."""
+    from iceberg_tools.util import JSONStream
+
+    stream = JSONStream(fp)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'entry' and stream.peek() == '[':
+            stream.expect('[')
+            while stream.peek() != ']':
+                _ = stream.value().get('resource', None)
+                if _:
+                    yield _
+                if stream.expect(',]') == ']':
+                    break
+            else:
+                stream.expect(']')
+        else:
+            stream.value()
+        if stream.expect(',}') == '}':
+            break
 
 
 def _profile_in_files(file_names: List[str]) -> dict:
@@ -36,12 +89,12 @@ def _profile_in_files(file_names: List[str]) -> dict:
         with ZipFile(zip_file) as myzip:
             for file_name in [_ for _ in file_names if not _.endswith('zip')]:
                 with myzip.open(file_name) as fp:
-                    for _ in _profile_in_bundle(orjson.loads(fp.read())):
+                    for _ in _profile_in_bundle(fp):
                         yield _
     else:
         for file_name in file_names:
-            with open(file_name) as fp:
-                for _ in _profile_in_bundle(orjson.loads(fp.read())):
+            with open(file_name, 'rb') as fp:
+                for _ in _profile_in_bundle(fp):
                     yield _
 
 
@@ -69,35 +122,182 @@ def _elements_with_bindings(file_names: List[str]) -> Iterator[dict]:
             yield {'key': _class_property(element['id']), 'element': element}
 
 
-def create_fhir_definitions_lookup(iceberg_path: str = "~/.iceberg"):
-    """Generate the element_bindings table."""
+def _sha256(path: pathlib.Path) -> str:
+    """Hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _definitions_hash(connection: sqlite3.Connection) -> Optional[str]:
+    """Content hash of the definitions a database was built from, None if unknown."""
+    try:
+        row = connection.execute('select value from metadata where key = ?;', (HASH_KEY,)).fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    return row[0] if row else None
+
+
+def _built_from(path: pathlib.Path) -> Optional[str]:
+    """Content hash of the definitions a database file was built from, None if unknown."""
+    if not path.is_file():
+        return None
+    try:
+        connection = _connect(path)
+    except sqlite3.DatabaseError:
+        return None
+    try:
+        return _definitions_hash(connection)
+    finally:
+        connection.close()
+
+
+def _download(definitions_path: pathlib.Path):
+    """Download the definitions zip, a failed download leaves no partial file behind."""
+    logger.info(f"Downloading {DEFINITIONS_URL}")
+    fd, tmp_path = tempfile.mkstemp(dir=definitions_path.parent, suffix='.zip.tmp')
+    os.close(fd)
+    try:
+        urllib.request.urlretrieve(DEFINITIONS_URL, tmp_path)
+        os.replace(tmp_path, definitions_path)
+    except OSError as e:
+        raise RuntimeError(f"Could not download {DEFINITIONS_URL}: {e}, set {DEFINITIONS_ENV} to a local copy "
+                           "or run `iceberg schema bindings --definitions_path`") from e
+    finally:
+        pathlib.Path(tmp_path).unlink(missing_ok=True)
+
+
+def create_fhir_definitions_lookup(iceberg_path: str = "~/.iceberg", output_path: str = None, definitions_path: str = None,
+                                   force: bool = False) -> pathlib.Path:
+    """Generate the element_bindings table, return the database path.
+
+    The definitions zip is downloaded to iceberg_path unless definitions_path is given.
+    Unless force, the build is skipped if the database was built from definitions with the same content hash.
+    Elements are streamed from the definitions and inserted in batches into a temporary file that is renamed,
+    a failed build leaves no partial database behind.
+    """
 
     path = pathlib.Path(iceberg_path).expanduser()
     path.mkdir(parents=True, exist_ok=True)
 
-    zip_file_path = path / "5.0.0-definitions.json.zip"
+    if definitions_path is None:
+        definitions_path = path / "5.0.0-definitions.json.zip"
+        if not definitions_path.is_file():
+            _download(definitions_path)
+
+    output_path = pathlib.Path(output_path).expanduser() if output_path else path / "element_bindings.sqlite"
+    definitions_hash = _sha256(pathlib.Path(definitions_path))
+    if not force and _built_from(output_path) == definitions_hash:
+        logger.info(f"{output_path} is up to date with {definitions_path}")
+        return output_path
+
+    generator = _elements_with_bindings([str(definitions_path)] + DEFINITIONS_FILES)
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=output_path.parent, suffix='.sqlite.tmp')
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(tmp_path)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with connection:
+                connection.execute('CREATE TABLE element_bindings (id PRIMARY KEY, entity Text)')
+                connection.execute('CREATE TABLE metadata (key PRIMARY KEY, value Text)')
+            rows = ((_['key'], orjson.dumps(_['element']).decode(),) for _ in generator)
+            while True:
+                batch = list(itertools.islice(rows, BATCH_SIZE))
+                if not batch:
+                    break
+                with connection:
+                    connection.executemany('INSERT OR REPLACE into element_bindings values (?, ?)', batch)
+            with connection:
+                connection.execute('INSERT into metadata values (?, ?)', (HASH_KEY, definitions_hash))
+            count = connection.execute('select count(*) from element_bindings;').fetchone()[0]
+            # checkpoint into a single file, read-only connections can't open a database with a pending WAL
+            connection.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            connection.close()
+        assert count > 0, f"No element bindings found in {definitions_path}"
+        os.replace(tmp_path, output_path)
+    finally:
+        for _ in ['', '-wal', '-shm']:
+            pathlib.Path(f"{tmp_path}{_}").unlink(missing_ok=True)
+    logger.info(f'element_bindings inserted in {output_path} {count}')
+    return output_path
+
+
+def _connect(path: pathlib.Path) -> sqlite3.Connection:
+    """Open a database read-only."""
+    return sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+
+
+def bindings_path() -> Optional[pathlib.Path]:
+    """The bindings database to read, None if there is none yet."""
+    if os.environ.get(BINDINGS_ENV, None):
+        path = pathlib.Path(os.environ[BINDINGS_ENV]).expanduser()
+        if not path.is_file():
+            raise FileNotFoundError(f"{BINDINGS_ENV}={path} is not a file")
+        return path
+    if USER_PATH.is_file():
+        return USER_PATH
+    return None
+
+
+def element_bindings(create: bool = False) -> sqlite3.Connection:
+    """Read-only connection to the bindings database, opened once per process.
+
+    If there is none and create, build USER_PATH from $ICEBERG_FHIR_DEFINITIONS, or else download the FHIR definitions.
+    """
+    global _CONNECTION
+    if _CONNECTION is not None and _CONNECTION[0] == os.getpid():
+        return _CONNECTION[1]
+    path = bindings_path()
+    if path is None:
+        if not create:
+            raise FileNotFoundError(f"No element bindings found, set {BINDINGS_ENV} or run `iceberg schema bindings`")
+        definitions_path = os.environ.get(DEFINITIONS_ENV, None) or None
+        if definitions_path is None:
+            logger.warning(f"No element bindings found, building {USER_PATH} from {DEFINITIONS_URL}. "
+                           f"To build offline, set {DEFINITIONS_ENV} to a local copy of it.")
+        path = create_fhir_definitions_lookup(output_path=str(USER_PATH), definitions_path=definitions_path)
+    logger.debug(f"Reading element bindings from {path}")
+    connection = _connect(path)
+    if connection.execute('select 1 from element_bindings limit 1;').fetchone() is None:
+        logger.warning(f"No element bindings in {path}, delete it to rebuild")
+    _CONNECTION = (os.getpid(), connection)
+    return connection
+
+
+def bindings_version(create: bool = False) -> str:
+    """Identifies the content of the bindings database, for keying caches of derived data.
 
-    urllib.request.urlretrieve(
-        "https://github.com/nazrulworld/hl7-archives/raw/0.4.0/FHIR/R5/5.0.0-definitions.json.zip",
-        zip_file_path)
+    The hash of the definitions it was built from, or its path, size and modification time if it predates the hash.
+    """
+    definitions_hash = _definitions_hash(element_bindings(create))
+    if definitions_hash:
+        return definitions_hash
+    path = bindings_path()
+    stat = path.stat()
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
 
-    generator = _elements_with_bindings(
-        [str(zip_file_path), 'profiles-resources.json', 'profiles-others.json', 'profiles-types.json'])
 
-    path = path / "element_bindings.sqlite"
-    connection = sqlite3.connect(path)
+def bindings_index(create: bool = False) -> Dict[str, Dict[str, dict]]:
+    """Elements with bindings by class name and property name, loaded in a single scan once per process.
 
-    with connection:
-        connection.execute('DROP table IF EXISTS element_bindings')
-        connection.execute('CREATE TABLE if not exists element_bindings (id PRIMARY KEY, entity Text)')
-        with connection:
-            connection.executemany('INSERT OR REPLACE into element_bindings values (?, ?)',
-                                   [(_['key'], orjson.dumps(_['element']).decode(),) for _ in generator])
-        with connection:
-            cursor = connection.cursor()
-            cursor.execute('select count(*) from element_bindings;')
-            logger.info(f'element_bindings inserted in {path} {cursor.fetchone()[0]}')
+    see element_bindings for `create`
+    """
+    global _INDEX
+    if _INDEX is None:
+        index = defaultdict(dict)
+        for id_, entity in element_bindings(create).execute('select id, entity from element_bindings;'):
+            klass, property_name = id_.split('.', 1)
+            index[klass][property_name] = orjson.loads(entity)
+        _INDEX = dict(index)
+    return _INDEX
 
 
 if __name__ == "__main__":
-    create_fhir_definitions_lookup()
+    create_fhir_definitions_lookup(output_path=str(USER_PATH))
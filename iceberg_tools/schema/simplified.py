@@ -5,7 +5,6 @@ from collections import OrderedDict
 
 import inflection
 import requests
-import requests_cache
 import yaml
 from yaml import SafeLoader
 
@@ -13,10 +12,18 @@ from iceberg_tools.schema import _list_of_type, _scalar_of_type, _list_of_any_ty
 
 logger = logging.getLogger(__name__)
 
-cache_path = pathlib.Path("~/.iceberg").expanduser()
-cache_path.mkdir(parents=True, exist_ok=True)
-cache_path = cache_path / "requests_cache"
-requests_cache.install_cache(cache_path)
+REQUESTS_CACHE_PATH = pathlib.Path("~/.iceberg/requests_cache").expanduser()
+"""Responses of fetched extension definitions are cached here, see install_requests_cache."""
+
+
+def install_requests_cache():
+    """Cache all `requests` responses in this process, called by the code that fetches definitions, not on import."""
+    import requests_cache
+
+    if requests_cache.is_installed():
+        return
+    REQUESTS_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    requests_cache.install_cache(REQUESTS_CACHE_PATH)
 
 
 FHIR_PRIMITIVES_TO_JSON_SCHEMA = {
@@ -129,6 +136,7 @@ def _add_gen3_static_dependencies(gen3_fixtures, schemas):
 
 def _add_extensions(extensions, schemas):
     """Add extensions to schema properties"""
+    install_requests_cache()
     for k, schema in schemas.items():
         if 'properties' not in schema:
             continue
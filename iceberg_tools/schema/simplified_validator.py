@@ -11,7 +11,9 @@ import os
 from iceberg_tools.dictionaryutils import DataDictionary
 from jsonschema.exceptions import ValidationError
 
-from iceberg_tools.util import _to_file, ParseResult
+from iceberg_tools.stats import stage_timer
+from iceberg_tools.trace import span
+from iceberg_tools.util import find_input_files, ndjson_lines, open_file, ParseResult
 
 
 logger = logging.getLogger(__name__)
@@ -101,29 +103,39 @@ def validate(gen3_resource: dict, schemas: dict):
 def directory_reader(
         directory_path: pathlib.Path,
         schema_path: str,
-        pattern: str = '*.ndjson',
+        pattern: str = '*.ndjson*',
         validate_=True) -> Iterator[ParseResult]:
-    """Extract FHIR resources from directory"""
+    """Extract FHIR resources from directory, ndjson files may be gzip or zstd compressed."""
 
     assert directory_path.is_dir(), f"{directory_path.name} is not a directory"
 
     schemas = ensure_schema(schema_path)
 
-    input_files = [_ for _ in directory_path.glob(pattern)]
+    input_files = find_input_files(directory_path, pattern)
+    if not input_files:
+        logger.warning(f"No files matching {pattern} in {directory_path}")
+    timer = stage_timer()
     for input_file in input_files:
         logger.info(input_file)
-        if not input_file.is_file():
-            continue
-        fp = _to_file(input_file)
-        with fp:
+        fp = open_file(input_file)
+        with span('file', 'validate', path=input_file), fp:
             offset = 0
-            for line in fp.readlines():
+            for line in ndjson_lines(fp):
+                if line is None:
+                    offset += 1
+                    continue
+                timer.lap('read', len(line))
                 gen3_resource = orjson.loads(line)
+                timer.lap('decode', len(line))
                 parse_result = validate(gen3_resource, schemas=schemas)
+                timer.lap('schema_check')
+                object_ = gen3_resource.get('object', None) if isinstance(gen3_resource, dict) else None
+                timer.record(object_.get('resourceType', None) if isinstance(object_, dict) else None)
                 parse_result.path = input_file
                 parse_result.offset = offset
                 offset += 1
                 yield parse_result
+                timer.restart()
 
 
 def ensure_schema(schema_path):
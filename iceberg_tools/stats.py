@@ -0,0 +1,211 @@
+"""Per stage, per resource type wall and cpu time counters, see `iceberg data --stats-out`.
+
+Collection is off unless enabled, instrumented code checks `collector()` once per batch or record
+and only reads the clocks when it returns a collector. Worker processes collect their own counters and
+return a snapshot with their results, merged into the collector of the parent process.
+"""
+import os
+import pathlib
+import time
+from typing import Dict, Optional, Tuple
+
+import orjson
+
+STAGES = ['read', 'decode', 'parse', 'migrate', 'simplify', 'schema_check', 'serialize', 'write']
+"""Instrumented stages, in processing order."""
+
+_COLLECTOR: Optional['StatsCollector'] = None
+"""Collector of this process, None when disabled."""
+
+
+def collector() -> Optional['StatsCollector']:
+    """The active collector, None if stats are disabled."""
+    return _COLLECTOR
+
+
+def enable_stats() -> 'StatsCollector':
+    """Start collecting in this process."""
+    global _COLLECTOR
+    if _COLLECTOR is None:
+        _COLLECTOR = StatsCollector()
+    return _COLLECTOR
+
+
+def disable_stats():
+    """Stop collecting in this process."""
+    global _COLLECTOR
+    _COLLECTOR = None
+
+
+def init_stats_worker(enabled: bool):
+    """Process pool initializer, collect in the worker if the parent does, not counting what a forked worker inherited."""
+    global _COLLECTOR
+    _COLLECTOR = StatsCollector() if enabled else None
+
+
+def stats_snapshot() -> Optional[dict]:
+    """Counters collected by this process since the last snapshot, None if disabled, see merge_stats."""
+    if _COLLECTOR is None:
+        return None
+    return _COLLECTOR.snapshot()
+
+
+def merge_stats(counters: Optional[dict]):
+    """Add a worker's snapshot to this process' collector."""
+    if _COLLECTOR is not None and counters:
+        _COLLECTOR.merge(counters)
+
+
+def stage_timer() -> 'StageTimer':
+    """A timer counting into the active collector, one that counts nothing if stats are disabled."""
+    if _COLLECTOR is None:
+        return _NULL_TIMER
+    return StageTimer(_COLLECTOR)
+
+
+def clock() -> Tuple[float, float]:
+    """Wall and cpu time now."""
+    return time.perf_counter(), time.process_time()
+
+
+def _process_times() -> Tuple[float, float]:
+    """Wall time and cpu time of this process and its finished children."""
+    times = os.times()
+    return time.perf_counter(), times.user + times.system + times.children_user + times.children_system
+
+
+class StatsCollector:
+    """Wall time, cpu time, records and bytes by (stage, resource type)."""
+
+    def __init__(self):
+        """Start the run clocks."""
+        self.counters: Dict[Tuple[str, str], list] = {}
+        """[wall, cpu, records, bytes] by (stage, resource type)"""
+        self.started = _process_times()
+        """wall and cpu time at start"""
+
+    def add(self, stage: str, resource_type: str, started: Tuple[float, float], ended: Tuple[float, float],
+            records: int = 1, bytes_: int = 0):
+        """Count time between two clock() readings."""
+        counter = self.counters.get((stage, resource_type), None)
+        if counter is None:
+            counter = self.counters[(stage, resource_type)] = [0.0, 0.0, 0, 0]
+        counter[0] += ended[0] - started[0]
+        counter[1] += ended[1] - started[1]
+        counter[2] += records
+        counter[3] += bytes_
+
+    def snapshot(self) -> dict:
+        """Return and reset the counters."""
+        counters = self.counters
+        self.counters = {}
+        return counters
+
+    def merge(self, counters: dict):
+        """Add counters from another process."""
+        for key, (wall, cpu, records, bytes_) in counters.items():
+            counter = self.counters.get(key, None)
+            if counter is None:
+                counter = self.counters[key] = [0.0, 0.0, 0, 0]
+            counter[0] += wall
+            counter[1] += cpu
+            counter[2] += records
+            counter[3] += bytes_
+
+    def report(self, command: str = None) -> dict:
+        """Totals per stage, broken down per resource type, with throughput."""
+        wall, cpu = _process_times()
+        stages = {}
+        for (stage, resource_type), (stage_wall, stage_cpu, records, bytes_) in sorted(self.counters.items(), key=_stage_order):
+            totals = stages.setdefault(stage, _totals(0.0, 0.0, 0, 0))
+            totals['wall_seconds'] += stage_wall
+            totals['cpu_seconds'] += stage_cpu
+            totals['records'] += records
+            totals['bytes'] += bytes_
+            totals['resource_types'][resource_type or 'unknown'] = _throughput(_totals(stage_wall, stage_cpu, records, bytes_))
+        for totals in stages.values():
+            _throughput(totals)
+        return {
+            'command': command,
+            'wall_seconds': wall - self.started[0],
+            'cpu_seconds': cpu - self.started[1],
+            'stages': stages,
+        }
+
+    def write(self, path: pathlib.Path, command: str = None):
+        """Write the report as json."""
+        with open(path, 'wb') as fp:
+            fp.write(orjson.dumps(self.report(command), option=orjson.OPT_INDENT_2))
+
+
+class StageTimer:
+    """Times consecutive stages of a record, counted once its resource type is known."""
+
+    def __init__(self, stats: StatsCollector):
+        """Start the clock."""
+        self.stats = stats
+        self.last = clock()
+        """end of the previous stage"""
+        self.laps = []
+        """(stage, started, ended, bytes) not yet counted"""
+
+    def lap(self, stage: str, bytes_: int = 0):
+        """End a stage, it started when the previous one ended."""
+        ended = clock()
+        self.laps.append((stage, self.last, ended, bytes_))
+        self.last = ended
+
+    def restart(self):
+        """Start the next stage now, time since the previous stage is not counted."""
+        self.last = clock()
+
+    def record(self, resource_type: str, records: int = 1):
+        """Count the pending stages for resource_type."""
+        for stage, started, ended, bytes_ in self.laps:
+            self.stats.add(stage, resource_type, started, ended, records, bytes_)
+        self.laps = []
+
+
+class _NullTimer(StageTimer):
+    """A StageTimer that does not read the clocks, when stats are disabled."""
+
+    def __init__(self):
+        """Nothing to count into."""
+        pass
+
+    def lap(self, stage: str, bytes_: int = 0):
+        """Ignored."""
+        pass
+
+    def restart(self):
+        """Ignored."""
+        pass
+
+    def record(self, resource_type: str, records: int = 1):
+        """Ignored."""
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+"""Returned by stage_timer when stats are disabled."""
+
+
+def _stage_order(item) -> tuple:
+    """Sort counters by stage order, then resource type."""
+    (stage, resource_type), _ = item
+    return STAGES.index(stage) if stage in STAGES else len(STAGES), stage, resource_type or ''
+
+
+def _totals(wall: float, cpu: float, records: int, bytes_: int) -> dict:
+    """A report entry."""
+    return {'wall_seconds': wall, 'cpu_seconds': cpu, 'records': records, 'bytes': bytes_, 'resource_types': {}}
+
+
+def _throughput(totals: dict) -> dict:
+    """Add records/sec and bytes/sec, relative to the stage's own wall time."""
+    wall = totals['wall_seconds']
+    totals['records_per_second'] = totals['records'] / wall if wall > 0 else None
+    totals['bytes_per_second'] = totals['bytes'] / wall if wall > 0 and totals['bytes'] else None
+    if not totals['resource_types']:
+        del totals['resource_types']
+    return totals
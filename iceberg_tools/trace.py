@@ -0,0 +1,117 @@
+"""Chrome trace-event spans per file, batch and worker, see `iceberg data --trace-out`.
+
+The written json loads in chrome://tracing or https://ui.perfetto.dev, one track per process and thread.
+Tracing is off unless enabled, `span` is then a no-op. Worker processes record their own spans and
+return a snapshot with their results, merged into the tracer of the parent process.
+"""
+import multiprocessing
+import os
+import pathlib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import orjson
+
+_TRACER: Optional['Tracer'] = None
+"""Tracer of this process, None when disabled."""
+
+
+def tracer() -> Optional['Tracer']:
+    """The active tracer, None if tracing is disabled."""
+    return _TRACER
+
+
+def enable_trace() -> 'Tracer':
+    """Start tracing in this process."""
+    global _TRACER
+    if _TRACER is None:
+        _TRACER = Tracer()
+    return _TRACER
+
+
+def disable_trace():
+    """Stop tracing in this process."""
+    global _TRACER
+    _TRACER = None
+
+
+def init_trace_worker(enabled: bool):
+    """Process pool initializer, trace in the worker if the parent does, dropping spans a forked worker inherited."""
+    global _TRACER
+    _TRACER = Tracer() if enabled else None
+
+
+def trace_snapshot() -> Optional[dict]:
+    """Spans recorded by this process since the last snapshot, None if disabled, see merge_trace."""
+    if _TRACER is None:
+        return None
+    return _TRACER.snapshot()
+
+
+def merge_trace(snapshot: Optional[dict]):
+    """Add a worker's snapshot to this process' tracer."""
+    if _TRACER is not None and snapshot:
+        _TRACER.merge(snapshot)
+
+
+@contextmanager
+def span(name: str, category: str, **args):
+    """Record the enclosed block as a complete event, args are shown in the viewer."""
+    tracer_ = _TRACER
+    if tracer_ is None:
+        yield
+        return
+    started = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        tracer_.add(name, category, started, time.perf_counter_ns(), args)
+
+
+class Tracer:
+    """Complete ('X') trace events, with the names of the processes and threads that recorded them."""
+
+    def __init__(self):
+        """Empty trace."""
+        self.events = []
+        """trace events"""
+        self.threads = {}
+        """(process name, thread name) by (pid, tid)"""
+
+    def add(self, name: str, category: str, started: int, ended: int, args: dict = None):
+        """Record a span, times are perf_counter_ns readings, a clock shared by the processes of a run."""
+        pid = os.getpid()
+        tid = threading.get_ident()
+        if (pid, tid) not in self.threads:
+            self.threads[(pid, tid)] = (multiprocessing.current_process().name, threading.current_thread().name)
+        self.events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': started / 1000, 'dur': (ended - started) / 1000,
+                            'pid': pid, 'tid': tid, 'args': {k: str(v) for k, v in (args or {}).items()}})
+
+    def snapshot(self) -> dict:
+        """Return and reset the recorded spans."""
+        snapshot = {'events': self.events, 'threads': self.threads}
+        self.events = []
+        self.threads = {}
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        """Add spans from another process."""
+        self.events.extend(snapshot['events'])
+        self.threads.update(snapshot['threads'])
+
+    def trace(self) -> dict:
+        """Events in trace-event format, with process and thread name metadata."""
+        metadata = []
+        for pid in sorted({pid for pid, _ in self.threads}):
+            process_name = next(names[0] for (pid_, _), names in self.threads.items() if pid_ == pid)
+            metadata.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': process_name}})
+        for (pid, tid), (_, thread_name) in self.threads.items():
+            metadata.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+        return {'traceEvents': metadata + sorted(self.events, key=lambda _: _['ts']), 'displayTimeUnit': 'ms'}
+
+    def write(self, path: pathlib.Path):
+        """Write the trace json."""
+        with open(path, 'wb') as fp:
+            fp.write(orjson.dumps(self.trace()))
@@ -1,25 +1,59 @@
-import gzip
+import codecs
 import importlib
 import io
+import itertools
+import json
+import multiprocessing
+import os
 import pathlib
+import queue
+import re
+import shutil
+import threading
 from dataclasses import dataclass
-from typing import Dict, Iterator, TextIO
+from multiprocessing.pool import AsyncResult
+from typing import BinaryIO, Dict, Iterator, List, TextIO, Union
 
-import click
 import orjson
+from fhir.resources import fhirtypes
+from fhir.resources.core.fhirabstractmodel import FHIRAbstractModel
 from fhir.resources.fhirresourcemodel import FHIRResourceModel
 from pydantic.v1.error_wrappers import ValidationError
 import logging
 
+from iceberg_tools.data.compression import EXTENSIONS, compression, open_compressed
+from iceberg_tools.data.index import open_index
+from iceberg_tools.stats import clock, collector, init_stats_worker, merge_stats, stats_snapshot
+from iceberg_tools.trace import span
+
 FHIR_CLASSES = importlib.import_module('fhir.resources')
 
 logger = logging.getLogger(__name__)
 
-
-class NaturalOrderGroup(click.Group):
-    """See https://github.com/pallets/click/issues/513."""
-    def list_commands(self, ctx):
-        return self.commands.keys()
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+"""Parallel readers split ndjson files larger than this into byte ranges."""
+COUNT_BUFFER_SIZE = 1024 * 1024
+"""Read size used when counting lines."""
+RESULT_BATCH_SIZE = 1000
+"""Results per batch a parallel reader worker sends to the parent, bounds the memory of both."""
+RESULT_QUEUE_SIZE = 2
+"""Batches buffered per task in flight before its worker blocks."""
+POLL_INTERVAL = 1.0
+"""Seconds between checks that a parallel reader worker is still alive."""
+SNIFF_SIZE = 64 * 1024
+"""A first line longer than this is not sniffed, the file is streamed as a json document, see _read_document."""
+STREAM_READ_SIZE = 1024 * 1024
+"""Read size used when streaming json documents."""
+MERGE_BUFFER_SIZE = 1024 * 1024
+"""Copy buffer size used when merging shards."""
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+"""Buffer size of binary emitter files."""
+WRITE_QUEUE_SIZE = 8
+"""Batches pending on the background writer before emit blocks."""
+SHARD_PATTERN = re.compile(r'^(?P<name>.+?)-(?P<shard>\d{5,})(-(?P<part>\d{5,}))?\.ndjson(?P<suffix>\.gz|\.zst)?$')
+"""`<name>-<shard>.ndjson` or `<name>-<shard>-<part>.ndjson`, optionally compressed, see EmitterContextManager."""
+MANIFEST = 'manifest.json'
+"""Lists the files written per name when output is rotated, see EmitterContextManager."""
 
 
 @dataclass
@@ -39,13 +73,102 @@ class ParseResult:
     """Resource id of resource"""
 
 
-def parse_obj(obj: Dict, validate=True, parse=True) -> ParseResult:
-    """Load a dictionary into a FHIR model """
+_CONSTRUCT_PLANS = {}
+"""Per FHIR model class, how to construct each json property, see construct_obj."""
+
+
+def construct_plan(klass) -> tuple:
+    """Map json property names to (field name, field, model class), model class is None for primitives.
+
+    Polymorphic resources (e.g. Bundle.entry.resource) have model class `Resource`, resolved from each value.
+    """
+    plan = _CONSTRUCT_PLANS.get(klass, None)
+    if plan is None:
+        properties = {}
+        defaults = {}
+        for name, field in klass.__fields__.items():
+            defaults[name] = field.get_default()
+            model_class = None
+            if isinstance(field.type_, type) and issubclass(field.type_, fhirtypes.AbstractType):
+                model_class = FHIR_CLASSES.get_fhir_model_class(field.type_.__resource_type__)
+            elif field.type_ is fhirtypes.ResourceType:
+                model_class = 'Resource'
+            properties[field.alias] = (name, field, model_class)
+        plan = _CONSTRUCT_PLANS[klass] = (properties, defaults)
+    return plan
+
+
+def coerce_primitive(klass, field, value):
+    """Coerce a primitive value (or list of values) of a field, as parse_obj would."""
+    if isinstance(value, str) and issubclass(field.type_, str):
+        # strings are kept as is, other primitives (dates, decimals ...) are coerced
+        return value
+    value, errors = field.validate(value, {}, loc=field.alias, cls=klass)
+    if errors:
+        raise ValidationError([errors], klass)
+    return value
+
+
+def _construct_value(klass, field, model_class, value):
+    """Construct a single value (or list of values) of a field."""
+    if model_class is None:
+        return coerce_primitive(klass, field, value)
+    if isinstance(value, list):
+        return [None if _ is None else _construct_model(model_class, _) for _ in value]
+    return _construct_model(model_class, value)
+
+
+def _construct_model(klass, obj: dict) -> FHIRAbstractModel:
+    """Build a model instance from a json dict, without running validators."""
+    if klass == 'Resource':
+        assert 'resourceType' in obj, "Dict missing `resourceType`, is it a FHIR dict?"
+        klass = FHIR_CLASSES.get_fhir_model_class(obj['resourceType'])
+    properties, defaults = construct_plan(klass)
+    values = dict(defaults)
+    fields_set = set()
+    for key, value in obj.items():
+        if key not in properties or value is None:
+            continue
+        name, field, model_class = properties[key]
+        values[name] = _construct_value(klass, field, model_class, value)
+        fields_set.add(name)
+    model = klass.__new__(klass)
+    object.__setattr__(model, '__dict__', values)
+    object.__setattr__(model, '__fields_set__', fields_set)
+    return model
+
+
+def construct_obj(obj: Dict) -> FHIRResourceModel:
+    """Load a trusted dictionary into a FHIR model, skipping validation.
+
+    Intended for data that has already been validated, unknown properties are dropped.
+    """
+    return _construct_model('Resource', obj)
+
+
+def parse_obj(obj: Dict, validate=True, parse=True, trusted=False) -> ParseResult:
+    """Load a dictionary into a FHIR model, trusted dictionaries are constructed without validation."""
+    stats = collector()
+    if stats is None or not parse:
+        return _parse_obj(obj, validate, parse, trusted)
+    started = clock()
+    parse_result = _parse_obj(obj, validate, parse, trusted)
+    stats.add('parse', obj.get('resourceType', None), started, clock())
+    return parse_result
+
+
+def _parse_obj(obj: Dict, validate=True, parse=True, trusted=False) -> ParseResult:
+    """See parse_obj."""
+    if not parse:
+        # raw dictionary only
+        return ParseResult(object=obj, resource=None, exception=None, path=None, resource_id=obj.get('id', None))
     try:
-        if parse:
-            assert 'resourceType' in obj, "Dict missing `resourceType`, is it a FHIR dict?"
-            klass = FHIR_CLASSES.get_fhir_model_class(obj['resourceType'])
-            _ = klass.parse_obj(obj)
+        if trusted:
+            _ = construct_obj(obj)
+            return ParseResult(object=obj, resource=_, exception=None, path=None, resource_id=_.id)
+        assert 'resourceType' in obj, "Dict missing `resourceType`, is it a FHIR dict?"
+        klass = FHIR_CLASSES.get_fhir_model_class(obj['resourceType'])
+        _ = klass.parse_obj(obj)
         if validate:
             # trigger object traversal, see monkey patch below, at bottom of file
             _.dict()
@@ -54,31 +177,58 @@ def parse_obj(obj: Dict, validate=True, parse=True) -> ParseResult:
         return ParseResult(object=obj, resource=None, exception=e, path=None, resource_id=obj.get('id', None))
 
 
-def _is_ndjson(file_path: pathlib.Path) -> bool:
-    """Open file, read all lines as json."""
-    fp = _to_file(file_path)
+def _is_ndjson_line(first_line: bytes) -> bool:
+    """True if the first line of a file is a complete json document, an empty file counts as ndjson."""
+    if not first_line:
+        return True
     try:
-        with fp:
-            for line in fp.readlines():
-                orjson.loads(line)
-                break
+        orjson.loads(first_line)
         return True
     except Exception as e:  # noqa
         return False
 
 
-def _to_file(file_path):
-    """Open file appropriately."""
-    if file_path.name.endswith('gz'):
-        fp = io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(file_path)))  # noqa
+def sniff_first_line(fp) -> bytes:
+    """Sniff the format of a file, return its first line if it is ndjson, None if it holds a single json document.
+
+    A first line longer than SNIFF_SIZE (e.g. a minified Bundle) is not read in full, None is returned,
+    the streaming document reader reads any lines that follow the first value as ndjson.
+    """
+    line = fp.readline(SNIFF_SIZE)
+    if len(line) == SNIFF_SIZE and not line.endswith(b'\n'):
+        return None
+    if _is_ndjson_line(line):
+        return line
+    return None
+
+
+def _is_ndjson(file_path: pathlib.Path) -> bool:
+    """Open file, read the first line as json."""
+    with open_file(file_path) as fp:
+        return sniff_first_line(fp) is not None
+
+
+def open_file(file_path):
+    """Open an input file as a buffered binary stream, gzip and zstd files are decompressed."""
+    if compression(file_path.name) is not None:
+        fp = open_compressed(file_path, "rb")
     else:
         fp = open(file_path, "rb")
     return fp
 
 
+def ndjson_lines(fp) -> Iterator[bytes]:
+    """Stream the lines of a binary file, blank lines are yielded as None to preserve line offsets."""
+    for line in fp:
+        if not line.strip():
+            yield None
+            continue
+        yield line
+
+
 def _is_json_file(name: str) -> bool:
     """Files we are interested in"""
-    if name.endswith('json.gz'):
+    if name.endswith('json.gz') or name.endswith('json.zst'):
         return True
     if name.endswith('json'):
         return True
@@ -113,12 +263,512 @@ def _entry_iterator(parse_result: ParseResult) -> Iterator[ParseResult]:
     pass
 
 
+def parse_ndjson_lines(lines: Iterator[bytes], input_file: pathlib.Path, offset: int = 0,
+                       parse=True, validate=True, trusted=False, reads=True) -> Iterator[ParseResult]:
+    """Parse ndjson lines, `offset` is the line number of the first line.
+
+    `reads` counts the time spent reading lines, False when they were read and counted by the caller.
+    """
+    if collector() is not None:
+        for _ in _parse_ndjson_lines_stats(lines, input_file, offset, parse=parse, validate=validate, trusted=trusted, reads=reads):
+            yield _
+        return
+    for line in lines:
+        if line is None:
+            offset += 1
+            continue
+        for _ in _parse_document(orjson.loads(line), input_file, offset, parse=parse, validate=validate, trusted=trusted):
+            yield _
+        offset += 1
+
+
+def _parse_ndjson_lines_stats(lines: Iterator[bytes], input_file: pathlib.Path, offset: int = 0,
+                              parse=True, validate=True, trusted=False, reads=True) -> Iterator[ParseResult]:
+    """parse_ndjson_lines, counting read and decode time."""
+    stats = collector()
+    lines = iter(lines)
+    while True:
+        started = clock()
+        line = next(lines, b'')
+        if line == b'':
+            return
+        if line is None:
+            offset += 1
+            continue
+        read = clock()
+        obj = orjson.loads(line)
+        decoded = clock()
+        resource_type = obj.get('resourceType', None) if isinstance(obj, dict) else None
+        if reads:
+            stats.add('read', resource_type, started, read, bytes_=len(line))
+        stats.add('decode', resource_type, read, decoded, bytes_=len(line))
+        for _ in _parse_document(obj, input_file, offset, parse=parse, validate=validate, trusted=trusted):
+            yield _
+        offset += 1
+
+
+def _parse_entry(entry: dict, input_file: pathlib.Path, offset: int, parse=True, validate=True, trusted=False) -> ParseResult:
+    """Parse the resource of a Bundle.entry, offset is the entry's index."""
+    parse_result = parse_obj(entry.get('resource', {}), validate=validate, parse=parse, trusted=trusted)
+    parse_result.path = input_file
+    parse_result.offset = offset
+    return parse_result
+
+
+def _parse_document(document: dict, input_file: pathlib.Path, offset: int = 0,
+                    parse=True, validate=True, trusted=False) -> Iterator[ParseResult]:
+    """Parse a decoded json document, each Bundle entry is parsed on its own."""
+    if document.get('resourceType', None) == 'Bundle' and isinstance(document.get('entry', None), list):
+        for index, entry in enumerate(document['entry']):
+            yield _parse_entry(entry, input_file, index, parse=parse, validate=validate, trusted=trusted)
+        return
+    parse_result = parse_obj(document, validate=validate, parse=parse, trusted=trusted)
+    parse_result.path = input_file
+    parse_result.offset = offset
+    for _ in _entry_iterator(parse_result):
+        yield _
+
+
+def _read_file(input_file: pathlib.Path, parse=True, validate=True, trusted=False) -> Iterator[ParseResult]:
+    """Extract FHIR resources from a single ndjson or json file."""
+    logger.info(input_file)
+    with open_file(input_file) as fp:
+        # sniff the format from the first line, then continue reading the same stream
+        first_line = sniff_first_line(fp)
+        if first_line is not None:
+            lines = ndjson_lines(itertools.chain([first_line], fp))
+            for _ in parse_ndjson_lines(lines, input_file, parse=parse, validate=validate, trusted=trusted):
+                yield _
+        else:
+            # look for json bundles, stream their entries
+            fp.seek(0)
+            for _ in _read_document(fp, input_file, parse=parse, validate=validate, trusted=trusted):
+                yield _
+
+
+class JSONStream:
+    """Decode json values one at a time from a binary stream, holding only the unread part of the current value."""
+
+    def __init__(self, fp, read_size: int = None):
+        """Wrap a binary file."""
+        self.fp = fp
+        self.read_size = read_size or STREAM_READ_SIZE
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.reads = [0.0, 0.0, 0] if collector() is not None else None
+        """wall time, cpu time and bytes of file reads, counted when stats are enabled"""
+
+    def _fill(self) -> bool:
+        """Append the next block to the buffer, reads grow with the pending value, False at end of file."""
+        if self.eof:
+            return False
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        if self.reads is None:
+            block = self.fp.read(max(self.read_size, len(self.buffer)))
+        else:
+            started = clock()
+            block = self.fp.read(max(self.read_size, len(self.buffer)))
+            ended = clock()
+            self.reads[0] += ended[0] - started[0]
+            self.reads[1] += ended[1] - started[1]
+            self.reads[2] += len(block)
+        self.buffer += self.decoder.decode(block, final=not block)
+        if not block:
+            self.eof = True
+        return True
+
+    def take_reads(self) -> list:
+        """Return and reset the read counters."""
+        reads = self.reads
+        self.reads = [0.0, 0.0, 0]
+        return reads
+
+    def peek(self) -> str:
+        """Skip whitespace, return the next character, '' at end of file."""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\n\r':
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters: str) -> str:
+        """Consume the next character, it must be one of `characters`."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise json.JSONDecodeError(f"Expecting one of {characters!r}", self.buffer, self.position)
+        self.position += 1
+        return character
+
+    def lines(self) -> Iterator[bytes]:
+        """The unread rest of the stream as binary lines, starting with the rest of the current line."""
+        pending, _ = self.decoder.getstate()
+        head = io.BytesIO(self.buffer[self.position:].encode() + pending).readlines()
+        self.buffer = ''
+        self.position = 0
+        if head and not head[-1].endswith(b'\n') and not self.eof:
+            head[-1] += self.fp.readline()
+        for _ in head:
+            yield _
+        if not self.eof:
+            for _ in self.fp:
+                yield _
+        self.eof = True
+
+    def value(self):
+        """Decode the next value, reading more of the stream until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+                # a number at the end of the buffer may continue in the next block
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def _read_document(fp, input_file: pathlib.Path, parse=True, validate=True, trusted=False) -> Iterator[ParseResult]:
+    """Extract FHIR resources from a single json document.
+
+    Bundle entries are decoded and parsed one at a time as the stream is read,
+    any other document (or a Bundle whose resourceType follows its entries) is parsed whole.
+    Anything after the first value is read as ndjson, the first value being line 0.
+    """
+    stream = JSONStream(fp)
+    started = clock() if stream.reads is not None else None
+    stream.expect('{')
+    document = {}
+    streamed = False
+    if stream.peek() == '}':
+        stream.expect('}')
+    else:
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'entry' and document.get('resourceType', None) == 'Bundle' and stream.peek() == '[':
+                streamed = True
+                for _ in _read_bundle_entries(stream, input_file, parse=parse, validate=validate, trusted=trusted):
+                    yield _
+            else:
+                document[key] = stream.value()
+            if stream.expect(',}') == '}':
+                break
+    if not streamed:
+        # not a bundle
+        if started is not None:
+            _count_reads(stream, document.get('resourceType', None), started, clock())
+        for _ in _parse_document(document, input_file, parse=parse, validate=validate, trusted=trusted):
+            yield _
+    # values after the first are ndjson lines, the first line was too long to sniff
+    for _ in parse_ndjson_lines(ndjson_lines(stream.lines()), input_file, parse=parse, validate=validate, trusted=trusted):
+        yield _
+
+
+def _read_bundle_entries(stream: JSONStream, input_file: pathlib.Path, parse=True, validate=True, trusted=False) -> Iterator[ParseResult]:
+    """Parse the elements of a Bundle.entry array, offset is the entry's index."""
+    stream.expect('[')
+    if stream.peek() == ']':
+        stream.expect(']')
+        return
+    offset = 0
+    # reads before the entries are counted with the first entry
+    earlier = stream.take_reads() if stream.reads is not None else None
+    while True:
+        if stream.reads is None:
+            entry = stream.value()
+        else:
+            started = clock()
+            entry = stream.value()
+            resource = entry.get('resource', None) if isinstance(entry, dict) else None
+            resource_type = resource.get('resourceType', None) if isinstance(resource, dict) else None
+            _count_reads(stream, resource_type, started, clock(), earlier)
+            earlier = None
+        yield _parse_entry(entry, input_file, offset, parse=parse, validate=validate, trusted=trusted)
+        offset += 1
+        if stream.expect(',]') == ']':
+            break
+
+
+def _count_reads(stream: JSONStream, resource_type: str, started: tuple, ended: tuple, earlier: list = None):
+    """Split the time between started and ended into the stream's reads and decoding, adding `earlier` reads."""
+    stats = collector()
+    wall, cpu, bytes_ = stream.take_reads()
+    stats.add('decode', resource_type, (started[0] + wall, started[1] + cpu), ended, bytes_=bytes_)
+    if earlier:
+        wall, cpu, bytes_ = wall + earlier[0], cpu + earlier[1], bytes_ + earlier[2]
+    stats.add('read', resource_type, (0.0, 0.0), (wall, cpu), bytes_=bytes_)
+
+
+def _range_lines(fp, start: int, end: int) -> Iterator[bytes]:
+    """Lines of a binary file that start within [start, end), start must be newline aligned."""
+    fp.seek(start)
+    position = start
+    while position < end:
+        line = fp.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line
+
+
+def _read_range(input_file: pathlib.Path, start: int, end: int, offset: int,
+                parse=True, validate=True, trusted=False) -> Iterator[ParseResult]:
+    """Extract FHIR resources from a newline aligned byte range of an ndjson file."""
+    with open(input_file, "rb") as fp:
+        for _ in parse_ndjson_lines(ndjson_lines(_range_lines(fp, start, end)), input_file, offset, parse=parse, validate=validate, trusted=trusted):
+            yield _
+
+
+@dataclass
+class ReadTask:
+    """Unit of work for the parallel reader, a whole file or a byte range of an ndjson file."""
+    path: pathlib.Path
+    """Source file."""
+    start: int = 0
+    """Byte offset of the first line in the range."""
+    end: int = None
+    """Byte offset past the last line in the range, None reads the whole file."""
+    offset: int = 0
+    """Base 0 line number of the first line in the range."""
+    size: int = 0
+    """Number of bytes to read, used for scheduling."""
+
+
+def read_task(task: ReadTask, parse=True, validate=True, trusted=False) -> Iterator[ParseResult]:
+    """Extract FHIR resources from a whole file or a byte range."""
+    if task.end is None:
+        return _read_file(task.path, parse=parse, validate=validate, trusted=trusted)
+    return _read_range(task.path, task.start, task.end, task.offset, parse=parse, validate=validate, trusted=trusted)
+
+
+_RESULT_QUEUES = None
+"""Queues a parallel reader worker puts results on, see _init_reader_worker."""
+
+
+def _init_reader_worker(queues: list, pids, stats: bool):
+    """Process pool initializer, the result queues are inherited by the worker."""
+    global _RESULT_QUEUES
+    _RESULT_QUEUES = queues
+    PoolWorkers.register(pids)
+    init_stats_worker(stats)
+
+
+class PoolWorkers:
+    """Pids of a process pool's workers, to notice one exiting mid task, e.g. killed when out of memory.
+
+    The pool dies silently with such a worker's task, its result never arrives.
+    Workers register from the pool initializer, see `register`.
+    """
+
+    def __init__(self, name: str):
+        """No workers yet, name is used in errors."""
+        self.name = name
+        self.queue = multiprocessing.Queue()
+        """workers put their pid here, pass it to the pool initializer"""
+        self.pids = set()
+        """registered workers"""
+
+    @staticmethod
+    def register(queue_):
+        """Called by a worker, with the queue of its PoolWorkers."""
+        queue_.put(os.getpid())
+
+    def check(self):
+        """Raise RuntimeError if a worker exited, pool workers only exit when the pool is closed."""
+        while True:
+            try:
+                self.pids.add(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        exited = self.pids - {_.pid for _ in multiprocessing.active_children()}
+        if exited:
+            raise RuntimeError(f"{self.name} worker {sorted(exited)} exited, the results of its task are lost")
+
+
+def _read_task_batches(index: int, slot: int, task: ReadTask, parse: bool, validate: bool, trusted: bool):
+    """Process pool worker, put the results of a task on a result queue in batches.
+
+    Messages are (index, kind, value), kind is 'batch' with a list of results,
+    or 'done' with the stats collected meanwhile, sent even if reading fails.
+    """
+    queue_ = _RESULT_QUEUES[slot]
+    try:
+        batch = []
+        for _ in read_task(task, parse=parse, validate=validate, trusted=trusted):
+            batch.append(_)
+            if len(batch) == RESULT_BATCH_SIZE:
+                queue_.put((index, 'batch', batch))
+                batch = []
+        if batch:
+            queue_.put((index, 'batch', batch))
+    finally:
+        queue_.put((index, 'done', stats_snapshot()))
+
+
+def _queued_results(queue_, results: Dict[int, AsyncResult], workers: PoolWorkers) -> Iterator[ParseResult]:
+    """Yield the batches put on a result queue until each task in results is done.
+
+    A worker's exception is raised once its task is done, a worker that exits mid task raises RuntimeError.
+    """
+    while results:
+        try:
+            index, kind, value = queue_.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            workers.check()
+            continue
+        if kind == 'batch':
+            for _ in value:
+                yield _
+        else:
+            merge_stats(value)
+            results.pop(index).get()
+
+
+def _count_lines(args: tuple) -> int:
+    """Process pool worker, count newlines in a byte range."""
+    path, start, end = args
+    count = 0
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            buffer = fp.read(min(COUNT_BUFFER_SIZE, remaining))
+            if not buffer:
+                break
+            count += buffer.count(b'\n')
+            remaining -= len(buffer)
+    return count
+
+
+def _split_points(path: pathlib.Path, size: int, chunk_size: int) -> List[int]:
+    """Newline aligned byte offsets that split a file into ranges of roughly chunk_size bytes."""
+    points = [0]
+    with open(path, "rb") as fp:
+        target = chunk_size
+        while target < size:
+            fp.seek(target - 1)
+            # the line containing target - 1 ends the previous range
+            fp.readline()
+            point = fp.tell()
+            if point >= size:
+                break
+            if point > points[-1]:
+                points.append(point)
+            target = point + chunk_size
+    points.append(size)
+    return points
+
+
+def plan_read_tasks(input_files: List[pathlib.Path], chunk_size: int, pool) -> List[ReadTask]:
+    """Split large, uncompressed ndjson files into byte ranges, other files are read whole.
+
+    Files with a fresh sidecar index are split using it, otherwise the lines of each range are counted.
+    """
+    tasks = []
+    ranges = []
+    for input_file in input_files:
+        size = input_file.stat().st_size
+        if chunk_size is None or size <= chunk_size or compression(input_file.name) is not None:
+            tasks.append(ReadTask(path=input_file, size=size))
+            continue
+        index = open_index(input_file)
+        if index is not None:
+            # exact split points and line numbers from the sidecar index
+            with index:
+                tasks.extend([ReadTask(path=input_file, start=start, end=end, offset=offset, size=end - start)
+                              for start, end, offset in index.split_points(chunk_size)])
+            continue
+        if not _is_ndjson(input_file):
+            tasks.append(ReadTask(path=input_file, size=size))
+            continue
+        points = _split_points(input_file, size, chunk_size)
+        file_ranges = [ReadTask(path=input_file, start=start, end=end, size=end - start)
+                       for start, end in zip(points[:-1], points[1:])]
+        tasks.extend(file_ranges)
+        ranges.extend(file_ranges)
+
+    # line numbers of each range, counted in parallel
+    counts = pool.map(_count_lines, [(_.path, _.start, _.end) for _ in ranges], chunksize=1)
+    offset = 0
+    previous_path = None
+    for task, count in zip(ranges, counts):
+        if task.path != previous_path:
+            offset = 0
+            previous_path = task.path
+        task.offset = offset
+        offset += count
+    return tasks
+
+
+def find_input_files(directory_path: pathlib.Path, pattern: str, ignore_path: str = None) -> List[pathlib.Path]:
+    """Json, ndjson and compressed json files matching pattern, in glob order, skipping paths containing ignore_path."""
+    input_files = []
+    for input_file in directory_path.glob(pattern):
+        if not _is_json_file(input_file.name):
+            continue
+        if ignore_path is not None and ignore_path in str(input_file):
+            continue
+        if not input_file.is_file():
+            continue
+        input_files.append(input_file)
+    return input_files
+
+
+def _parallel_reader(input_files: List[pathlib.Path], parse: bool, validate: bool, trusted: bool,
+                     workers: int, ordered: bool, chunk_size: int) -> Iterator[ParseResult]:
+    """Read files across a process pool.
+
+    Large ndjson files are split into byte ranges, idle workers pull the next task from the pool's shared queue.
+    Workers send results in batches over bounded queues, so memory does not grow with the size of a task,
+    e.g. a compressed file or a Bundle, which are read whole.
+    When ordered, each of the tasks in flight has its own queue, consumed in task order.
+    When unordered, the largest tasks are scheduled first so the last worker is not left with a long tail,
+    all tasks share one queue.
+    """
+    slots = 2 * workers if ordered else 1
+    queues = [multiprocessing.Queue(RESULT_QUEUE_SIZE * (1 if ordered else workers)) for _ in range(slots)]
+    reader_workers = PoolWorkers('Reader')
+    with multiprocessing.Pool(processes=workers, initializer=_init_reader_worker,
+                              initargs=(queues, reader_workers.queue, collector() is not None)) as pool:
+        tasks = plan_read_tasks(input_files, chunk_size, pool)
+        if not ordered:
+            tasks = sorted(tasks, key=lambda _: _.size, reverse=True)
+
+        def _submit(index: int) -> AsyncResult:
+            return pool.apply_async(_read_task_batches, (index, index % slots, tasks[index], parse, validate, trusted))
+
+        if not ordered:
+            for _ in _queued_results(queues[0], {index: _submit(index) for index in range(len(tasks))}, reader_workers):
+                yield _
+            return
+        # a slot's queue is reused once its task is consumed
+        results = {index: _submit(index) for index in range(min(slots, len(tasks)))}
+        for index in range(len(tasks)):
+            for _ in _queued_results(queues[index % slots], {index: results.pop(index)}, reader_workers):
+                yield _
+            if index + slots < len(tasks):
+                results[index + slots] = _submit(index + slots)
+
+
 def directory_reader(
         directory_path: pathlib.Path,
         pattern: str = '*.*',
         parse=True,
         validate=True,
-        ignore_path: str = None) -> Iterator[ParseResult]:
+        ignore_path: str = None,
+        workers: int = None,
+        ordered: bool = True,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        trusted: bool = False) -> Iterator[ParseResult]:
     """Extract FHIR resources from directory
 
     Args:
@@ -127,51 +777,92 @@ def directory_reader(
         parse (bool, optional): parse FHIR resources. Defaults to True.
         validate (bool, optional): validate FHIR resources. Defaults to True.
         ignore_path (str, optional): ignore files with this string in path. Defaults to None.
+        workers (int, optional): number of worker processes, None or 1 reads serially. Defaults to None.
+        ordered (bool, optional): when parallel, yield results in file order. Defaults to True.
+        chunk_size (int, optional): when parallel, split ndjson files larger than this many bytes into ranges. Defaults to 64MB.
+        trusted (bool, optional): construct FHIR resources without validation, for data already validated. Defaults to False.
     """
 
     assert directory_path.is_dir(), f"{directory_path.name} is not a directory"
 
-    input_files = [_ for _ in directory_path.glob(pattern) if _is_json_file(_.name)]
+    input_files = find_input_files(directory_path, pattern, ignore_path)
+
+    if workers is not None and workers > 1:
+        for _ in _parallel_reader(input_files, parse, validate, trusted, workers, ordered, chunk_size):
+            yield _
+        return
+
     for input_file in input_files:
-        if ignore_path is not None and ignore_path in str(input_file):
-            continue
-        logger.info(input_file)
-        if not input_file.is_file():
-            continue
-        is_ndjson = _is_ndjson(input_file)
-        fp = _to_file(input_file)
-        with fp:
-            if is_ndjson:
-                offset = 0
-                for line in fp.readlines():
-                    parse_result = parse_obj(orjson.loads(line), validate=validate, parse=parse)
-                    parse_result.path = input_file
-                    parse_result.offset = offset
-                    for _ in _entry_iterator(parse_result):
-                        # print(_.offset, 'is_ndjson', input_file, parse_result.resource.id, parse_result.resource.resource_type)
-                        yield _
-                    offset += 1
-            else:
-                # look for json bundles
-                _ = orjson.loads(fp.read())
-                # not a bundle
-                parse_result = parse_obj(_, validate)
-                parse_result.path = input_file
-                parse_result.offset = 0
-                for _ in _entry_iterator(parse_result):
-                    yield _
-                continue
+        with span('file', 'read', path=input_file):
+            for _ in _read_file(input_file, parse=parse, validate=validate, trusted=trusted):
+                yield _
+
+
+class _BackgroundWriter:
+    """File like, collects bytes into batches, a writer thread writes and closes the underlying file."""
+
+    def __init__(self, fp: BinaryIO, queue_: queue.Queue, batch_size: int):
+        """Wrap a binary file."""
+        self.fp = fp
+        self.name = fp.name
+        self.queue = queue_
+        self.batch_size = batch_size
+        self.batch = []
+        self.size = 0
+        self.position = 0
+
+    def tell(self) -> int:
+        """Bytes written so far, including the pending batch."""
+        return self.position
+
+    def write(self, data: bytes) -> int:
+        """Add data to the batch, hand the batch to the writer thread once full."""
+        self.batch.append(data)
+        self.size += len(data)
+        self.position += len(data)
+        if self.size >= self.batch_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        """Hand the pending batch to the writer thread."""
+        if self.batch:
+            self.queue.put((self.fp, b''.join(self.batch)))
+            self.batch = []
+            self.size = 0
+
+    def close(self):
+        """Flush, the writer thread closes the file."""
+        self.flush()
+        self.queue.put((self.fp, None))
 
 
 class EmitterContextManager:
     """Maintain file pointers to output directory."""
 
-    def __init__(self, output_path: str, verbose=False, file_mode="w"):
-        """Ensure output_path exists, init emitter dict."""
+    def __init__(self, output_path: str, verbose=False, file_mode="w", shard: int = None,
+                 binary: bool = False, buffer_size: int = WRITE_BUFFER_SIZE, background: bool = False,
+                 max_bytes: int = None, max_records: int = None, compression: str = None):
+        """Ensure output_path exists, init emitter dict, if shard is set files are named `<name>-<shard>.ndjson`.
+
+        binary files accept bytes (e.g. from orjson.dumps) and use a buffer of buffer_size bytes,
+        if background is set, buffers are written by a writer thread so serialization and disk I/O overlap.
+        If max_bytes or max_records is set, output rotates to a new `<name>-<part>.ndjson` file
+        (`<name>-<shard>-<part>.ndjson` if sharded) once the current file is full, emit must be called once per record,
+        the files and their record counts are listed in `manifest.json` (`manifest-<shard>.json` if sharded).
+        With compression (gzip or zstd), files are named `<name>.ndjson.gz` or `<name>.ndjson.zst`,
+        max_bytes then counts uncompressed bytes.
+        """
         output_path = pathlib.Path(output_path)
         if not output_path.exists():
             output_path.mkdir(parents=True)
         assert output_path.is_dir(), f"{output_path} not a directory?"
+        assert binary or not background, "background writer requires binary"
+        assert binary or max_bytes is None, "max_bytes requires binary"
+        assert max_bytes is None or max_bytes > 0, "max_bytes should be positive"
+        assert max_records is None or max_records > 0, "max_records should be positive"
+        assert compression is None or compression in EXTENSIONS, f"compression should be one of {list(EXTENSIONS)}"
+        assert binary or compression is None, "compression requires binary"
 
         self.output_path = output_path
         """destination directory"""
@@ -181,6 +872,50 @@ class EmitterContextManager:
         """log activity"""
         self.file_mode = file_mode
         """mode for file opens"""
+        self.shard = shard
+        """shard number, see merge_shards"""
+        self.binary = binary
+        """files are opened in binary mode"""
+        self.buffer_size = buffer_size
+        """binary file buffer size, background writer batch size"""
+        self.max_bytes = max_bytes
+        """rotate once a file holds this many bytes"""
+        self.max_records = max_records
+        """rotate once a file holds this many records"""
+        self.compression = compression
+        """gzip, zstd or None"""
+        self.files = {}
+        """[file name, record count] of each file written, by name"""
+        self.queue = None
+        """pending (file, bytes) writes of the background writer"""
+        self.writer = None
+        """background writer thread"""
+        self.writer_exception = None
+        """first exception raised by the background writer"""
+        if background:
+            self.queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+            self.writer = threading.Thread(target=self._write, name='emitter-writer', daemon=True)
+            self.writer.start()
+
+    @property
+    def rotates(self) -> bool:
+        """Output is rotated by size or record count."""
+        return self.max_bytes is not None or self.max_records is not None
+
+    def _write(self):
+        """Background writer, write batches until a None item."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            fp, data = item
+            try:
+                if data is None:
+                    fp.close()
+                elif self.writer_exception is None:
+                    fp.write(data)
+            except Exception as e:  # noqa
+                self.writer_exception = self.writer_exception or e
 
     def __enter__(self):
         """Ensure output_path exists, init emitter dict.
@@ -188,16 +923,153 @@ class EmitterContextManager:
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
-        """Close all open files."""
+        """Close all open files, write the manifest if output was rotated."""
         for _ in self.emitters.values():
             _.close()
             if self.verbose:
                 logger.info(f"wrote {_.name}")
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+            if self.writer_exception is not None and exc_type is None:
+                raise self.writer_exception
+        if self.rotates and exc_type is None:
+            self.write_manifest()
 
-    def emit(self, name: str) -> TextIO:
-        """Maintain a hash of open files."""
-        if name not in self.emitters:
-            self.emitters[name] = open(self.output_path / f"{name}.ndjson", self.file_mode)
-            if self.verbose:
-                logger.debug(f"opened {self.emitters[name].name}")
-        return self.emitters[name]
+    def manifest(self) -> Dict[str, List[dict]]:
+        """Files written by name, with their record counts."""
+        return {name: [{'path': file_name, 'count': count} for file_name, count in files]
+                for name, files in sorted(self.files.items())}
+
+    def write_manifest(self) -> pathlib.Path:
+        """Write the manifest, `manifest.json` or `manifest-<shard>.json` if sharded."""
+        path = self.output_path / (MANIFEST if self.shard is None else manifest_name(self.shard))
+        with open(path, 'wb') as fp:
+            fp.write(orjson.dumps(self.manifest(), option=orjson.OPT_INDENT_2))
+        return path
+
+    def _file_name(self, name: str) -> str:
+        """File name of the next file of name."""
+        suffix = EXTENSIONS.get(self.compression, '')
+        if not self.rotates:
+            return f"{name}.ndjson{suffix}" if self.shard is None else shard_name(name, self.shard, suffix=suffix)
+        part = len(self.files.get(name, []))
+        if self.shard is None:
+            return shard_name(name, part, suffix=suffix)
+        return shard_name(name, self.shard, part, suffix=suffix)
+
+    def _open(self, name: str) -> Union[TextIO, BinaryIO]:
+        """Open the next file of name."""
+        file_name = self._file_name(name)
+        if self.binary:
+            file_mode = self.file_mode if 'b' in self.file_mode else self.file_mode + 'b'
+            if self.compression is not None:
+                fp = open_compressed(self.output_path / file_name, file_mode, buffer_size=self.buffer_size)
+            else:
+                fp = open(self.output_path / file_name, file_mode, buffering=self.buffer_size)
+            if self.writer is not None:
+                fp = _BackgroundWriter(fp, self.queue, self.buffer_size)
+        else:
+            fp = open(self.output_path / file_name, self.file_mode)
+        self.files.setdefault(name, []).append([file_name, 0])
+        if self.verbose:
+            logger.debug(f"opened {fp.name}")
+        return fp
+
+    def _is_full(self, name: str) -> bool:
+        """The current file of name reached max_records or max_bytes."""
+        if self.max_records is not None and self.files[name][-1][1] >= self.max_records:
+            return True
+        return self.max_bytes is not None and self.emitters[name].tell() >= self.max_bytes
+
+    def emit(self, name: str) -> Union[TextIO, BinaryIO]:
+        """Maintain a hash of open files, rotate full files."""
+        fp = self.emitters.get(name, None)
+        if fp is None:
+            fp = self.emitters[name] = self._open(name)
+        elif self.rotates and self._is_full(name):
+            fp.close()
+            fp = self.emitters[name] = self._open(name)
+        self.files[name][-1][1] += 1
+        return fp
+
+
+def shard_name(name: str, shard: int, part: int = None, suffix: str = '') -> str:
+    """File name of one shard of `<name>.ndjson`, or of one part of a shard, suffix is the compression extension."""
+    if part is None:
+        return f"{name}-{shard:05d}.ndjson{suffix}"
+    return f"{name}-{shard:05d}-{part:05d}.ndjson{suffix}"
+
+
+def manifest_name(shard: int) -> str:
+    """File name of the manifest of one shard."""
+    return f"manifest-{shard:05d}.json"
+
+
+def read_manifest(output_path: pathlib.Path) -> Dict[str, List[pathlib.Path]]:
+    """Output files by name, in order, from `manifest.json` if present, otherwise the `<name>.ndjson[.gz|.zst]` files."""
+    output_path = pathlib.Path(output_path)
+    manifest_path = output_path / MANIFEST
+    if manifest_path.is_file():
+        manifest = orjson.loads(manifest_path.read_bytes())
+        return {name: [output_path / _['path'] for _ in files] for name, files in manifest.items()}
+    files = {}
+    for path in sorted(output_path.glob('*.ndjson*')):
+        if not path.name.endswith('.ndjson') and compression(path.name) is None:
+            continue
+        name = path.name.split('.ndjson')[0]
+        assert name not in files, f"{files[name][0].name} and {path.name} are both in {output_path}, expected one file per name"
+        files[name] = [path]
+    return files
+
+
+def merge_shards(output_path: pathlib.Path) -> Dict[str, int]:
+    """Concatenate `<name>-<shard>.ndjson` files into `<name>.ndjson`, in shard order, remove the shards.
+
+    Compressed shards are concatenated as is, gzip members and zstd frames decompress as one stream.
+
+    Rotated shards (listed in `manifest-<shard>.json`) are not concatenated, they are renamed to
+    `<name>-<part>.ndjson` in shard order and listed in `manifest.json`.
+    Returns the number of shards merged per name.
+    """
+    output_path = pathlib.Path(output_path)
+    manifest_paths = sorted(output_path.glob('manifest-*.json'))
+    if manifest_paths:
+        return _renumber_shards(output_path, manifest_paths)
+    shards = {}
+    for path in output_path.glob('*-*.ndjson*'):
+        match = SHARD_PATTERN.match(path.name)
+        if match and match.group('part') is None:
+            name = f"{match.group('name')}.ndjson{match.group('suffix') or ''}"
+            shards.setdefault(name, []).append((int(match.group('shard')), path))
+    for name, paths in shards.items():
+        with open(output_path / name, "wb") as fp:
+            for _, path in sorted(paths):
+                with open(path, "rb") as shard_fp:
+                    shutil.copyfileobj(shard_fp, fp, MERGE_BUFFER_SIZE)
+                path.unlink()
+        logger.info(f"merged {len(paths)} shards into {name}")
+    return {name.split('.ndjson')[0]: len(paths) for name, paths in shards.items()}
+
+
+def _renumber_shards(output_path: pathlib.Path, manifest_paths: List[pathlib.Path]) -> Dict[str, int]:
+    """Rename rotated shard files to `<name>-<part>.ndjson`, in shard order, combine their manifests."""
+    files = {}
+    # manifest-<shard>.json sort in shard order, files are listed in part order
+    for manifest_path in manifest_paths:
+        for name, entries in orjson.loads(manifest_path.read_bytes()).items():
+            files.setdefault(name, []).extend(entries)
+    manifest = {}
+    for name, entries in sorted(files.items()):
+        manifest[name] = []
+        for part, entry in enumerate(entries):
+            file_name = shard_name(name, part, suffix=EXTENSIONS.get(compression(entry['path']), ''))
+            (output_path / entry['path']).rename(output_path / file_name)
+            manifest[name].append({'path': file_name, 'count': entry['count']})
+        logger.info(f"renamed {len(entries)} shards of {name}")
+    with open(output_path / MANIFEST, 'wb') as fp:
+        fp.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+    for manifest_path in manifest_paths:
+        manifest_path.unlink()
+    return {name: len(entries) for name, entries in manifest.items()}
@@ -90,3 +90,18 @@ def test_schema_link_writer_nested():
         assert specimen_schema['links'] is not None, "Links should be added to specimen"
         assert specimen_schema['properties']['links'] is not None, "Links should be added to specimen properties"
         assert 'links' not in specimen_schema['properties']['links'], "Links should not be double nested"
+
+
+def test_schema_link_writer_memoized(monkeypatch):
+    """Nested schemas and their links are extracted once, each schema gets its own copy of the links."""
+    from iceberg_tools import graph
+
+    classes = [Specimen, Patient]
+    with SchemaLinkWriter() as mgr:
+        expected = mgr.insert_links(extract_schemas([Specimen], BASE_URI)['Specimen'], classes)
+        nested_links = [_ for _ in expected['links'] if '$comment' in _]
+        monkeypatch.setattr(graph, 'extract_schemas', None)
+        monkeypatch.setattr(graph, '_extract_links', lambda schema, classes_: [])
+        specimen_schema = mgr.insert_links(extract_schemas([Specimen], BASE_URI)['Specimen'], classes)
+    assert nested_links and specimen_schema['links'] == nested_links, "Nested links should come from the cache"
+    assert specimen_schema['links'][0] is not nested_links[0], "Cached links should be copied"
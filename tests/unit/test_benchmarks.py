@@ -0,0 +1,43 @@
+import subprocess
+import sys
+
+import orjson
+
+from benchmarks import renderers, startup
+from benchmarks.generator import RESOURCE_TYPES, Study, write_bundles, write_ndjson
+from iceberg_tools.util import parse_obj
+
+
+def test_generator(tmp_path):
+    """Generated resources are valid FHIR, deterministic, and only reference generated resources."""
+    study = Study(500)
+    counts = write_ndjson(study, tmp_path / 'ndjson')
+    assert sum(counts.values()) == len(study) and list(counts) == RESOURCE_TYPES
+    assert write_bundles(study, tmp_path / 'bundles', bundle_size=100) == -(-len(study) // 100)
+
+    resources = [orjson.loads(line) for _ in RESOURCE_TYPES for line in (tmp_path / 'ndjson' / f"{_}.ndjson").read_bytes().splitlines()]
+    keys = {f"{_['resourceType']}/{_['id']}" for _ in resources}
+    for resource in resources:
+        assert parse_obj(resource).exception is None, resource
+        references = [_ for _ in orjson.dumps(resource).decode().split('"reference":"')[1:]]
+        assert all(_.split('"')[0] in keys for _ in references)
+    assert next(Study(500).resources('Patient')) == next(study.resources('Patient'))
+
+
+def test_renderers():
+    """Each renderer is timed and its allocations counted."""
+    results = renderers.run(number=10, repeat=1)
+    assert list(results['renderers']) == renderers.RENDERERS
+    for result in results['renderers'].values():
+        assert result['ns_per_op'] > 0 and result['blocks_per_op'] > 0
+
+
+def test_startup_lazy_imports():
+    """Commands that do not use FHIR models start without importing fhir.resources, the oid table or requests_cache."""
+    args = ['data', 'report', '--help']
+    on_exit = "import atexit, sys; atexit.register(lambda: print('modules:', sorted(sys.modules))); "
+    completed = subprocess.run([sys.executable, '-c', on_exit + startup.LAUNCHER] + args, capture_output=True, text=True)
+    modules = completed.stdout.split('modules:')[1]
+    assert 'fhir.resources' not in modules and 'oid_lookup' not in modules and 'requests_cache' not in modules
+    result = startup._run(args, repeat=1)
+    assert result['wall_seconds_median'] > 0 and result['modules'] > 0
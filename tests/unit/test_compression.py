@@ -0,0 +1,111 @@
+import gzip
+import pathlib
+import shutil
+
+import orjson
+import pytest
+
+from iceberg_tools.data import compression
+from iceberg_tools.data.compression import open_compressed
+from iceberg_tools.util import EmitterContextManager, directory_reader, merge_shards, read_manifest
+
+LINES = [orjson.dumps({'resourceType': 'Patient', 'id': f"p{_}"}, option=orjson.OPT_APPEND_NEWLINE) for _ in range(1000)]
+
+
+def _available():
+    """Compressions that can be written here."""
+    return ['gzip'] + (['zstd'] if shutil.which('zstd') or compression.zstandard else [])
+
+
+def _backends(monkeypatch, request):
+    """Use the (de)compression command, or the python fallback."""
+    if request == 'python':
+        monkeypatch.setattr(compression.shutil, 'which', lambda _: None)
+        if compression.zstandard is None:
+            return ['gzip']
+        return ['gzip', 'zstd']
+    return [_ for _, command in [('gzip', 'pigz'), ('zstd', 'zstd')] if shutil.which(command)]
+
+
+@pytest.mark.parametrize('backend', ['command', 'python'])
+def test_round_trip(tmp_path, monkeypatch, backend):
+    """Compressed files read back, rewind, and interoperate with gzip."""
+    for compression_ in _backends(monkeypatch, backend):
+        path = tmp_path / f"Patient.ndjson{compression.EXTENSIONS[compression_]}"
+        with open_compressed(path, 'wb', buffer_size=1024) as fp:
+            for line in LINES:
+                fp.write(line)
+            assert fp.tell() == sum(len(_) for _ in LINES)
+        with open_compressed(path) as fp:
+            assert fp.readline() == LINES[0]
+            fp.seek(0)
+            assert list(fp) == LINES
+        if compression_ == 'gzip':
+            assert gzip.decompress(path.read_bytes()).splitlines(keepends=True) == LINES
+
+
+def test_read_compressed(tmp_path):
+    """directory_reader reads gzip and zstd ndjson."""
+    for compression_ in _available():
+        path = tmp_path / compression_ / f"Patient.ndjson{compression.EXTENSIONS[compression_]}"
+        path.parent.mkdir(exist_ok=True)
+        with open_compressed(path, 'wb') as fp:
+            fp.writelines(LINES[:10])
+        results = [_ for _ in directory_reader(path.parent, pattern='*.*', validate=False)]
+        assert [_.resource.id for _ in results] == [f"p{_}" for _ in range(10)]
+
+
+def test_emit_compressed(tmp_path):
+    """Compressed shards are merged and rotated shards renumbered."""
+    for shard in [1, 0]:
+        with EmitterContextManager(tmp_path / 'merged', binary=True, shard=shard, compression='gzip') as emitter:
+            for line in LINES:
+                emitter.emit('Patient').write(line)
+        with EmitterContextManager(tmp_path / 'rotated', binary=True, shard=shard, compression='gzip', max_records=400) as emitter:
+            for line in LINES:
+                emitter.emit('Patient').write(line)
+    assert merge_shards(tmp_path / 'merged') == {'Patient': 2}
+    assert gzip.decompress((tmp_path / 'merged' / 'Patient.ndjson.gz').read_bytes()).splitlines(keepends=True) == LINES * 2
+    assert merge_shards(tmp_path / 'rotated') == {'Patient': 6}
+    paths = read_manifest(tmp_path / 'rotated')['Patient']
+    assert paths[0].name == 'Patient-00000.ndjson.gz'
+    assert b''.join(gzip.decompress(_.read_bytes()) for _ in paths).splitlines(keepends=True) == LINES * 2
+
+
+def test_validate_simplified_compressed(tmp_path, capsys):
+    """Compressed simplify output is validated, an empty directory is not reported as passing."""
+    from iceberg_tools.cli.data import validate_simplified
+    from iceberg_tools.data.simplifier import simplify_directory
+
+    schema_path = 'iceberg/schemas/simplified/simplified-fhir.json'
+    simplify_directory('tests/fixtures/simplify/kf', 'Organization.ndjson', tmp_path / 'simplified', schema_path,
+                       'PFB', 'config.yaml', compression='gzip')
+    assert [_.name for _ in (tmp_path / 'simplified').glob('*.ndjson*')] == ['Organization.ndjson.gz']
+    assert validate_simplified(tmp_path / 'simplified', schema_path)
+    (tmp_path / 'empty').mkdir()
+    assert not validate_simplified(tmp_path / 'empty', schema_path)
+    assert 'No records found' in capsys.readouterr().out
+
+
+def test_pfb_compressed(tmp_path, monkeypatch):
+    """Compressed ndjson is added to a PFB decompressed, a name both compressed and not is refused."""
+    from iceberg_tools.data import pfb
+
+    added = []
+
+    def _run_cmd(command_line):
+        if command_line.startswith('pfb add'):
+            added.append(pathlib.Path(command_line.split(' ')[3]).read_bytes())
+        return ''
+
+    monkeypatch.setattr(pfb, 'run_cmd', _run_cmd)
+    (tmp_path / 'in').mkdir()
+    with gzip.open(tmp_path / 'in' / 'Patient.ndjson.gz', 'wb') as fp:
+        fp.writelines(LINES)
+    writer = pfb.SimplePFBWriter('schema.json', tmp_path / 'out.pfb', ['Patient'])
+    assert len(list(writer.transform_directory(tmp_path / 'in'))) == 1
+    assert added == [b''.join(LINES)]
+
+    (tmp_path / 'in' / 'Patient.ndjson').write_bytes(b''.join(LINES))
+    with pytest.raises(AssertionError, match='one file per name'):
+        read_manifest(tmp_path / 'in')
@@ -0,0 +1,196 @@
+import datetime
+import gzip
+import io
+import os
+import pathlib
+
+import orjson
+import pytest
+
+from iceberg_tools import util
+from iceberg_tools.util import directory_reader
+
+FIXTURES = [
+    pathlib.Path('tests/fixtures/simplify/foo'),
+    pathlib.Path('tests/fixtures/simplify/dbgap/examples-5.0'),
+    pathlib.Path('tests/fixtures/simplify/genomics-reporting/examples-5.0'),
+]
+
+
+def _key(parse_result):
+    """Identify a result by its provenance."""
+    resource_id = parse_result.resource.id if parse_result.resource else parse_result.resource_id
+    return str(parse_result.path), parse_result.offset, resource_id
+
+
+def test_parallel_ordered_matches_serial():
+    """Ordered parallel reads yield the same results, in the same order, as a serial read."""
+    for directory_path in FIXTURES:
+        serial = [_key(_) for _ in directory_reader(directory_path, pattern='**/*.*', validate=False)]
+        parallel = [_key(_) for _ in directory_reader(directory_path, pattern='**/*.*', validate=False, workers=2)]
+        assert len(serial) > 0, f"Should have read {directory_path}"
+        assert serial == parallel
+
+
+def test_parallel_unordered_matches_serial():
+    """Unordered parallel reads yield the same results as a serial read."""
+    for directory_path in FIXTURES:
+        serial = [_key(_) for _ in directory_reader(directory_path, pattern='**/*.*', validate=False)]
+        parallel = [_key(_) for _ in directory_reader(directory_path, pattern='**/*.*', validate=False, workers=2, ordered=False)]
+        assert sorted(serial) == sorted(parallel)
+
+
+def test_byte_range_chunks_match_serial():
+    """Ndjson files split into small byte ranges report the same offsets as a serial read."""
+    directory_path = pathlib.Path('tests/fixtures/simplify/kf')
+    serial = [_key(_) for _ in directory_reader(directory_path, pattern='Observation.ndjson', validate=False)]
+    for ordered in [True, False]:
+        chunked = [_key(_) for _ in directory_reader(directory_path, pattern='Observation.ndjson', validate=False,
+                                                     workers=3, ordered=ordered, chunk_size=16 * 1024)]
+        if ordered:
+            assert serial == chunked
+        else:
+            assert sorted(serial) == sorted(chunked)
+
+
+def test_streaming_ndjson(tmp_path):
+    """Plain and gzipped ndjson are streamed, blank lines are skipped but still counted in offsets."""
+    lines = [
+        b'{"resourceType": "Patient", "id": "p1"}\n',
+        b'\n',
+        b'{"resourceType": "Patient", "id": "p2"}\n',
+    ]
+    with open(tmp_path / 'Patient.ndjson', 'wb') as fp:
+        fp.writelines(lines)
+    with gzip.open(tmp_path / 'Patient.ndjson.gz', 'wb') as fp:
+        fp.writelines(lines)
+
+    for pattern in ['*.ndjson', '*.ndjson.gz']:
+        results = [_key(_) for _ in directory_reader(tmp_path, pattern=pattern)]
+        assert [(offset, id_) for _, offset, id_ in results] == [(0, 'p1'), (2, 'p2')]
+
+
+def test_streaming_bundle(tmp_path, monkeypatch):
+    """Bundle entries are parsed one at a time, even when values straddle read boundaries."""
+    monkeypatch.setattr(util, 'STREAM_READ_SIZE', 7)
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [
+            {"resource": {"resourceType": "Patient", "id": "p1", "multipleBirthInteger": 12345}},
+            {"resource": {"resourceType": "Patient", "id": "p2", "notAField": True}},
+            {"resource": {"resourceType": "Patient", "id": "p3", "name": [{"text": "Ünïcode"}]}},
+        ]
+    }
+    with open(tmp_path / 'bundle.json', 'wb') as fp:
+        fp.write(orjson.dumps(bundle, option=orjson.OPT_INDENT_2))
+    with open(tmp_path / 'minified.json', 'wb') as fp:
+        fp.write(orjson.dumps(bundle))
+
+    for pattern in ['bundle.json', 'minified.json']:
+        results = list(directory_reader(tmp_path, pattern=pattern))
+        assert [(_.offset, _.resource_id) for _ in results] == [(0, 'p1'), (1, 'p2'), (2, 'p3')]
+        assert results[0].resource.multipleBirthInteger == 12345
+        assert results[1].exception is not None, "Invalid entry should be reported on its own"
+        assert results[2].resource.name[0].text == 'Ünïcode'
+
+
+def test_json_stream():
+    """Values are decoded one at a time across small reads, the rest is available as lines."""
+    document = '{"a": [1, "Ü", {"b": null}]}\n{"c": 2}\n'.encode()
+    stream = util.JSONStream(io.BytesIO(document), read_size=3)
+    assert stream.expect('{') == '{'
+    assert stream.value() == 'a'
+    assert stream.expect(':') == ':'
+    assert stream.value() == [1, 'Ü', {'b': None}]
+    assert stream.expect(',}') == '}'
+    assert list(stream.lines()) == [b'\n', b'{"c": 2}\n']
+
+
+def test_long_first_line_ndjson(tmp_path, monkeypatch):
+    """Ndjson named *.json with a first line too long to sniff still yields every line, with line offsets."""
+    monkeypatch.setattr(util, 'STREAM_READ_SIZE', 1000)
+    lines = [
+        {"resourceType": "Patient", "id": "p1", "name": [{"text": "Ü" * util.SNIFF_SIZE}]},
+        {"resourceType": "Patient", "id": "p2"},
+        None,
+        {"resourceType": "Patient", "id": "p3", "name": [{"text": "Ü" * 600}]},
+        {"resourceType": "Patient", "id": "p4"},
+    ]
+    with open(tmp_path / 'patients.json', 'wb') as fp:
+        fp.writelines([orjson.dumps(_) + b'\n' if _ else b'\n' for _ in lines])
+
+    for workers in [None, 2]:
+        results = list(directory_reader(tmp_path, pattern='*.json', workers=workers))
+        assert [(_.offset, _.resource_id) for _ in results] == [(0, 'p1'), (1, 'p2'), (3, 'p3'), (4, 'p4')]
+        assert all(_.exception is None for _ in results)
+        assert results[2].resource.name[0].text == "Ü" * 600
+
+
+def test_trusted_matches_validated():
+    """Resources constructed without validation serialize the same as validated resources."""
+    for directory_path in FIXTURES:
+        validated = [_ for _ in directory_reader(directory_path, pattern='**/*.*', validate=False) if _.resource]
+        trusted = [_ for _ in directory_reader(directory_path, pattern='**/*.*', validate=False, trusted=True) if _.resource]
+        assert len(validated) > 0, f"Should have read {directory_path}"
+        # invalid resources are not detected in trusted mode
+        assert set(_key(_) for _ in validated) <= set(_key(_) for _ in trusted)
+        trusted = {_key(_): _.resource for _ in trusted}
+        for _ in validated:
+            assert trusted[_key(_)].json() == _.resource.json()
+            assert type(trusted[_key(_)]) is type(_.resource)
+
+
+def test_trusted_parse_obj():
+    """Trusted parse_obj coerces primitives and nested models, drops unknown properties."""
+    obj = {"resourceType": "Observation", "id": "o1", "status": "final", "code": {"text": "x"},
+           "effectiveDateTime": "2020-01-02", "valueQuantity": {"value": 1.5}, "notAField": True,
+           "contained": [{"resourceType": "Patient", "id": "p1"}]}
+    parse_result = util.parse_obj(obj, validate=False, trusted=True)
+    assert parse_result.exception is None
+    resource = parse_result.resource
+    assert resource.resource_type == 'Observation' and resource.id == 'o1'
+    assert resource.code.text == 'x'
+    assert resource.contained[0].resource_type == 'Patient'
+    assert resource.effectiveDateTime == datetime.date(2020, 1, 2)
+    assert not hasattr(resource, 'notAField')
+
+
+def test_validate_command(tmp_path, capsys):
+    """`iceberg data validate` passes a valid directory, an empty directory is not reported as passing."""
+    from iceberg_tools.cli.data import validate
+
+    assert validate('tests/fixtures/simplify/kf', 'Organization.ndjson')
+    assert 'OK, all resources pass' in capsys.readouterr().out
+    assert not validate(tmp_path, '*.*')
+    assert 'No records found' in capsys.readouterr().out
+
+
+def _exit_worker(task, **kwargs):
+    """A read_task that kills its worker."""
+    os._exit(1)
+
+
+def _fail_task(task, **kwargs):
+    """A read_task that fails part way."""
+    yield util.ParseResult(object={}, resource=None, exception=None, path=task.path)
+    raise ValueError(f"cannot read {task.path}")
+
+
+def test_parallel_batches(tmp_path, monkeypatch):
+    """Workers return whole-file tasks in batches, worker errors and exits are raised in the parent."""
+    monkeypatch.setattr(util, 'RESULT_BATCH_SIZE', 4)
+    monkeypatch.setattr(util, 'POLL_INTERVAL', 0.1)
+    for name in ['Patient', 'Specimen']:
+        with gzip.open(tmp_path / f'{name}.ndjson.gz', 'wb') as fp:
+            fp.writelines([orjson.dumps({"resourceType": "Patient", "id": f"{name}-{_}"}) + b'\n' for _ in range(25)])
+    serial = [_key(_) for _ in directory_reader(tmp_path, pattern='*.ndjson.gz')]
+    assert len(serial) == 50
+    assert [_key(_) for _ in directory_reader(tmp_path, pattern='*.ndjson.gz', workers=2)] == serial
+    assert sorted(_key(_) for _ in directory_reader(tmp_path, pattern='*.ndjson.gz', workers=2, ordered=False)) == sorted(serial)
+
+    for read_task, exception in [(_fail_task, ValueError), (_exit_worker, RuntimeError)]:
+        monkeypatch.setattr(util, 'read_task', read_task)
+        for ordered in [True, False]:
+            with pytest.raises(exception):
+                list(directory_reader(tmp_path, pattern='*.ndjson.gz', workers=2, ordered=ordered))
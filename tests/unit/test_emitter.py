@@ -0,0 +1,66 @@
+import orjson
+import pytest
+
+from iceberg_tools.util import EmitterContextManager, merge_shards, read_manifest
+
+RECORDS = [{'id': str(_), 'resourceType': 'Patient' if _ % 3 else 'Observation'} for _ in range(1000)]
+
+
+def _emit(emitter, binary):
+    """Write records by resourceType."""
+    for record in RECORDS:
+        line = orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+        emitter.emit(record['resourceType']).write(line if binary else line.decode())
+
+
+def test_emitter_backends(tmp_path):
+    """Text, binary and background writers produce the same files."""
+    for name, kwargs in [('text', {}), ('binary', dict(binary=True)),
+                         ('background', dict(binary=True, background=True, buffer_size=1024))]:
+        with EmitterContextManager(tmp_path / name, **kwargs) as emitter:
+            _emit(emitter, kwargs.get('binary', False))
+    for name in ['binary', 'background']:
+        for file_name in ['Patient.ndjson', 'Observation.ndjson']:
+            assert (tmp_path / name / file_name).read_bytes() == (tmp_path / 'text' / file_name).read_bytes()
+    assert len((tmp_path / 'background' / 'Patient.ndjson').read_bytes().splitlines()) == 666
+
+
+def test_background_writer_errors(tmp_path):
+    """Write errors on the writer thread are raised on exit."""
+    with pytest.raises(ValueError):
+        with EmitterContextManager(tmp_path, binary=True, background=True, buffer_size=2) as emitter:
+            fp = emitter.emit('Patient')
+            fp.fp.close()
+            fp.write(b'{}\n')
+
+
+def test_emitter_rotation(tmp_path):
+    """Output rotates by record count or size, the manifest lists every file."""
+    with EmitterContextManager(tmp_path / 'records', binary=True, max_records=100) as emitter:
+        _emit(emitter, True)
+    manifest = orjson.loads((tmp_path / 'records' / 'manifest.json').read_bytes())
+    assert [_['count'] for _ in manifest['Patient']] == [100] * 6 + [66]
+    assert manifest['Observation'][-1] == {'path': 'Observation-00003.ndjson', 'count': 34}
+    assert len((tmp_path / 'records' / 'Patient-00006.ndjson').read_bytes().splitlines()) == 66
+
+    with EmitterContextManager(tmp_path / 'bytes', binary=True, background=True, max_bytes=4096) as emitter:
+        _emit(emitter, True)
+    files = read_manifest(tmp_path / 'bytes')
+    assert len(files['Patient']) > 1
+    expected = [line for path in read_manifest(tmp_path / 'records')['Patient'] for line in path.read_bytes().splitlines()]
+    assert [line for path in files['Patient'] for line in path.read_bytes().splitlines()] == expected
+    assert all(path.stat().st_size < 4096 + 64 for path in files['Patient'])
+
+
+def test_merge_rotated_shards(tmp_path):
+    """Rotated shards are renumbered in shard order."""
+    for shard in [1, 0]:
+        with EmitterContextManager(tmp_path, binary=True, shard=shard, max_records=400) as emitter:
+            _emit(emitter, True)
+    assert (tmp_path / 'manifest-00001.json').is_file()
+    assert merge_shards(tmp_path) == {'Observation': 2, 'Patient': 4}
+    files = read_manifest(tmp_path)
+    assert [_.name for _ in files['Patient']] == [f"Patient-0000{_}.ndjson" for _ in range(4)]
+    lines = [line for path in files['Patient'] for line in path.read_bytes().splitlines()]
+    assert len(lines) == 2 * 666
+    assert not list(tmp_path.glob('manifest-*.json'))
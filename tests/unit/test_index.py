@@ -0,0 +1,76 @@
+import os
+import pathlib
+import shutil
+
+import orjson
+
+from iceberg_tools import util
+from iceberg_tools.data.index import build_index, index_path, open_index
+from iceberg_tools.util import directory_reader
+
+SOURCE = pathlib.Path('tests/fixtures/simplify/kf/Observation.ndjson')
+
+
+def _copy(tmp_path) -> pathlib.Path:
+    """An indexable copy of the fixture."""
+    source = tmp_path / 'Observation.ndjson'
+    shutil.copy(SOURCE, source)
+    return source
+
+
+def test_index_lookup(tmp_path):
+    """Records are found by id and line number, without re-scanning the file."""
+    source = _copy(tmp_path)
+    lines = source.read_bytes().splitlines(keepends=True)
+    with build_index(source) as ndjson_index:
+        assert index_path(source).is_file()
+        assert len(ndjson_index) == len(lines)
+        assert ndjson_index.count('Observation') == len(lines)
+        assert ndjson_index.count('Patient') == 0
+        assert ndjson_index.resource_types() == {'Observation': len(lines)}
+        for line_number in [0, len(lines) // 2, len(lines) - 1]:
+            assert ndjson_index.read(line_number) == lines[line_number]
+            id_ = orjson.loads(lines[line_number])['id']
+            assert ndjson_index.find('Observation', id_) == line_number
+        assert ndjson_index.find('Observation', 'no-such-id') is None
+
+
+def test_stale_index(tmp_path):
+    """An index is ignored once its source changes."""
+    source = _copy(tmp_path)
+    build_index(source).close()
+    with open_index(source) as ndjson_index:
+        assert ndjson_index is not None
+    with open(source, 'ab') as fp:
+        fp.write(b'{"resourceType": "Observation", "id": "appended"}\n')
+    assert open_index(source) is None
+    with open_index(source, build=True) as ndjson_index:
+        assert ndjson_index.find('Observation', 'appended') == len(ndjson_index) - 1
+
+
+def test_index_split_points(tmp_path):
+    """Split points from the index match the counted split points."""
+    source = _copy(tmp_path)
+    chunk_size = 16 * 1024
+    counted = [(_.start, _.end, _.offset) for _ in util.plan_read_tasks([source], chunk_size, _SerialPool())]
+    with build_index(source) as ndjson_index:
+        indexed = [(_.start, _.end, _.offset) for _ in util.plan_read_tasks([source], chunk_size, _SerialPool())]
+        assert ndjson_index.split_points(chunk_size) == indexed
+    assert len(indexed) > 1
+    assert indexed[0][0] == 0 and indexed[-1][1] == os.path.getsize(source)
+    # ranges are contiguous
+    assert all(a[1] == b[0] for a, b in zip(indexed[:-1], indexed[1:]))
+    assert indexed == counted
+
+    serial = [(_.offset, _.resource_id) for _ in directory_reader(tmp_path, pattern='*.ndjson', validate=False)]
+    parallel = [(_.offset, _.resource_id) for _ in
+                directory_reader(tmp_path, pattern='*.ndjson', validate=False, workers=2, chunk_size=chunk_size)]
+    assert serial == parallel
+
+
+class _SerialPool:
+    """Stand in for multiprocessing.Pool."""
+
+    def map(self, func, iterable, chunksize=None):
+        """Apply func in process."""
+        return [func(_) for _ in iterable]
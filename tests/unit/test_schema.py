@@ -1,8 +1,20 @@
+import logging
+import os
+import pathlib
+import sqlite3
+import subprocess
+import sys
+import urllib.error
+import zipfile
+
+import orjson
+import pytest
 from fhir.resources.documentreference import DocumentReference
 from fhir.resources.patient import Patient, PatientLink, PatientCommunication
 from fhir.resources.task import Task
 
-from iceberg_tools.schema import _find_fhir_classes, extract_schemas, BASE_URI
+from iceberg_tools.schema import _class_node, _find_fhir_classes, extract_schemas, BASE_URI
+from iceberg_tools.schema.fhir_resources import binding_lookup
 
 
 def test_find_fhir_classes():
@@ -13,6 +25,17 @@ def test_find_fhir_classes():
         assert _ in classes, ('No find', _)
 
 
+def test_find_fhir_classes_depth(caplog):
+    """Each level adds the classes embedded by the previous one, stats count them."""
+    caplog.set_level(logging.INFO)
+    direct = _find_fhir_classes({'dependency_order': ['Patient'], 'subclass_depth': 1})
+    assert PatientLink in direct and Patient in direct and 'Patient: ' in caplog.text
+    deeper = _find_fhir_classes({'dependency_order': ['Patient'], 'subclass_depth': 2}, log_stats=False)
+    assert direct < deeper
+    for klass in deeper - direct:
+        assert any(klass in _class_node(_)[1] for _ in direct)
+
+
 def test_schemas():
     """Assert we find schemas descending from Patient."""
     classes = _find_fhir_classes({'dependency_order': ['Patient']})
@@ -73,3 +96,86 @@ def test_task():
     requested_performer = task['properties']['requestedPerformer']
     print(requested_performer)
     assert 'backref' in requested_performer, "requested_performer should have a backref"
+
+
+def test_extract_schemas_cache(tmp_path, monkeypatch):
+    """Schemas extracted in parallel are cached, a cached run returns the same schemas."""
+    classes = _find_fhir_classes({'dependency_order': ['Patient']}, log_stats=False)
+    expected = extract_schemas(classes, BASE_URI)
+    monkeypatch.setattr('iceberg_tools.schema.PARALLEL_MISSES', 2)
+    assert extract_schemas(classes, BASE_URI, workers=2, cache_path=tmp_path) == expected
+    cached = list(tmp_path.glob('*/*.json'))
+    assert len(cached) == len(classes)
+    for path in cached:
+        path.write_bytes(path.read_bytes().replace(b'"$id"', b'"cached"'))
+    assert all('cached' in _ for _ in extract_schemas(classes, BASE_URI, cache_path=tmp_path).values())
+
+
+def test_element_bindings_store(tmp_path, monkeypatch):
+    """The bindings database is built from a definitions zip, opened read-only from $ICEBERG_ELEMENT_BINDINGS."""
+    gender = {'id': 'Patient.gender', 'binding': {'strength': 'required', 'valueSet': 'http://hl7.org/fhir/ValueSet/administrative-gender|5.0.0'}}
+    bundle = {'resourceType': 'Bundle', 'entry': [{'resource': {'snapshot': {'element': [gender, {'id': 'Patient.active'}]}}}]}
+    definitions_path = tmp_path / 'definitions.zip'
+    with zipfile.ZipFile(definitions_path, 'w') as definitions:
+        for file_name in binding_lookup.DEFINITIONS_FILES:
+            definitions.writestr(file_name, orjson.dumps(bundle if file_name == 'profiles-resources.json' else {}))
+    path = binding_lookup.create_fhir_definitions_lookup(tmp_path, tmp_path / 'bindings.sqlite', definitions_path)
+    assert sorted(_.name for _ in tmp_path.iterdir()) == ['bindings.sqlite', 'definitions.zip'], 'left temporary files'
+    built = path.stat().st_mtime_ns
+    assert binding_lookup.create_fhir_definitions_lookup(tmp_path, path, definitions_path) == path
+    assert path.stat().st_mtime_ns == built, 'rebuilt from unchanged definitions'
+    binding_lookup.create_fhir_definitions_lookup(tmp_path, path, definitions_path, force=True)
+    assert sorted(_.name for _ in tmp_path.iterdir()) == ['bindings.sqlite', 'definitions.zip'], 'left temporary files'
+
+    monkeypatch.setenv(binding_lookup.BINDINGS_ENV, str(path))
+    monkeypatch.setattr(binding_lookup, '_CONNECTION', None)
+    monkeypatch.setattr(binding_lookup, '_INDEX', None)
+    connection = binding_lookup.element_bindings()
+    assert connection.execute('select id from element_bindings').fetchall() == [('Patient.gender',)]
+    with pytest.raises(sqlite3.OperationalError):
+        connection.execute("insert into element_bindings values ('a', 'b')")
+    assert binding_lookup.element_bindings() is connection
+    assert list(binding_lookup.bindings_index()) == ['Patient'] and binding_lookup.bindings_index()['Patient']['gender'] == gender
+
+    schema = extract_schemas([Patient], BASE_URI)['Patient']
+    assert schema['properties']['gender']['binding_uri'] == 'http://hl7.org/fhir/ValueSet/administrative-gender'
+
+
+def test_element_bindings_first_use(tmp_path, monkeypatch, caplog):
+    """On first use the user database is built from $ICEBERG_FHIR_DEFINITIONS, a download is announced and cleans up."""
+    bundle = {'resourceType': 'Bundle', 'entry': [{'resource': {'snapshot': {'element': [
+        {'id': 'Patient.gender', 'binding': {'valueSet': 'http://hl7.org/fhir/ValueSet/administrative-gender|5.0.0'}}]}}}]}
+    definitions_path = tmp_path / 'definitions.zip'
+    with zipfile.ZipFile(definitions_path, 'w') as definitions:
+        for file_name in binding_lookup.DEFINITIONS_FILES:
+            definitions.writestr(file_name, orjson.dumps(bundle if file_name == 'profiles-resources.json' else {}))
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.delenv(binding_lookup.BINDINGS_ENV, raising=False)
+    monkeypatch.setattr(binding_lookup, 'USER_PATH', tmp_path / '.iceberg' / 'element_bindings.sqlite')
+    monkeypatch.setattr(binding_lookup, '_CONNECTION', None)
+
+    def _offline(url, path):
+        pathlib.Path(path).write_bytes(b'partial')
+        raise urllib.error.URLError('offline')
+
+    monkeypatch.setattr(binding_lookup.urllib.request, 'urlretrieve', _offline)
+    monkeypatch.delenv(binding_lookup.DEFINITIONS_ENV, raising=False)
+    with caplog.at_level(logging.WARNING), pytest.raises(RuntimeError, match=binding_lookup.DEFINITIONS_ENV):
+        binding_lookup.element_bindings(create=True)
+    assert binding_lookup.DEFINITIONS_URL in caplog.text, 'download should be announced'
+    assert list((tmp_path / '.iceberg').iterdir()) == [], 'left a partial download'
+
+    caplog.clear()
+    monkeypatch.setenv(binding_lookup.DEFINITIONS_ENV, str(definitions_path))
+    with caplog.at_level(logging.WARNING):
+        connection = binding_lookup.element_bindings(create=True)
+    assert connection.execute('select id from element_bindings').fetchall() == [('Patient.gender',)]
+    assert binding_lookup.bindings_path() == binding_lookup.USER_PATH
+    assert caplog.text == ''
+
+
+def test_import_has_no_side_effects(tmp_path):
+    """Importing the schema module neither opens nor creates the bindings database."""
+    code = "import iceberg_tools.schema, sys; assert iceberg_tools.schema.fhir_resources.binding_lookup._CONNECTION is None"
+    subprocess.run([sys.executable, '-c', code], check=True, env=os.environ | {'HOME': str(tmp_path)})
+    assert not (tmp_path / '.iceberg' / 'element_bindings.sqlite').exists()
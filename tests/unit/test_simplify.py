@@ -1,13 +1,22 @@
 # http://build.fhir.org/specimen-example.json
 
+import os
+import pathlib
+
 import orjson
+import pytest
 from fhir.resources.observation import Observation
 from fhir.resources.patient import Patient
 from fhir.resources.specimen import Specimen
 from fhir.resources.task import Task
 
-from iceberg_tools.data.simplifier import simplify, _default_json_serializer, SimplifierContextManager, _render_dialect
+from iceberg_tools.data import simplifier
+from iceberg_tools.data.simplifier import simplify, _default_json_serializer, SimplifierContextManager, _render_dialect, getter, \
+    simplify_directory, ENGINES
+from iceberg_tools.data.simplifier.dict_simplifier import check_dict, simplify_dict
+from iceberg_tools.data.simplifier.render_plan import render_plan
 from iceberg_tools.schema.simplified_validator import ensure_schema, validate
+from iceberg_tools.util import merge_shards
 
 SPECIMEN = {
     "resourceType": "Specimen",
@@ -460,3 +469,145 @@ def test_simplify_observation():
         assert simplified['valueQuantity_value'] == 61, simplified['valueQuantity_value']
         assert simplified['valueQuantity_unit'] == "http://unitsofmeasure.org#/min", simplified['valueQuantity_unit']
         assert simplified['valueQuantity'] == "61 /min", simplified['valueQuantity']
+
+
+def test_simplify_dict_engine():
+    """The dict engine renders the same record and references as the model engine."""
+    nested_objects = {
+        'Specimen': ['processing.additive', 'processing.method', 'collection.method', 'collection.bodySite'],
+        'Patient': ['address.postalCode'],
+        'Task': ['input.valueReference', 'output.valueReference'],
+    }
+    for klass, obj in [(Specimen, SPECIMEN), (Patient, PATIENT), (Task, TASK), (Observation, OBSERVATION)]:
+        for transform_ids in [None, 'seed']:
+            with SimplifierContextManager():
+                expected = simplify(klass.parse_obj(obj), 'PFB', nested_objects, transform_ids)
+            actual = simplify_dict(orjson.loads(orjson.dumps(obj)), 'PFB', nested_objects, transform_ids)
+            assert orjson.dumps(actual, default=_default_json_serializer) == \
+                orjson.dumps(expected, default=_default_json_serializer), obj['resourceType']
+
+
+def test_simplify_dict_engine_directories(tmp_path):
+    """On whole fixture directories, including resources that fail validation, both engines write the same files."""
+    for directory in ['synthea', 'ncpi', 'dbgap']:
+        for engine in ENGINES:
+            simplify_directory(f"tests/fixtures/simplify/{directory}", '**/*.*', tmp_path / engine / directory,
+                               'iceberg/schemas/simplified/simplified-fhir.json', 'PFB', 'config.yaml', engine=engine)
+        expected = sorted((tmp_path / 'model' / directory).iterdir())
+        assert expected, directory
+        assert [_.name for _ in sorted((tmp_path / 'dict' / directory).iterdir())] == [_.name for _ in expected]
+        for path in expected:
+            assert (tmp_path / 'dict' / directory / path.name).read_bytes() == path.read_bytes(), path
+
+
+def test_check_dict():
+    """Resources the models reject are rejected, a Reference without a reference is valid."""
+    assert check_dict(orjson.loads(orjson.dumps(SPECIMEN))) is None
+    assert 'extra fields' in str(check_dict({'resourceType': 'Patient', 'id': 'p1', 'telecom2': []}))
+    assert 'field required' in str(check_dict({'resourceType': 'ResearchSubject', 'status': 'active'}))
+    assert check_dict({'resourceType': 'ResearchSubject', 'study': {'display': 'study'}, 'subject': {'reference': 'Patient/p1'}})
+    obj = {'resourceType': 'Patient', 'id': 'p1', 'managingOrganization': {'display': 'organization'}}
+    assert check_dict(obj) is None
+    simplified, references = simplify_dict(obj, 'PFB')
+    assert references == [None]
+    assert _render_dialect(simplified, references, 'PFB', {})['relations'] == []
+
+
+def test_render_plan():
+    """Render plans classify fields once per class."""
+    plan = render_plan(Observation)
+    assert plan is render_plan(Observation)
+    assert plan.resource_type == 'Observation' and plan.renderer_class is Observation
+    assert 'status' in [_.name for _ in plan.primitives]
+    assert 'code' in [_.name for _ in plan.codings] and 'category' in [_.name for _ in plan.codings]
+    references = [_.name for _ in plan.references]
+    assert 'subject' in references and 'basedOn' not in references, "lists of references are not rendered"
+    assert [_.name for _ in plan.values][:2] == ['valueQuantity', 'valueCodeableConcept']
+    assert plan.has_extension and plan.has_identifier
+    assert render_plan(Patient).renderer_class is None
+
+
+def test_getter():
+    """Nested object paths are compiled once per resource type and path."""
+    specimen = Specimen.parse_obj(SPECIMEN)
+    _getter = getter('Specimen', 'processing.additive')
+    assert _getter is getter('Specimen', 'processing.additive')
+    assert _getter.names == ['processing', 'additive'] and _getter.extension_name is None
+    assert _getter.get(specimen)[0].reference == 'Substance/CHEMBL1231821'
+    assert getter('Specimen', 'collection.method').get(specimen).coding[0].code == 'LNV'
+    assert getter('Specimen', 'parent.reference').get(specimen) is None
+
+    _getter = getter('DocumentReference', 'content.attachment.extension.md5')
+    assert _getter.names == ['content', 'attachment'] and _getter.extension_name == 'md5'
+
+
+def test_simplify_directory_workers(tmp_path, monkeypatch):
+    """Worker processes write shards, merged they match a serial run."""
+    # split the fixtures into several byte ranges
+    monkeypatch.setattr(simplifier, 'DEFAULT_CHUNK_SIZE', 4 * 1024)
+    kwargs = dict(input_path='tests/fixtures/simplify/kf', pattern='Observation.ndjson',
+                  schema_path='iceberg/schemas/simplified/simplified-fhir.json', dialect='PFB', config_path='config.yaml')
+    simplify_directory(output_path=tmp_path / 'serial', **kwargs)
+    simplify_directory(output_path=tmp_path / 'parallel', workers=2, **kwargs)
+    simplify_directory(output_path=tmp_path / 'shards', workers=2, merge=False, **kwargs)
+
+    expected = (tmp_path / 'serial' / 'Observation.ndjson').read_bytes()
+    assert expected
+    assert [_.name for _ in (tmp_path / 'parallel').iterdir()] == ['Observation.ndjson']
+    assert (tmp_path / 'parallel' / 'Observation.ndjson').read_bytes() == expected
+
+    shards = sorted((tmp_path / 'shards').iterdir())
+    assert len(shards) > 1 and shards[0].name == 'Observation-00000.ndjson'
+    assert b''.join(_.read_bytes() for _ in shards) == expected
+    assert merge_shards(tmp_path / 'shards') == {'Observation': len(shards)}
+    assert (tmp_path / 'shards' / 'Observation.ndjson').read_bytes() == expected
+    assert len(list((tmp_path / 'shards').iterdir())) == 1
+
+
+def test_simplify_pipeline(tmp_path, monkeypatch):
+    """The overlapped pipeline writes the same records, in the same order, as a serial run and reports every stage."""
+    from iceberg_tools.data.simplifier import pipeline
+    monkeypatch.setattr(pipeline, 'BATCH_SIZE', 7)
+    stats = []
+    simplify_pipeline = pipeline.simplify_pipeline
+    monkeypatch.setattr(pipeline, 'simplify_pipeline', lambda *args: stats.append(simplify_pipeline(*args)))
+    kwargs = dict(input_path='tests/fixtures/simplify/kf', pattern='Observation.ndjson',
+                  schema_path='iceberg/schemas/simplified/simplified-fhir.json', dialect='PFB', config_path='config.yaml')
+    simplify_directory(output_path=tmp_path / 'serial', **kwargs)
+    simplify_directory(output_path=tmp_path / 'pipeline', workers=2, pipeline=True, **kwargs)
+    expected = (tmp_path / 'serial' / 'Observation.ndjson').read_bytes()
+    assert expected
+    assert (tmp_path / 'pipeline' / 'Observation.ndjson').read_bytes() == expected
+
+    stats = stats[0]
+    assert set(stats) == {'reader', 'simplify', 'writer'}
+    assert stats['reader'].items == stats['simplify'].items == stats['writer'].items > 1
+
+
+def _exit_batch(batch):
+    """A pipeline worker that is killed."""
+    os._exit(1)
+
+
+def test_simplify_pipeline_stats_and_exits(tmp_path, monkeypatch):
+    """The pipeline reader counts reads, a worker that exits fails the run instead of hanging it."""
+    from iceberg_tools import stats
+    from iceberg_tools.data.simplifier import pipeline
+    monkeypatch.setattr(pipeline, 'BATCH_SIZE', 7)
+    monkeypatch.setattr(pipeline, 'POLL_INTERVAL', 0.05)
+    kwargs = dict(input_path='tests/fixtures/simplify/kf', pattern='Observation.ndjson',
+                  schema_path='iceberg/schemas/simplified/simplified-fhir.json', dialect='PFB', config_path='config.yaml',
+                  workers=2, pipeline=True)
+    lines = len(pathlib.Path('tests/fixtures/simplify/kf/Observation.ndjson').read_bytes().splitlines())
+    try:
+        collector = stats.enable_stats()
+        simplify_directory(output_path=tmp_path / 'pipeline', **kwargs)
+        report = collector.report()['stages']
+    finally:
+        stats.disable_stats()
+    assert report['read']['records'] == report['decode']['records'] == lines
+    assert report['read']['bytes'] == pathlib.Path('tests/fixtures/simplify/kf/Observation.ndjson').stat().st_size
+
+    monkeypatch.setattr(pipeline, '_simplify_batch', _exit_batch)
+    with pytest.raises(RuntimeError, match='exited'):
+        simplify_directory(output_path=tmp_path / 'exited', **kwargs)
@@ -0,0 +1,109 @@
+import pathlib
+
+import orjson
+
+from iceberg_tools import stats
+from iceberg_tools.stats import StatsCollector, clock
+from iceberg_tools.util import directory_reader
+
+FIXTURE = pathlib.Path('tests/fixtures/simplify/kf')
+
+
+def test_collector_report(tmp_path):
+    """Counters are totalled per stage and per resource type, snapshots merge across collectors."""
+    worker = StatsCollector()
+    started = clock()
+    for resource_type in ['Patient', 'Patient', 'Observation']:
+        worker.add('decode', resource_type, started, clock(), bytes_=10)
+    parent = StatsCollector()
+    parent.add('write', 'Patient', started, clock(), bytes_=5)
+    parent.merge(worker.snapshot())
+    assert worker.counters == {}
+
+    parent.write(tmp_path / 'stats.json', 'validate')
+    report = orjson.loads((tmp_path / 'stats.json').read_bytes())
+    assert report['command'] == 'validate'
+    assert list(report['stages']) == ['decode', 'write']
+    decode = report['stages']['decode']
+    assert (decode['records'], decode['bytes']) == (3, 30)
+    assert decode['resource_types']['Patient']['records'] == 2
+    assert decode['records_per_second'] > 0
+
+
+def test_reader_stats():
+    """Serial and parallel reads count every record, stats are off unless enabled."""
+    assert stats.collector() is None
+    try:
+        for workers in [None, 2]:
+            collector = stats.enable_stats()
+            results = [_ for _ in directory_reader(FIXTURE, pattern='Organization.ndjson', validate=False, workers=workers)]
+            counts = {stage: totals['records'] for stage, totals in collector.report()['stages'].items()}
+            assert counts == {'read': len(results), 'decode': len(results), 'parse': len(results)}
+            stats.disable_stats()
+    finally:
+        stats.disable_stats()
+
+
+def test_migrate_and_validate_simplified_stats(tmp_path):
+    """Migration, bundle reads and simplified validation are timed per stage, with a span per file."""
+    from iceberg_tools import trace
+    from iceberg_tools.cli.data import validate_simplified
+    from iceberg_tools.data.migrator import migrate_bundles, migrate_ndjson
+    from iceberg_tools.data.simplifier import simplify_directory
+
+    schema_path = 'iceberg/schemas/simplified/simplified-fhir.json'
+    lines = len(FIXTURE.joinpath('Organization.ndjson').read_text().splitlines())
+    synthea = pathlib.Path('tests/fixtures/simplify/synthea')
+    entries = len(orjson.loads(synthea.joinpath('PractitionerInformation.json').read_bytes())['entry'])
+    try:
+        tracer = trace.enable_trace()
+        for workers in [None, 2]:
+            collector = stats.enable_stats()
+            (tmp_path / 'migrated').mkdir(exist_ok=True)
+            migrate_ndjson(tmp_path / 'migrated', FIXTURE, False, 'Organization.ndjson', workers=workers)
+            migrate_bundles(tmp_path / 'migrated', synthea, False, 'PractitionerInformation.json', workers=workers)
+            counts = {stage: totals['records'] for stage, totals in collector.report()['stages'].items()}
+            assert counts == {'read': lines + 1, 'decode': lines + 1, 'migrate': lines + entries, 'serialize': lines + 1, 'write': lines + 1}
+            stats.disable_stats()
+
+        collector = stats.enable_stats()
+        results = [_ for _ in directory_reader(synthea, pattern='PractitionerInformation.json', validate=False)]
+        stages = collector.report()['stages']
+        assert stages['read']['records'] == stages['decode']['records'] == len(results) == entries
+        assert stages['read']['bytes'] == synthea.joinpath('PractitionerInformation.json').stat().st_size
+        stats.disable_stats()
+
+        simplify_directory(str(FIXTURE), 'Organization.ndjson', tmp_path / 'simplified', schema_path, 'PFB', 'config.yaml')
+        assert {_['name'] for _ in tracer.snapshot()['events']} == {'_migrate_ndjson_file', '_migrate_bundle', 'file'}
+        collector = stats.enable_stats()
+        assert validate_simplified(tmp_path / 'simplified', schema_path)
+        counts = {stage: totals['records'] for stage, totals in collector.report()['stages'].items()}
+        assert counts == {'read': lines, 'decode': lines, 'schema_check': lines}
+        tracer.write(tmp_path / 'trace.json')
+    finally:
+        stats.disable_stats()
+        trace.disable_trace()
+    events = orjson.loads((tmp_path / 'trace.json').read_bytes())['traceEvents']
+    assert [_['name'] for _ in events if _['ph'] == 'X'] == ['file']
+
+
+def test_migrate_counts_bytes(tmp_path):
+    """Migration counts bytes, not characters, the output does not depend on stats being enabled."""
+    from iceberg_tools.data.migrator import migrate_ndjson
+
+    (tmp_path / 'in').mkdir()
+    source = tmp_path / 'in' / 'Patient.ndjson'
+    source.write_bytes(b''.join(orjson.dumps({'resourceType': 'Patient', 'id': f"p{_}", 'name': [{'text': 'Ünïcode'}]},
+                                             option=orjson.OPT_APPEND_NEWLINE) for _ in range(3)))
+    for name in ['disabled', 'enabled']:
+        (tmp_path / name).mkdir()
+    migrate_ndjson(tmp_path / 'disabled', tmp_path / 'in', False, '*.ndjson')
+    try:
+        collector = stats.enable_stats()
+        migrate_ndjson(tmp_path / 'enabled', tmp_path / 'in', False, '*.ndjson')
+        stages = collector.report()['stages']
+    finally:
+        stats.disable_stats()
+    assert stages['read']['bytes'] == source.stat().st_size
+    assert stages['write']['bytes'] == (tmp_path / 'enabled' / 'Patient.ndjson').stat().st_size
+    assert (tmp_path / 'enabled' / 'Patient.ndjson').read_bytes() == (tmp_path / 'disabled' / 'Patient.ndjson').read_bytes()
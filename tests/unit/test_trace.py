@@ -0,0 +1,30 @@
+import orjson
+
+from iceberg_tools import trace
+from iceberg_tools.data.pfb import run_cmd
+from iceberg_tools.data.simplifier import simplify_directory
+from iceberg_tools.trace import span
+
+
+def test_trace_spans(tmp_path):
+    """Spans are recorded only while enabled, worker spans are merged into the parent's trace."""
+    with span('ignored', 'test'):
+        pass
+    assert trace.tracer() is None
+    tracer = trace.enable_trace()
+    try:
+        assert run_cmd('echo hello') == 'hello'
+        simplify_directory('tests/fixtures/simplify/kf', 'Organization.ndjson', tmp_path / 'out',
+                           'iceberg/schemas/simplified/simplified-fhir.json', 'PFB', 'config.yaml', workers=2)
+        tracer.write(tmp_path / 'trace.json')
+    finally:
+        trace.disable_trace()
+
+    events = orjson.loads((tmp_path / 'trace.json').read_bytes())['traceEvents']
+    spans = [_ for _ in events if _['ph'] == 'X']
+    assert [_['name'] for _ in spans] == ['echo hello', 'task', 'merge']
+    assert spans[0]['args']['command'] == 'echo hello'
+    task = spans[1]
+    assert task['dur'] > 0 and task['args']['path'].endswith('Organization.ndjson')
+    names = {(_['pid'], _['name']): _['args']['name'] for _ in events if _['ph'] == 'M'}
+    assert names[(task['pid'], 'process_name')] != names[(spans[0]['pid'], 'process_name')]